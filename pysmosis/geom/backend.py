@@ -0,0 +1,36 @@
+"""
+Picks a linearref implementation: the extension compiled by setup.py, else
+linearref.pyx compiled on import by pyximport when Cython is installed, else
+the pure Python pylinearref.  Setting PYSMOSIS_LINEARREF to 'compiled',
+'pyximport' or 'python' forces one of them.
+
+    from backend import linearref
+"""
+import os
+
+IMPLEMENTATIONS = ('compiled', 'pyximport', 'python')
+
+def load(implementation=None):
+    """Returns (linearref module, name of its implementation)."""
+    if implementation not in (None,) + IMPLEMENTATIONS:
+        raise ValueError("unknown linearref implementation %r" % implementation)
+    if implementation in (None, 'compiled'):
+        try:
+            import linearref
+            return linearref, 'compiled'
+        except ImportError:
+            if implementation:
+                raise
+    if implementation in (None, 'pyximport'):
+        try:
+            import pyximport
+            pyximport.install()
+            import linearref
+            return linearref, 'pyximport'
+        except ImportError:
+            if implementation:
+                raise
+    import pylinearref
+    return pylinearref, 'python'
+
+linearref, IMPLEMENTATION = load(os.environ.get('PYSMOSIS_LINEARREF') or None)
@@ -0,0 +1,87 @@
+"""
+linearref benchmarks: import time and per-call cost of the compiled
+extension, pyximport and the pure Python fallback.  Build the extension
+first (python setup.py build_ext --inplace), then run from this directory:
+
+    python bench.py startup
+    python bench.py calls
+"""
+import os
+import sys
+import time
+import timeit
+import tempfile
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def run(implementation, code, env=None):
+    """Runs code in a fresh interpreter using the given linearref
+    implementation, returning its stdout."""
+    env = dict(env or os.environ, PYSMOSIS_LINEARREF=implementation)
+    p = subprocess.Popen([sys.executable, "-c", code], cwd=here, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode:
+        raise RuntimeError(err)
+    return out
+
+def bench_startup(repeat=3):
+    """Time to import linearref in a fresh process.  pyximport is timed with
+    an empty build directory (compiling the .pyx) and with the build cached."""
+    code = "import time; t = time.time(); import backend; print time.time() - t, backend.linearref.__file__"
+    cold_home = tempfile.mkdtemp()
+    cases = [('compiled', None), ('pyximport', dict(os.environ, HOME=cold_home)),
+             ('pyximport', None), ('python', None)]
+    for implementation, env in cases:
+        times = []
+        for i in range(env and 1 or repeat):
+            elapsed, path = run(implementation, code, env).split()
+            times.append(float(elapsed))
+        label = implementation + (env and " (cold)" or "")
+        print "startup %-18s %8.1fms  %s" % (label, min(times) * 1e3, os.path.basename(path))
+
+calls = [
+    ("distance_earth", "l.distance_earth(-122.41, 37.77, -122.42, 37.78)"),
+    ("seg_closest_pt", "l.seg_closest_pt(a, b, p)"),
+    ("seg_distance_pt", "l.seg_distance_pt(a, b, p)"),
+    ("LineString()", "l.LineString(coords, geographic=True)"),
+    ("length", "s.length()"),
+    ("locate_point", "s.locate_point(p)"),
+    ("substring", "s.substring(0.25, 0.75)"),
+    ("locate_points/pt", "s.locate_points(xs, ys)", 1000),
+    ("distance_earth_many/pt", "l.distance_earth_many(xs, ys, xs2, ys)", 1000),
+]
+
+setup = """
+from array import array
+from backend import linearref as l
+a, b, p = l.GPoint(-122.41, 37.77), l.GPoint(-122.42, 37.78), l.GPoint(-122.415, 37.771)
+coords = [(-122.41 + i * 0.001, 37.77 + (i % 2) * 0.001) for i in range(20)]
+s = l.LineString(coords, geographic=True)
+xs = array('d', [-122.41 + i * 1e-5 for i in range(1000)])
+ys = array('d', [37.77 + i * 1e-5 for i in range(1000)])
+xs2 = array('d', [x + 0.01 for x in xs])
+"""
+
+def bench_calls(number=20000):
+    """Microseconds per call (per point, for the batch calls) of the API."""
+    implementations = ('compiled', 'pyximport', 'python')
+    results = {}
+    for implementation in implementations:
+        timings = run(implementation, """
+import timeit
+for name, stmt, per in %r:
+    n = max(1, %d // per)
+    print name, min(timeit.repeat(stmt, %r, number=n, repeat=3)) / n / per * 1e6
+""" % ([c + (1,) if len(c) == 2 else c for c in calls], number, setup))
+        results[implementation] = dict((line.split()[0], float(line.split()[1])) for line in timings.splitlines())
+    print "%-24s" % "us/call" + "".join(["%12s" % i for i in implementations])
+    for call in calls:
+        print "%-24s" % call[0] + "".join(["%12.3f" % results[i][call[0]] for i in implementations])
+
+benchmarks = {'startup': bench_startup,
+              'calls': bench_calls}
+
+if __name__ == '__main__':
+    name = len(sys.argv) > 1 and sys.argv[1] or 'startup'
+    benchmarks[name]()
@@ -0,0 +1,197 @@
+"""
+A routing graph over way segments, in compressed sparse row form.
+
+Vertices are the end nodes of the segments, numbered in node id order.  The
+edges leaving vertex v are edges offsets[v] to offsets[v+1] - 1 of the flat
+targets, segments and lengths arrays: the vertex each leads to, the id of
+the segment it follows and its length in meters, the length of the segment
+geometry from linearref.distance_earth.  Searches are Dijkstra's, or A*
+with the spherical distance to the target as the heuristic, over these
+arrays.
+"""
+import heapq
+from array import array
+from bisect import bisect_left
+
+from backend import linearref
+
+# array typecode holding a signed 64 bit integer
+INT64 = [t for t in ('l', 'i') if array(t).itemsize == 8][0]
+INFINITY = float('inf')
+
+class Graph(object):
+    """A directed graph of the segments between nodes of a road network.
+
+    Build it from (segment id, start node id, end node id, coordinates)
+    tuples, where coordinates is the sequence of (x, y) pairs of the segment
+    (e.g. WaySegment rows), with an optional fifth item, the direction it
+    may be followed in: 0 both ways (the default), 1 start to end only, -1
+    end to start only.  Segments of fewer than two points are left out."""
+    def __init__(self, segments):
+        ids, starts, ends, directions = array(INT64), array(INT64), array(INT64), array('b')
+        x1, y1, x2, y2 = array('d'), array('d'), array('d'), array('d')
+        npairs = array('i')
+        coords = {}
+        for segment in segments:
+            pts = list(segment[3])
+            if len(pts) < 2:
+                continue
+            ids.append(segment[0])
+            starts.append(segment[1])
+            ends.append(segment[2])
+            directions.append(len(segment) > 4 and segment[4] or 0)
+            coords[segment[1]] = pts[0]
+            coords[segment[2]] = pts[-1]
+            for (a, b), (c, d) in zip(pts, pts[1:]):
+                x1.append(a); y1.append(b); x2.append(c); y2.append(d)
+            npairs.append(len(pts) - 1)
+
+        # segment lengths, from the distances of all their point pairs at once
+        distances = linearref.distance_earth_many(x1, y1, x2, y2)
+        lengths = array('d')
+        i = 0
+        for n in npairs:
+            lengths.append(sum(distances[i:i + n]))
+            i += n
+
+        self.nodes = array(INT64, sorted(coords))
+        vertex = dict((node, v) for v, node in enumerate(self.nodes))
+        self.xs = array('d', [coords[node][0] for node in self.nodes])
+        self.ys = array('d', [coords[node][1] for node in self.nodes])
+
+        # each edge as (source, target, segment index), then in CSR order
+        edges = []
+        for i in xrange(len(ids)):
+            a, b = vertex[starts[i]], vertex[ends[i]]
+            if directions[i] >= 0:
+                edges.append((a, b, i))
+            if directions[i] <= 0:
+                edges.append((b, a, i))
+        edges.sort()
+        self.offsets = array('i', [0] * (len(self.nodes) + 1))
+        for a, b, i in edges:
+            self.offsets[a + 1] += 1
+        for v in xrange(len(self.nodes)):
+            self.offsets[v + 1] += self.offsets[v]
+        self.targets = array('i', [b for a, b, i in edges])
+        self.segments = array(INT64, [ids[i] for a, b, i in edges])
+        self.lengths = array('d', [lengths[i] for a, b, i in edges])
+
+    ARRAYS = ('nodes', 'xs', 'ys', 'offsets', 'targets', 'segments', 'lengths')
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """A graph over the arrays of another, as returned by its arrays()
+        (e.g. read back from a snapshot), which are used as they are."""
+        graph = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(graph, name, arrays[name])
+        return graph
+
+    def arrays(self):
+        """{name: array} of the graph's arrays."""
+        return dict((name, getattr(self, name)) for name in self.ARRAYS)
+
+    def __len__(self):
+        """The number of edges."""
+        return len(self.targets)
+
+    def nbytes(self):
+        """The memory taken by the graph's arrays."""
+        return sum([len(buffer(a)) for a in self.arrays().values()])
+
+    def vertex(self, node):
+        """The vertex of a node id; KeyError if the node is not in the graph."""
+        v = bisect_left(self.nodes, node)
+        if v == len(self.nodes) or self.nodes[v] != node:
+            raise KeyError(node)
+        return v
+
+    def edges(self, node):
+        """(target node id, segment id, length) of the edges leaving node."""
+        v = self.vertex(node)
+        return [(self.nodes[self.targets[e]], self.segments[e], self.lengths[e])
+                for e in xrange(self.offsets[v], self.offsets[v + 1])]
+
+    def _search(self, source, goals=(), target=None, max_length=None):
+        """Settles vertices in order of their distance from vertex source,
+        until all of the vertices in goals are settled (or, without goals,
+        every reachable one) or the distance passes max_length.  With a
+        target vertex, the search is A* toward it, and ends there.  Returns
+        ({vertex: distance} of the settled vertices, {vertex: (previous
+        vertex, edge)} of every vertex reached)."""
+        offsets, targets, lengths = self.offsets, self.targets, self.lengths
+        push, pop = heapq.heappush, heapq.heappop
+        if target is not None:
+            goals = (target,)
+            xs, ys, tx, ty = self.xs, self.ys, self.xs[target], self.ys[target]
+            distance_earth = linearref.distance_earth
+        remaining = set(goals)
+        settled = {}
+        best = {source: 0.0}
+        previous = {source: (-1, -1)}
+        heap = [(0.0, 0.0, source)]
+        while heap:
+            f, d, v = pop(heap)
+            if v in settled:
+                continue
+            if max_length is not None and d > max_length:
+                break
+            settled[v] = d
+            if remaining:
+                remaining.discard(v)
+                if not remaining:
+                    break
+            for e in xrange(offsets[v], offsets[v + 1]):
+                w = targets[e]
+                dw = d + lengths[e]
+                if w not in settled and dw < best.get(w, INFINITY):
+                    best[w] = dw
+                    previous[w] = (v, e)
+                    if target is None:
+                        push(heap, (dw, dw, w))
+                    else:
+                        push(heap, (dw + distance_earth(xs[w], ys[w], tx, ty), dw, w))
+        return settled, previous
+
+    def _path(self, previous, v):
+        nodes, segments = [self.nodes[v]], []
+        v, e = previous[v]
+        while e >= 0:
+            nodes.append(self.nodes[v])
+            segments.append(self.segments[e])
+            v, e = previous[v]
+        nodes.reverse()
+        segments.reverse()
+        return nodes, segments
+
+    def shortest_path(self, source, target, astar=True):
+        """(length in meters, node ids, segment ids) of the shortest path from
+        node source to node target, or None if there is none.  astar=False
+        searches with plain Dijkstra."""
+        s, t = self.vertex(source), self.vertex(target)
+        if astar:
+            settled, previous = self._search(s, target=t)
+        else:
+            settled, previous = self._search(s, goals=(t,))
+        if t not in settled:
+            return None
+        return (settled[t],) + self._path(previous, t)
+
+    def distances(self, source, targets=None, max_length=None):
+        """{node id: length of the shortest path} from node source to each of
+        targets (or every node) reachable within max_length meters, in one
+        search."""
+        goals = targets is not None and [self.vertex(t) for t in targets] or ()
+        settled, previous = self._search(self.vertex(source), goals, max_length=max_length)
+        if targets is not None:
+            return dict((self.nodes[v], settled[v]) for v in goals if v in settled)
+        return dict((self.nodes[v], d) for v, d in settled.iteritems())
+
+    def shortest_paths(self, source, targets, max_length=None):
+        """{node id: (length, node ids, segment ids)} of the shortest paths from
+        node source to each of targets reachable within max_length, in one
+        search."""
+        goals = [self.vertex(t) for t in targets]
+        settled, previous = self._search(self.vertex(source), goals, max_length=max_length)
+        return dict((self.nodes[v], (settled[v],) + self._path(previous, v)) for v in goals if v in settled)
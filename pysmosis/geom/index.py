@@ -0,0 +1,197 @@
+"""
+An in-memory spatial index over line segments, for nearest-segment queries.
+
+The segments (consecutive vertex pairs of a set of linestrings, e.g. way
+geometries) are kept in flat arrays and packed into an R-tree with the
+Sort-Tile-Recursive algorithm.  Queries are best-first searches over the
+tree, ordered by a lower bound of the spherical distance to each box, and
+return exact distances from linearref.
+"""
+import heapq
+from array import array
+from math import asin, sin, cos, sqrt, radians, ceil
+
+from backend import linearref
+
+EARTH_RADIUS = 6370986.884258304
+
+# array typecode holding a signed 64 bit integer
+INT64 = [t for t in ('l', 'i') if array(t).itemsize == 8][0]
+
+def box_mindist(x, y, minx, miny, maxx, maxy):
+    """A lower bound, in meters, of the spherical distance from (x, y) to any
+    point of the box."""
+    dx = max(minx - x, 0, x - maxx)
+    dy = max(miny - y, 0, y - maxy)
+    if dx == 0 and dy == 0:
+        return 0.0
+    # the cosine is smallest at the box latitude furthest from the equator
+    far = max(abs(miny), abs(maxy))
+    h = sin(radians(dy) / 2) ** 2 + cos(radians(y)) * cos(radians(far)) * sin(radians(min(dx, 180)) / 2) ** 2
+    return 2.0 * EARTH_RADIUS * asin(min(1.0, sqrt(h)))
+
+def segment_distance(x1, y1, x2, y2, x, y):
+    """(distance in meters, closest point, fraction along the segment) from 
+    (x, y) to the segment (x1, y1)-(x2, y2), using linearref."""
+    a = linearref.GPoint(x1, y1)
+    b = linearref.GPoint(x2, y2)
+    p = linearref.GPoint(x, y)
+    closest = linearref.seg_closest_pt(a, b, p)
+    length = a.distance_pt(b)
+    return closest.distance_pt(p), (closest.x, closest.y), length and a.distance_pt(closest) / length or 0.0
+
+def closest_point_on_linestring(coords, point):
+    """Returns (segment number, fraction along that segment, closest point,
+    distance in meters) for the point of the linestring nearest point."""
+    x, y = point
+    best = None
+    for i in range(1, len(coords)):
+        (x1, y1), (x2, y2) = coords[i-1], coords[i]
+        d, closest, frac = segment_distance(x1, y1, x2, y2, x, y)
+        if best is None or d < best[3]:
+            best = (i-1, frac, closest, d)
+    return best
+
+def _str_order(boxes, count, leaf_size):
+    """Sort-Tile-Recursive order of count boxes held as minx, miny, maxx, maxy
+    quadruples in boxes: sorted by center x into vertical slices, each slice
+    sorted by center y."""
+    cx = lambda i: boxes[4*i] + boxes[4*i+2]
+    cy = lambda i: boxes[4*i+1] + boxes[4*i+3]
+    order = sorted(range(count), key=cx)
+    pages = int(ceil(count / float(leaf_size)))
+    slice_size = int(ceil(sqrt(pages))) * leaf_size
+    ret = []
+    for s in range(0, count, slice_size):
+        ret.extend(sorted(order[s:s + slice_size], key=cy))
+    return ret
+
+class SegmentIndex(object):
+    """An STR-packed R-tree over the segments of a set of linestrings.
+
+    Build it from (id, coordinates) pairs, where coordinates is a sequence of
+    (x, y) pairs (e.g. way ids and way geometries); queries report the id
+    and the position of the segment within its linestring."""
+    def __init__(self, linestrings, node_size=16):
+        self.node_size = node_size
+        self.coords = array('d')  # x1, y1, x2, y2 per segment
+        self.ids = array(INT64)   # linestring id per segment
+        self.seqs = array('i')    # segment number within the linestring
+        for id, coords in linestrings:
+            coords = list(coords)
+            for i in range(1, len(coords)):
+                self.coords.extend(coords[i-1])
+                self.coords.extend(coords[i])
+                self.ids.append(id)
+                self.seqs.append(i-1)
+        self._build()
+
+    @classmethod
+    def from_arrays(cls, arrays, node_size=16):
+        """An index over the arrays of another, as returned by its arrays()
+        (e.g. read back from a snapshot), which are used as they are."""
+        index = cls.__new__(cls)
+        index.node_size = node_size
+        for name in ('coords', 'ids', 'seqs', 'segment_boxes'):
+            setattr(index, name, arrays[name])
+        index.levels = []
+        while 'levels.%d.nodes' % len(index.levels) in arrays:
+            level = len(index.levels)
+            index.levels.append((arrays['levels.%d.nodes' % level], arrays['levels.%d.children' % level]))
+        return index
+
+    def arrays(self):
+        """{name: array} of the index's arrays; the tree levels are named
+        levels.<level>.nodes and levels.<level>.children."""
+        ret = {'coords': self.coords, 'ids': self.ids, 'seqs': self.seqs, 'segment_boxes': self.segment_boxes}
+        for level, (nodes, children) in enumerate(self.levels):
+            ret['levels.%d.nodes' % level] = nodes
+            ret['levels.%d.children' % level] = children
+        return ret
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _build(self):
+        n = len(self.ids)
+        c = self.coords
+        boxes = array('d')
+        for i in range(n):
+            x1, y1, x2, y2 = c[4*i:4*i+4]
+            boxes.extend((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+        # reorder the segments themselves into leaf order
+        order = _str_order(boxes, n, self.node_size)
+        self.coords = array('d', [v for i in order for v in c[4*i:4*i+4]])
+        self.ids = array(INT64, [self.ids[i] for i in order])
+        self.seqs = array('i', [self.seqs[i] for i in order])
+        boxes = array('d', [v for i in order for v in boxes[4*i:4*i+4]])
+        self.segment_boxes = boxes
+
+        # levels[0] are the leaves; every level holds node boxes and the
+        # [start, end) range of their children in the level below (or segments)
+        self.levels = []
+        count = n
+        while True:
+            nodes = array('d')
+            children = array('i')
+            for start in range(0, count, self.node_size):
+                end = min(start + self.node_size, count)
+                nodes.extend((min(boxes[4*i] for i in range(start, end)),
+                              min(boxes[4*i+1] for i in range(start, end)),
+                              max(boxes[4*i+2] for i in range(start, end)),
+                              max(boxes[4*i+3] for i in range(start, end))))
+                children.extend((start, end))
+            count = len(children) // 2
+            order = _str_order(nodes, count, self.node_size)
+            nodes = array('d', [v for i in order for v in nodes[4*i:4*i+4]])
+            children = array('i', [v for i in order for v in children[2*i:2*i+2]])
+            self.levels.append((nodes, children))
+            boxes = nodes
+            if count <= 1:
+                break
+
+    def segment(self, i):
+        """((x1, y1), (x2, y2)) of segment i."""
+        c = self.coords
+        return (c[4*i], c[4*i+1]), (c[4*i+2], c[4*i+3])
+
+    def distance(self, i, x, y):
+        """(distance in meters, closest point, fraction along the segment) from
+        (x, y) to segment i."""
+        c = self.coords
+        return segment_distance(c[4*i], c[4*i+1], c[4*i+2], c[4*i+3], x, y)
+
+    def iter_nearest(self, x, y, max_distance=None):
+        """Yields (distance, id, segment number, closest point, fraction along
+        the segment) for the segments nearest (x, y), nearest first."""
+        if not len(self.ids):
+            return
+        top = len(self.levels) - 1
+        heap = [(0.0, top, 0, None)]
+        while heap:
+            dist, level, i, hit = heapq.heappop(heap)
+            if max_distance is not None and dist > max_distance:
+                return
+            if hit:
+                yield (dist, self.ids[i], self.seqs[i]) + hit
+                continue
+            if level < 0:
+                d, point, frac = self.distance(i, x, y)
+                heapq.heappush(heap, (d, level, i, (point, frac)))
+                continue
+            nodes, children = self.levels[level]
+            boxes = level and self.levels[level-1][0] or self.segment_boxes
+            for j in range(children[2*i], children[2*i+1]):
+                k = 4 * j
+                d = box_mindist(x, y, boxes[k], boxes[k+1], boxes[k+2], boxes[k+3])
+                if max_distance is None or d <= max_distance:
+                    heapq.heappush(heap, (d, level-1, j, None))
+
+    def nearest(self, x, y, k=1, max_distance=None):
+        """The k nearest segments to (x, y), as returned by iter_nearest."""
+        ret = []
+        for hit in self.iter_nearest(x, y, max_distance):
+            ret.append(hit)
+            if len(ret) == k:
+                break
+        return ret
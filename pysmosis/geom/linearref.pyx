@@ -8,13 +8,20 @@ is (or is not) a geographic coordinate.  Geographic coordinates use a spherical
 calculation rather than a planar distance calculation.
 """
 
+cimport cython
+from array import array
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double asin(double d)
     double sin(double d)
     double cos(double d)
     double fabs(double d)
     double sqrt(double d)
+    double pow(double x, double y)
+
+cdef extern from "Python.h":
+    int PyObject_AsReadBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
+    int PyObject_AsWriteBuffer(object obj, void **buffer, Py_ssize_t *buffer_len) except -1
 
 
 # Constants
@@ -22,8 +29,11 @@ DEF __PI = 3.14159265
 DEF EARTH_RADIUS = 6370986.884258304
 
 
-cpdef double distance_earth(float x1, float y1, float x2, float y2):
+cpdef double distance_earth(double x1, double y1, double x2, double y2):
     """ Calculates the spherical distance between two geographic points."""
+    return _distance_earth(x1, y1, x2, y2)
+
+cdef inline double _distance_earth(double x1, double y1, double x2, double y2) nogil:
     cdef double long1, lat1, long2, lat2
     cdef double longdiff
     cdef double sino
@@ -44,16 +54,48 @@ cpdef double distance_earth(float x1, float y1, float x2, float y2):
     if sino > 1.0: sino = 1.0
     return 2.0 * EARTH_RADIUS * asin(sino);
 
-#def distance_earth(float x1, float y1, float x2, float y2):
-#    return cdistance_earth(x1,y1,x2,y2)
+cdef inline double _distance(double x1, double y1, double x2, double y2, bint geo) nogil:
+    if geo:
+        return _distance_earth(x1, y1, x2, y2)
+    return pow((x2-x1)*(x2-x1) + (y2-y1)*(y2-y1), 0.5)
+
+@cython.cdivision(True)
+cdef inline void _seg_closest(double x1, double y1, double x2, double y2, double px, double py, double *cx, double *cy) nogil:
+    """
+     * The closest point to p of the segment 1-2, using the 
+     * comp.graphics.algorithms Frequently Asked Questions method
+     *
+     *  (1)               AC dot AB
+         *         r = ---------
+         *               ||AB||^2
+     *    r has the following meaning:
+     *    r=0 P = A
+     *    r=1 P = B
+     *    r<0 P is on the backward extension of AB
+     *    r>1 P is on the forward extension of AB
+     *    0<r<1 P is interior to AB
+     *
+     * Further ref: http://local.wasp.uwa.edu.au/~pbourke/geometry/pointline/
+    """
+    cdef double r
+    if x1 == x2 and y1 == y2:
+        cx[0] = x1; cy[0] = y1
+        return
+    r = ((px-x1) * (x2-x1) + (py-y1) * (y2-y1)) / ((x2-x1)*(x2-x1) + (y2-y1)*(y2-y1))
+    if r < 0:
+        cx[0] = x1; cy[0] = y1
+    elif r > 1:
+        cx[0] = x2; cy[0] = y2
+    else:
+        cx[0] = x1 + r*(x2-x1); cy[0] = y1 + r*(y2-y1)
 
     
 cdef class CPoint:
     """ A coordinate pair.  If geo is set, distance_earth will be used in distance calculations."""
     cdef double _x, _y
-    cdef bool geo
+    cdef bint geo
 
-    def __init__(self, double x, double y, bool geo):
+    def __init__(self, double x, double y, bint geo):
         self._x = x; self._y = y; self.geo = geo;
         
     def __str__(self):
@@ -82,19 +124,14 @@ cdef class CPoint:
         
     
     cpdef double distance_pt(self, CPoint p2):
-        if self.geo:
-            return distance_earth(self._x, self._y, p2._x, p2._y)
-        # else
-        cdef double hside = p2._x - self._x
-        cdef double vside = p2._y - self._y
-        return ( hside*hside + vside*vside )**0.5
+        return _distance(self._x, self._y, p2._x, p2._y, self.geo)
     
 
-def Point(float x, float y):
+def Point(double x, double y):
     """Helper function to create a simple coordinate."""
     return CPoint(x, y, False)
 
-def GPoint(float x, float y):
+def GPoint(double x, double y):
     """ Helper function to return a geographic coordinate."""
     return CPoint(x, y, True)
 
@@ -145,7 +182,7 @@ cpdef CPoint seg_intersect_seg(CPoint a, CPoint b, CPoint c, CPoint d):
     if ( b._x == c._x ) and ( b._y == c._y ) or (( b._x == d._x ) and ( b._y == d._y )):
         return b.clone()
 
-    cdef float r_bot = (b._x-a._x)*(d._y-c._y) - (b._y-a._y)*(d._x-c._x)
+    cdef double r_bot = (b._x-a._x)*(d._y-c._y) - (b._y-a._y)*(d._x-c._x)
     # colinear or parallel lines
     if r_bot == 0:
         return None    
@@ -188,18 +225,18 @@ cpdef double seg_distance_seg(CPoint a, CPoint b, CPoint c, CPoint d):
         If the denominator in eqn 1 is zero, AB & CD are parallel
         If the numerator in eqn 1 is also zero, AB & CD are collinear.
     """
-    cdef float r_top = (a._y-c._y)*(d._x-c._x) - (a._x-c._x)*(d._y-c._y)
-    cdef float r_bot = (b._x-a._x)*(d._y-c._y) - (b._y-a._y)*(d._x-c._x)
+    cdef double r_top = (a._y-c._y)*(d._x-c._x) - (a._x-c._x)*(d._y-c._y)
+    cdef double r_bot = (b._x-a._x)*(d._y-c._y) - (b._y-a._y)*(d._x-c._x)
 
-    cdef float s_top = (a._y-c._y)*(b._x-a._x) - (a._x-c._x)*(b._y-a._y)
-    cdef float s_bot = r_bot
+    cdef double s_top = (a._y-c._y)*(b._x-a._x) - (a._x-c._x)*(b._y-a._y)
+    cdef double s_bot = r_bot
     
     if  r_bot==0 or s_bot == 0:
         return min(seg_distance_pt(c, d, a),
                    min(seg_distance_pt(c, d, b),   
                        min(seg_distance_pt(a, b, c), seg_distance_pt(a, b, d))))
-    cdef float sv = s_top/s_bot
-    cdef float r = r_top/r_bot
+    cdef double sv = s_top/s_bot
+    cdef double r = r_top/r_bot
 
     if r<0 or r>1 or sv<0 or sv>1:
         #no intersection 
@@ -214,125 +251,146 @@ cpdef double seg_distance_seg(CPoint a, CPoint b, CPoint c, CPoint d):
         
 cpdef double seg_distance_pt(CPoint a, CPoint b, CPoint p):
     """The closest distance from a line to a point."""
-    cdef CPoint c = seg_closest_pt(a, b, p)
-    #print "Closest", c
-    return c.distance_pt(p)
+    cdef double x, y
+    _seg_closest(a._x, a._y, b._x, b._y, p._x, p._y, &x, &y)
+    return _distance(x, y, p._x, p._y, a.geo)
 
 cpdef CPoint seg_closest_pt(CPoint a, CPoint b, CPoint p):
     """The point from a line to another line."""
-    if a._x == b._x and b._y == a._y:
-        #print "Case 1"
-        return a
-    
-    """
-     * otherwise, we use comp.graphics.algorithms
-     * Frequently Asked Questions method
-     *
-     *  (1)               AC dot AB
-         *         r = ---------
-         *               ||AB||^2
-     *    r has the following meaning:
-     *    r=0 P = A
-     *    r=1 P = B
-     *    r<0 P is on the backward extension of AB
-     *    r>1 P is on the forward extension of AB
-     *    0<r<1 P is interior to AB
-     *
-     * Further ref: http://local.wasp.uwa.edu.au/~pbourke/geometry/pointline/
-    """
-
-    r = ((p._x-a._x) * (b._x-a._x) + (p._y-a._y) * (b._y-a._y)) / ((b._x-a._x)*(b._x-a._x) +(b._y-a._y)*(b._y-a._y))
-    #print "r", r
-    if r<0: 
-        #print "Case 2"
-        return a.clone()
-    if r>1: 
-        #print "Case 3"
-        return b.clone()
-
-    return CPoint(a._x + r*(b._x - a._x), a._y + r*(b._y - a._y), a.geo)
+    cdef double x, y
+    _seg_closest(a._x, a._y, b._x, b._y, p._x, p._y, &x, &y)
+    return CPoint(x, y, a.geo)
 
-cdef interpolate_point2d(CPoint A, CPoint B, float F):
-        return CPoint(A.x+((B.x-A.x)*F), A.y+((B.y-A.y)*F), A.geo)
+cdef inline Py_ssize_t _nearest_seg(double *line, Py_ssize_t npts, double px, double py, bint geo, double *cx, double *cy, double *dist) nogil:
+    # the first segment nearest p, with the closest point on it and its distance
+    cdef Py_ssize_t i, seg = 0
+    cdef double x, y, d
+    for i from 1 <= i < npts:
+        _seg_closest(line[2*i-2], line[2*i-1], line[2*i], line[2*i+1], px, py, &x, &y)
+        d = _distance(x, y, px, py, geo)
+        if i == 1 or d < dist[0]:
+            dist[0] = d; cx[0] = x; cy[0] = y
+            seg = i-1
+        if dist[0] <= 0.0:
+            break
+    return seg
+
+cdef inline Py_ssize_t _bisect(double *cum, Py_ssize_t npts, double m) nogil:
+    # the first segment i with cum[i+1] >= m
+    cdef Py_ssize_t lo = 0, hi = npts - 2, mid
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if cum[mid+1] < m:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
-cdef CPoint _to_cpoint(object arg, object geographic):
+cdef object _to_coord(object arg):
     if type(arg) == tuple or type(arg) == list:
-        return CPoint(float(arg[0]), float(arg[1]), geographic)
+        return (float(arg[0]), float(arg[1]))
     if hasattr(arg,"x") and hasattr(arg,"y"):
-        return CPoint(float(arg.x), float(arg.y), geographic)
+        return (float(arg.x), float(arg.y))
     raise TypeError("unable to convert %s to a coordinate" % type(arg))
 
 cdef class LineString:
-    """A sequence of points that define a linestring."""
-    cdef object _pts
-    cdef object geographic # cant be a bool, because cython chokes on it.
+    """A sequence of points that define a linestring.
+    
+    The vertices are held in a flat array of doubles, alongside the length of
+    the linestring up to each vertex."""
+    cdef object _flat    # array('d') of x0, y0, x1, y1, ...
+    cdef object _lengths # array('d'), the length up to each vertex
+    cdef double *_coords
+    cdef double *_cum
+    cdef Py_ssize_t _n
+    cdef bint geographic
+    
     def __init__(self, *args, geographic=False):
-        self._pts = []
-        self.geographic = bool(geographic) == True
-        pts = []
+        self.geographic = geographic
+        flat = array('d')
         for a in args:
-            #print type(a), type(a[0])
             if type(a) == list or type(a) == tuple and type(a[0]) == tuple:
-                self._pts.extend([_to_cpoint(_a, geographic) for _a in a])
+                for _a in a:
+                    flat.extend(_to_coord(_a))
             else:
-                self._pts.append(_to_cpoint(a, geographic))
+                flat.extend(_to_coord(a))
+        self._set(flat)
+    
+    cdef _set(self, object flat):
+        cdef void *ptr
+        cdef Py_ssize_t i, size
+        self._n = len(flat) // 2
+        self._flat = flat
+        self._lengths = array('d', [0.0]) * (self._n + 1)
+        PyObject_AsWriteBuffer(self._flat, &ptr, &size)
+        self._coords = <double *>ptr
+        PyObject_AsWriteBuffer(self._lengths, &ptr, &size)
+        self._cum = <double *>ptr
+        for i from 1 <= i < self._n:
+            self._cum[i] = self._cum[i-1] + _distance(self._coords[2*i-2], self._coords[2*i-1], 
+                                                      self._coords[2*i], self._coords[2*i+1], self.geographic)
+    
+    cdef CPoint _pt(self, Py_ssize_t i):
+        return CPoint(self._coords[2*i], self._coords[2*i+1], self.geographic)
+    
+    cdef _check(self):
+        if self._n < 2:
+            raise ValueError("the linestring has fewer than two points")
     
     property pts:
         def __get__(self):
-            return self._pts
+            cdef Py_ssize_t i
+            return [self._pt(i) for i in range(self._n)]
     
     def __len__(self):
-        return len(self._pts)
+        return self._n
     
     def __str__(self):
-        return "(" + ",".join(map(str, self._pts)) + ")"
+        return "(" + ",".join(map(str, self.pts)) + ")"
     
     property coords:
         def __get__(self):
-            return [(c.x, c.y) for c in self._pts]
+            cdef Py_ssize_t i
+            return [(self._coords[2*i], self._coords[2*i+1]) for i in range(self._n)]
     
     def length(self):
         """Length of all segments comprising this line."""
-        return sum([self._pts[i-1].distance_pt(self._pts[i]) for i in range(1,len(self._pts))])
+        if self._n == 0:
+            return 0.0
+        return self._cum[self._n-1]
                 
     cpdef CPoint closest_pt(self, CPoint p):
         """The nearest point on this linestring to a given point."""
-        cdef int min_dist = -1
-        closest = None
-        for i in range(1,len(self._pts)):
-            a = self._pts[i-1]
-            b = self._pts[i]
-            c = seg_closest_pt(a, b, p)
-            d = c.distance_pt(p)
-            if d == 0:
-                return c
-            if not closest or min_dist > d:
-                min_dist = d
-                closest = c
-        return closest
+        cdef double x = 0, y = 0, d = 0
+        if self._n < 2:
+            return None
+        _nearest_seg(self._coords, self._n, p._x, p._y, self.geographic, &x, &y, &d)
+        return CPoint(x, y, self.geographic)
     
     cpdef double distance_pt(self, CPoint p):
         """The distance from the nearest point on this linestring to the given point."""
-        return self.closest_pt(p).distance_pt(p)
+        cdef double x = 0, y = 0, d = 0
+        self._check()
+        _nearest_seg(self._coords, self._n, p._x, p._y, self.geographic, &x, &y, &d)
+        return d
     
     cpdef CPoint closest_pt_to_line(self, LineString l2):
         """The distance from this line to another."""
-        cdef int min_dist = -1
+        cdef double min_dist = -1
         cdef CPoint closest = None
-        cdef double closest_u, closest_v
-        for i in range(1,len(self._pts)):
-            a = self._pts[i-1]
-            b = self._pts[i]
-            for j in range(1,len(l2._pts)):
-                u = l2._pts[j-1]
-                v = l2._pts[j]
+        pts = self.pts
+        pts2 = l2.pts
+        for i in range(1,len(pts)):
+            a = pts[i-1]
+            b = pts[i]
+            for j in range(1,len(pts2)):
+                u = pts2[j-1]
+                v = pts2[j]
                 d = seg_distance_seg(a, b, u, v)
                 if d == 0:
                     return seg_intersect_seg(a, b, u, v)
                 if min_dist == -1 or min_dist > d:
                     min_dist = d
-                    closest_u = seg_distance_pt(a, b, u)
-                    closest_v = seg_distance_pt(a, b, v)
                     if seg_distance_pt(a, b, u) < seg_distance_pt(a, b, v):
                         closest = seg_closest_pt(a, b, u)
                     else:
@@ -341,217 +399,216 @@ cdef class LineString:
     
     cpdef double distance_to_line(self, LineString l2):
         """The distance from this line to another."""
-        cdef int min_dist = -1
-        for i in range(1,len(self._pts)):
-            a = self._pts[i-1]
-            b = self._pts[i]
-            for j in range(1,len(l2._pts)):
-                u = l2._pts[j-1]
-                v = l2._pts[j]
+        cdef double min_dist = -1
+        pts = self.pts
+        pts2 = l2.pts
+        for i in range(1,len(pts)):
+            a = pts[i-1]
+            b = pts[i]
+            for j in range(1,len(pts2)):
+                u = pts2[j-1]
+                v = pts2[j]
                 d = seg_distance_seg(a, b, u, v)
-                #print "SDS",d
                 if d == 0:
                     return 0
                 if min_dist == -1 or min_dist > d:
                     min_dist = d
-        return d
+        return min_dist
 
-    
     cpdef double locate_point(self, CPoint p):
         """Find the measure [0,1] on this linestring to which the given point falls nearest."""
-        cdef CPoint nearest = None
-        cdef double mindist = -1 # min dist found
-        cdef CPoint start = None # current 
-        cdef CPoint end = None # current + 1
-        cdef int seg = -1 # closest segment index
-        cdef double dist
-
-        start = self._pts[0]
-        for i in range(1, len(self)):
-            end = self._pts[i]
-            dist = seg_distance_pt(start, end, p)
-            if i == 1 or dist < mindist:
-                mindist = dist
-                seg = i-1
-            if mindist <= 0.0: 
-                break
-            
-            start = end
-        if mindist > 0:
-            nearest = seg_closest_pt(self._pts[seg], self._pts[seg+1], p)
-        else:
-            nearest = p
-    
-        #print "Min dist", mindist, nearest, seg_closest_pt(self._pts[seg+1], self._pts[seg+2], p)
-        
-        
-        cdef double tlen = self.length() # total length
-        cdef double plen = 0 # length so far
-        
-        start = self._pts[0]
-        for i in range(0, seg):
-            end = self._pts[i+1]
-            plen = plen + start.distance_pt(end)
-            start = end
-        plen += start.distance_pt(nearest)
-        #print plen, tlen, start.distance_pt(nearest), plen/tlen
-        return plen / tlen
+        cdef double x = 0, y = 0, d = 0
+        cdef Py_ssize_t seg
+        self._check()
+        seg = _nearest_seg(self._coords, self._n, p._x, p._y, self.geographic, &x, &y, &d)
+        if d <= 0:
+            x = p._x; y = p._y
+        return (self._cum[seg] + _distance(self._coords[2*seg], self._coords[2*seg+1], x, y, self.geographic)) / self._cum[self._n-1]
+    
+    def locate_points(self, xs, ys):
+        """locate_point for each of the points (xs[i], ys[i]), as an array('d')."""
+        self._check()
+        return locate_points(self._flat, xs, ys, self.geographic)
+    
+    cdef object _along(self, Py_ssize_t i, double m):
+        # the point at length m along the linestring, which falls on segment i
+        cdef double *a = self._coords + 2*i
+        cdef double f
+        if m <= self._cum[i]:
+            return (a[0], a[1])
+        if m >= self._cum[i+1]:
+            return (a[2], a[3])
+        f = (m - self._cum[i]) / _distance(a[0], a[1], a[2], a[3], self.geographic)
+        return (a[0] + (a[2]-a[0])*f, a[1] + (a[3]-a[1])*f)
     
     cpdef LineString substring(self, double frm, double to):
         """Returns the substring of this linestring between the two measures."""
-        cdef int state = 0 # 0=before, 1=inside        
-        cdef object dpa = [] # the output array
-        cdef object ipa = self._pts # the input array
         cdef double length = self.length()
-        cdef double tlength = 0 # traversed length
-        cdef CPoint p1 = ipa[0]
-        cdef CPoint p2 = None
-
+        cdef Py_ssize_t i, first, last
+        cdef LineString ret
+        self._check()
         if frm > to:
-            raise ArgumentError("from is less than to")
-        # Get 'from' and 'to' lengths 
+            raise ArgumentError("from is greater than to")
         frm = length*frm
         to = length*to
-
-        for i in range(0, len(ipa)-1):
-            p2 = ipa[i+1]
-            #LWDEBUGF(3 ,"Segment %d: (%g,%g,%g,%g)-(%g,%g,%g,%g)",
-            #    i, p1.x, p1.y, p1.z, p1.m, p2.x, p2.y, p2.z, p2.m);
-            # Find the length of this segment 
-            slength = p1.distance_pt(p2)
-    
-            """
-             * We are before requested start.
-            """
-            if state == 0: #  before 
-                """
-                 * Didn't reach the 'from' point,
-                 * nothing to do
-                """
-                if frm > tlength + slength:
-                    tlength += slength
-                    p1 = p2
-                    continue
-                    # goto END
-    
-                elif frm == tlength + slength:
-                    #LWDEBUG(3, "  Second point is our start");
-                    """
-                     * Second point is our start
-                    """
-                    dpa.append(p2)
-                    state=1 #;  we're inside now 
-                    
-                elif frm == tlength:
-                    #LWDEBUG(3, "  First point is our start");
-                    """
-                     * First point is our start
-                    """
-                    dpa.append(p1)
-                    """
-                     * We're inside now, but will check
-                     * 'to' point as well
-                    """
-                    state=1
-    
-                else:  # tlength < from < tlength+slength 
-                    """
-                     * Our start is between first and
-                     * second point
-                    """
-                    dseg = (frm- tlength) / slength;
-                    pt = interpolate_point2d(p1, p2,dseg)
-                    dpa.append(pt)
-                    """
-                     * We're inside now, but will check
-                     * 'to' point as well
-                     """
-                    state=1
-    
-            if state == 1: # inside     
-                #LWDEBUG(3, " Inside");
-                """
-                 * Didn't reach the 'end' point,
-                 * just copy second point
-                 """
-                if to > tlength + slength:
-                    dpa.append(p2)
-                    tlength += slength
-                    p1 = p2
-                    continue
-                    #goto END;
-                    
-                elif to == tlength + slength:
-                    """
-                     * 'to' point is our second point.
-                    """
-                    dpa.append(p2)
-                    break #  substring complete 
-    
-                elif to == tlength:
-                    """
-                     * 'to' point is our first point.
-                     * (should only happen if 'to' is 0)
-                    """
-                    dpa.append(p1)
-                    break#;  substring complete 
-    
-               
-                elif ( to < tlength + slength ):
-                    """
-                     * 'to' point falls on this segment
-                     * Interpolate and break.
-                    """
-                    dseg = (to - tlength) / slength
-                    pt = interpolate_point2d(p1, p2, dseg)
-                    dpa.append(pt)
-                    break
-                else:
-                    print "Unhandled case"
-            
-            tlength += slength
-            p1 = p2
-    
-        return LineString(dpa, geographic=ipa[0].is_geo())
-    
-    cpdef LineString concatenate(self, LineString l2, float merge_tolerance=0):
+        first = _bisect(self._cum, self._n, frm)
+        last = _bisect(self._cum, self._n, to)
+        
+        flat = array('d')
+        flat.extend(self._along(first, frm))
+        for i from first < i <= last:
+            if self._cum[i] > frm:
+                flat.extend((self._coords[2*i], self._coords[2*i+1]))
+        flat.extend(self._along(last, to))
+        ret = LineString(geographic=self.geographic)
+        ret._set(flat)
+        return ret
+    
+    cpdef LineString concatenate(self, LineString l2, double merge_tolerance=0):
         """Returns true if l2 was joined or None, if the min distance is above the max distance allowed."""
         cdef CPoint a, b, c, d
-        a = self._pts[0]
-        b = self._pts[-1]
-        c = l2._pts[0]
-        d = l2._pts[-1]
+        self._check()
+        l2._check()
+        a = self._pt(0)
+        b = self._pt(self._n-1)
+        c = l2._pt(0)
+        d = l2._pt(l2._n-1)
         cdef double ac = a.distance_pt(c)
         cdef double ad = a.distance_pt(d)
         cdef double bc = b.distance_pt(c)
         cdef double bd = b.distance_pt(d)
+        coords = self.coords
+        coords2 = l2.coords
         
         if ac < min(ad, min(bc, bd)):
             #print "Case 1", a, c, ac
             if ac <= merge_tolerance:
-                return LineString(self._pts[::-1], l2._pts[1:], geographic=self.geographic)
+                return LineString(coords[::-1], coords2[1:], geographic=self.geographic)
             else:
-                return LineString(self._pts[::-1], l2._pts, geographic=self.geographic)
+                return LineString(coords[::-1], coords2, geographic=self.geographic)
 
         elif ad < min(bc, bd):
             #print "Case 2", a, d, ad
             if ad <= merge_tolerance:
-                return LineString(l2._pts, self._pts[1:], geographic=self.geographic)
+                return LineString(coords2, coords[1:], geographic=self.geographic)
             else:
-                return LineString(l2._pts, self._pts, geographic=self.geographic)
+                return LineString(coords2, coords, geographic=self.geographic)
         elif bc < bd:
             #print "Case 3", b, c, bc
             if bc <= merge_tolerance:
-                return LineString(self._pts, l2._pts[1:], geographic=self.geographic)
+                return LineString(coords, coords2[1:], geographic=self.geographic)
             else:
-                return LineString(self._pts, l2._pts, geographic=self.geographic)
+                return LineString(coords, coords2, geographic=self.geographic)
         else:
             #print "Case 4", b, d, bd
             if bd <= merge_tolerance:
-                return LineString(self._pts, l2._pts[1::-1], geographic=self.geographic)
+                return LineString(coords, coords2[-2::-1], geographic=self.geographic)
             else:
-                return LineString(self._pts, l2._pts[::-1], geographic=self.geographic)
+                return LineString(coords, coords2[::-1], geographic=self.geographic)
         
     
+"""
+Batch versions of the functions above, over contiguous buffers of C doubles
+(array('d') or native endian, C contiguous float64 numpy arrays; other
+numpy arrays are copied into one of those, and other sequences into an
+array('d'), first).  Linestrings are given as flat x1, y1, x2, y2, ... 
+coordinates.  The loops run in C with the GIL released, so several threads 
+can work on one trace or segment table at once.  Results are returned as
+array('d') (and array('i') for segment numbers).
+"""
+
+cdef object _doubles(object obj, double **buf, Py_ssize_t *n):
+    """Points buf at obj's doubles, returning obj, or the array('d') copy 
+    made of it, which the caller must hold on to."""
+    cdef void *ptr
+    cdef Py_ssize_t size
+    dtype = getattr(obj, 'dtype', None)
+    if dtype is not None:
+        # a numpy array's buffer is only read as is if it is native endian,
+        # C contiguous doubles
+        if dtype.char != 'd' or not dtype.isnative or not obj.flags.c_contiguous:
+            obj = obj.astype('=f8', order='C')
+    elif getattr(obj, 'typecode', None) != 'd':
+        obj = array('d', obj)
+    PyObject_AsReadBuffer(obj, &ptr, &size)
+    buf[0] = <double *>ptr
+    n[0] = size / sizeof(double)
+    return obj
+
+cdef object _new_array(object typecode, Py_ssize_t n, void **buf):
+    cdef Py_ssize_t size
+    ret = array(typecode, [0]) * n
+    PyObject_AsWriteBuffer(ret, buf, &size)
+    return ret
+
+cdef object _points(object xs, object ys, double **x, double **y, Py_ssize_t *n):
+    cdef Py_ssize_t ny
+    xs = _doubles(xs, x, n)
+    ys = _doubles(ys, y, &ny)
+    if n[0] != ny:
+        raise ValueError("coordinate arrays differ in length")
+    return (xs, ys)
+
+cdef object _line(object coords, double **line, Py_ssize_t *npts):
+    coords = _doubles(coords, line, npts)
+    npts[0] = npts[0] / 2
+    if npts[0] < 2:
+        raise ValueError("a linestring needs at least two points")
+    return coords
+
+def distance_earth_many(x1, y1, x2, y2):
+    """distance_earth between each of the points (x1[i], y1[i]) and (x2[i], y2[i])."""
+    cdef double *x1s, *y1s, *x2s, *y2s, *out
+    cdef Py_ssize_t i, n, m
+    a = _points(x1, y1, &x1s, &y1s, &n)
+    b = _points(x2, y2, &x2s, &y2s, &m)
+    if n != m:
+        raise ValueError("coordinate arrays differ in length")
+    ret = _new_array('d', n, <void **>&out)
+    with nogil:
+        for i from 0 <= i < n:
+            out[i] = _distance_earth(x1s[i], y1s[i], x2s[i], y2s[i])
+    return ret
+
+def closest_pts(coords, xs, ys, bint geographic=False):
+    """For each of the points (xs[i], ys[i]), the nearest point of the 
+    linestring coords and its distance, as (xs, ys, distances, segment 
+    numbers) arrays."""
+    cdef double *line, *px, *py, *cx, *cy, *dist
+    cdef int *seg
+    cdef Py_ssize_t i, n, npts
+    coords = _line(coords, &line, &npts)
+    points = _points(xs, ys, &px, &py, &n)
+    ret = (_new_array('d', n, <void **>&cx), _new_array('d', n, <void **>&cy),
+           _new_array('d', n, <void **>&dist), _new_array('i', n, <void **>&seg))
+    with nogil:
+        for i from 0 <= i < n:
+            seg[i] = _nearest_seg(line, npts, px[i], py[i], geographic, &cx[i], &cy[i], &dist[i])
+    return ret
+
+@cython.cdivision(True)
+def locate_points(coords, xs, ys, bint geographic=False):
+    """LineString.locate_point for each of the points (xs[i], ys[i]) on the
+    linestring coords: the measure [0,1] at which each falls nearest."""
+    cdef double *line, *px, *py, *out, *cum
+    cdef double cx = 0, cy = 0, dist = 0
+    cdef Py_ssize_t i, n, npts, seg
+    coords = _line(coords, &line, &npts)
+    points = _points(xs, ys, &px, &py, &n)
+    # cum[i] is the length of the linestring up to point i
+    cumulative = _new_array('d', npts, <void **>&cum)
+    for i from 1 <= i < npts:
+        cum[i] = cum[i-1] + _distance(line[2*i-2], line[2*i-1], line[2*i], line[2*i+1], geographic)
+    if cum[npts-1] == 0:
+        raise ZeroDivisionError("the linestring has no length")
+    ret = _new_array('d', n, <void **>&out)
+    with nogil:
+        for i from 0 <= i < n:
+            seg = _nearest_seg(line, npts, px[i], py[i], geographic, &cx, &cy, &dist)
+            if dist <= 0:
+                cx = px[i]; cy = py[i]
+            out[i] = (cum[seg] + _distance(line[2*seg], line[2*seg+1], cx, cy, geographic)) / cum[npts-1]
+    return ret
+
 class ArgumentError(Exception):
     pass
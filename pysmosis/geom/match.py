@@ -0,0 +1,218 @@
+"""
+Map matching: the road segments a GPS trace most likely followed, from a
+hidden Markov model over the candidate segments near each fix (after
+Newson and Krumm, "Hidden Markov Map Matching Through Noise and
+Sparseness", 2009).
+
+The candidates of a fix are the segments within radius meters of it,
+found in a SegmentIndex, each at its point nearest the fix.  The emission
+log probability of a candidate falls with the square of its distance from
+the fix (normal GPS noise, of standard deviation sigma meters).  The
+transition log probability between candidates of consecutive fixes falls
+with the difference between their route distance, through a routing
+Graph, and the great circle distance of the fixes (exponential, of scale
+beta meters).  Viterbi picks the most likely sequence of candidates; a
+fix without candidates, or one no candidate of the previous fix has a
+route to, ends the sequence and the next fix begins another.
+"""
+import multiprocessing
+from array import array
+
+from backend import linearref
+from graph import INT64, INFINITY
+from index import SegmentIndex
+
+# directions a segment may be followed in
+FORWARD, BACKWARD = 1, 2
+
+class Matcher(object):
+    """Matches traces to the segments of graph, a routing Graph, given the
+    (segment id, start node id, end node id, coordinates) tuples it was
+    built from.  A fifth item of those is ignored: segments are followed in
+    the directions of the graph's edges.
+
+    radius is the distance in meters within which segments are candidates
+    of a fix, and candidates the most of them kept, nearest first.  Routes
+    between candidates are searched for up to max_detour times the distance
+    between their fixes, plus twice radius."""
+    def __init__(self, graph, segments, radius=50.0, candidates=8, sigma=5.0, beta=5.0,
+                 max_detour=3.0, node_size=16):
+        self.graph = graph
+        self.radius = radius
+        self.candidates = candidates
+        self.sigma = sigma
+        self.beta = beta
+        self.max_detour = max_detour
+        segments = sorted([(s[0], s[1], s[2], list(s[3])) for s in segments if len(s[3]) >= 2])
+        self.ids, self.starts, self.ends = array(INT64), array(INT64), array(INT64)
+        # cum holds the length of each segment up to each of its vertices,
+        # the vertices of segment row starting at first[row]
+        self.first = array('i')
+        x1, y1, x2, y2 = array('d'), array('d'), array('d'), array('d')
+        for id, start, end, coords in segments:
+            self.ids.append(id)
+            self.starts.append(start)
+            self.ends.append(end)
+            self.first.append(len(x1) + len(self.first))
+            for (a, b), (c, d) in zip(coords, coords[1:]):
+                x1.append(a); y1.append(b); x2.append(c); y2.append(d)
+        distances = linearref.distance_earth_many(x1, y1, x2, y2)
+        self.cum, self.lengths = array('d'), array('d')
+        i = 0
+        for id, start, end, coords in segments:
+            length = 0.0
+            self.cum.append(length)
+            for d in distances[i:i + len(coords) - 1]:
+                length += d
+                self.cum.append(length)
+            self.lengths.append(length)
+            i += len(coords) - 1
+        self.rows = dict((id, row) for row, id in enumerate(self.ids))
+
+        self.directions = array('b', [0] * len(self.ids))
+        for v in xrange(len(graph.nodes)):
+            node = graph.nodes[v]
+            for e in xrange(graph.offsets[v], graph.offsets[v + 1]):
+                row = self.rows.get(graph.segments[e])
+                if row is None:
+                    continue
+                # of a loop's two edges, take the first to be the forward one
+                if node == self.starts[row] and not self.directions[row] & FORWARD:
+                    self.directions[row] |= FORWARD
+                else:
+                    self.directions[row] |= BACKWARD
+        self.index = SegmentIndex(((id, coords) for id, start, end, coords in segments), node_size)
+
+    def nearest(self, x, y):
+        """The candidates of a fix at (x, y): (segment id, offset in meters
+        along the segment of its point nearest the fix, distance in meters of
+        that point from the fix), nearest first."""
+        ret = []
+        seen = set()
+        for dist, id, seq, point, frac in self.index.iter_nearest(x, y, self.radius):
+            if id in seen:
+                continue
+            seen.add(id)
+            k = self.first[self.rows[id]] + seq
+            ret.append((id, self.cum[k] + frac * (self.cum[k + 1] - self.cum[k]), dist))
+            if len(ret) == self.candidates:
+                break
+        return ret
+
+    def _ends(self, id, offset):
+        """(node, meters from offset to it) of the ends of segment id that
+        can be driven to from offset along it, and (node, meters from it to
+        offset) of those that offset can be driven to from."""
+        row = self.rows[id]
+        flags, length = self.directions[row], self.lengths[row]
+        exits, entries = [], []
+        if flags & FORWARD:
+            exits.append((self.ends[row], length - offset))
+            entries.append((self.starts[row], offset))
+        if flags & BACKWARD:
+            exits.append((self.starts[row], offset))
+            entries.append((self.ends[row], length - offset))
+        return exits, entries
+
+    def routes(self, a, b, max_length=None):
+        """The route distances in meters, routes[i][j], from each candidate
+        a[i] of a fix to each candidate b[j] of the next (INFINITY if there
+        is none within max_length meters of the graph), with one search from
+        each node the a candidates can leave their segments by."""
+        exits = [self._ends(id, offset)[0] for id, offset, dist in a]
+        entries = [self._ends(id, offset)[1] for id, offset, dist in b]
+        targets = set([node for ends in entries for node, m in ends])
+        reached = dict((node, self.graph.distances(node, targets, max_length))
+                       for node in set([node for ends in exits for node, m in ends]))
+        ret = []
+        for i, (id, offset, dist) in enumerate(a):
+            row = []
+            for j, (id2, offset2, dist2) in enumerate(b):
+                best = INFINITY
+                if id == id2:
+                    flags = self.directions[self.rows[id]]
+                    if flags & FORWARD and offset2 >= offset:
+                        best = offset2 - offset
+                    if flags & BACKWARD and offset2 <= offset:
+                        best = min(best, offset - offset2)
+                for node, m in exits[i]:
+                    distances = reached[node]
+                    for node2, m2 in entries[j]:
+                        if node2 in distances:
+                            best = min(best, m + distances[node2] + m2)
+                row.append(best)
+            ret.append(row)
+        return ret
+
+    def match(self, trace):
+        """Matches a trace, a sequence of (x, y) fixes, returning for each
+        fix (segment id, offset in meters along the segment from its start
+        node) of its match, or None if it has no candidates."""
+        trace = list(trace)
+        ret = [None] * len(trace)
+        if not trace:
+            return ret
+        xs = array('d', [x for x, y in trace])
+        ys = array('d', [y for x, y in trace])
+        # great circle distances between consecutive fixes
+        gaps = linearref.distance_earth_many(xs[:-1], ys[:-1], xs[1:], ys[1:])
+        candidates = [self.nearest(x, y) for x, y in trace]
+        # back[t][j]: the candidate of fix t - 1 on the best path to
+        # candidate j of fix t, or -1 where a sequence begins
+        back = [None] * len(trace)
+        scores = None
+        for t, cands in enumerate(candidates):
+            emissions = [-0.5 * (dist / self.sigma) ** 2 for id, offset, dist in cands]
+            if scores is not None and cands:
+                routes = self.routes(candidates[t - 1], cands, self.max_detour * gaps[t - 1] + 2 * self.radius)
+                previous, scores, back[t] = scores, [], []
+                for j, emission in enumerate(emissions):
+                    best, arg = -INFINITY, -1
+                    for i, score in enumerate(previous):
+                        if routes[i][j] < INFINITY:
+                            score -= abs(routes[i][j] - gaps[t - 1]) / self.beta
+                            if score > best:
+                                best, arg = score, i
+                    scores.append(best + emission)
+                    back[t].append(arg)
+                if max(back[t]) >= 0:
+                    continue
+                # no route from the previous fix: its sequence ends there
+                self._trace_back(ret, candidates, back, t - 1, previous)
+            elif scores is not None:
+                self._trace_back(ret, candidates, back, t - 1, scores)
+            scores = cands and emissions or None
+            back[t] = [-1] * len(cands)
+        if scores is not None:
+            self._trace_back(ret, candidates, back, len(trace) - 1, scores)
+        return ret
+
+    def _trace_back(self, ret, candidates, back, t, scores):
+        """Fills ret with the best sequence of candidates ending at fix t."""
+        j = max(range(len(scores)), key=scores.__getitem__)
+        while j >= 0:
+            id, offset, dist = candidates[t][j]
+            ret[t] = (id, offset)
+            j = back[t][j]
+            t -= 1
+
+    def match_traces(self, traces, workers=1, chunksize=8):
+        """match for each of traces, in order.  With workers > 1 the traces
+        are matched in a pool of worker processes, which inherit the
+        Matcher, chunksize traces at a time."""
+        global _matcher
+        if workers <= 1:
+            return [self.match(trace) for trace in traces]
+        _matcher = self
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(_match_task, traces, chunksize)
+        finally:
+            pool.terminate()
+            _matcher = None
+
+# the Matcher of a match_traces worker process
+_matcher = None
+
+def _match_task(trace):
+    return _matcher.match(trace)
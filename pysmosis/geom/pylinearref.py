@@ -0,0 +1,421 @@
+"""
+A pure Python implementation of the linearref API, for when the compiled
+extension is not available.  It follows the Cython code operation for
+operation, so both give the same results; it is only slower.
+"""
+from array import array
+from bisect import bisect_left
+from math import asin, sin, cos, fabs, sqrt
+
+__PI = 3.14159265
+EARTH_RADIUS = 6370986.884258304
+
+def distance_earth(x1, y1, x2, y2):
+    """ Calculates the spherical distance between two geographic points."""
+    long1 = -2 * (x1 / 360.0) * __PI
+    lat1 = 2 * (y1 / 360.0) * __PI
+
+    long2 = -2 * (x2 / 360.0) * __PI
+    lat2 = 2 * (y2 / 360.0) * __PI
+
+    # compute difference in longitudes - want < 180 degrees
+    longdiff = fabs(long1 - long2)
+    if longdiff > __PI:
+        longdiff = (2 * __PI) - longdiff
+
+    sino = sqrt(sin(fabs(lat1 - lat2) / 2.) * sin(fabs(lat1 - lat2) / 2.) + \
+            cos(lat1) * cos(lat2) * sin(longdiff / 2.) * sin(longdiff / 2.))
+    if sino > 1.0: sino = 1.0
+    return 2.0 * EARTH_RADIUS * asin(sino)
+
+def _distance(x1, y1, x2, y2, geo):
+    if geo:
+        return distance_earth(x1, y1, x2, y2)
+    return ((x2-x1)*(x2-x1) + (y2-y1)*(y2-y1))**0.5
+
+def _seg_closest(x1, y1, x2, y2, px, py):
+    # see linearref._seg_closest
+    if x1 == x2 and y1 == y2:
+        return x1, y1
+    r = ((px-x1) * (x2-x1) + (py-y1) * (y2-y1)) / ((x2-x1)*(x2-x1) + (y2-y1)*(y2-y1))
+    if r < 0:
+        return x1, y1
+    if r > 1:
+        return x2, y2
+    return x1 + r*(x2-x1), y1 + r*(y2-y1)
+
+class CPoint(object):
+    """ A coordinate pair.  If geo is set, distance_earth will be used in distance calculations."""
+    __slots__ = ('x', 'y', 'geo')
+
+    def __init__(self, x, y, geo):
+        self.x = float(x); self.y = float(y); self.geo = bool(geo)
+
+    def __str__(self):
+        return "(%f %f)" % (self.x, self.y)
+
+    def clone(self):
+        """ Return a copy of this point."""
+        return CPoint(self.x, self.y, self.geo)
+
+    def is_geo(self):
+        """Is this a geographic point."""
+        return self.geo == True
+
+    def distance_pt(self, p2):
+        return _distance(self.x, self.y, p2.x, p2.y, self.geo)
+
+def Point(x, y):
+    """Helper function to create a simple coordinate."""
+    return CPoint(x, y, False)
+
+def GPoint(x, y):
+    """ Helper function to return a geographic coordinate."""
+    return CPoint(x, y, True)
+
+class Line(object):
+    """ A line as defined by two points."""
+    def __init__(self, p1, p2):
+        self.p1 = p1; self.p2 = p2
+
+    def __str__(self):
+        return "%f,%f->%f,%f" %(self.p1.x, self.p1.y, self.p2.x, self.p2.y)
+
+    def length(self):
+        """ Length of the line."""
+        return self.p1.distance_pt(self.p2)
+
+    def closest_pt(self, p):
+        """Return the point on the line nearest the given point."""
+        return seg_closest_pt(self.p1, self.p2, p)
+
+    def distance_pt(self, p):
+        """The distance from the nearest point on this line to the given point."""
+        return seg_distance_pt(self.p1, self.p2, p)
+
+    def distance_seg(self, s):
+        """The closest distance from this line to another line."""
+        return seg_distance_seg(self.p1, self.p2, s.p1, s.p2)
+
+def seg_intersect_seg(a, b, c, d):
+    if (a.x == b.x) and (a.y == b.y):
+        if seg_distance_pt(c, d, a) == 0:
+            return a.clone()
+        return None
+
+    # U and V are the same point
+    if (c.x == d.x) and (c.y == d.y):
+        if seg_distance_pt(a, b, c) == 0:
+            return c.clone()
+        return None
+
+    if ((a.x == c.x) and (a.y == c.y)) or ((a.x == d.x) and (a.y == d.y)):
+        return a.clone()
+
+    if (b.x == c.x) and (b.y == c.y) or ((b.x == d.x) and (b.y == d.y)):
+        return b.clone()
+
+    r_bot = (b.x-a.x)*(d.y-c.y) - (b.y-a.y)*(d.x-c.x)
+    # colinear or parallel lines
+    if r_bot == 0:
+        return None
+
+    x = ((a.x*b.y - a.y*b.x)*(c.x - d.x) - (a.x - b.x)*(c.x*d.y - c.y*d.x)) / ((a.x - b.x)*(c.y - d.y) - (a.y - b.y)*(c.x - d.x))
+    y = ((a.x*b.y - a.y*b.x)*(c.y - d.y) - (a.y - b.y)*(c.x*d.y - c.y*d.x)) / ((a.x - b.x)*(c.y - d.y) - (a.y - b.y)*(c.x - d.x))
+    return CPoint(x, y, a.geo)
+
+def seg_distance_seg(a, b, c, d):
+    """The closest distance from one line to another line."""
+    # A and B are the same point
+    if (a.x == b.x) and (a.y == b.y):
+        return seg_distance_pt(c, d, a)
+
+    # U and V are the same point
+    if (c.x == d.x) and (c.y == d.y):
+        return seg_distance_pt(a, b, c)
+
+    # see linearref.seg_distance_seg
+    r_top = (a.y-c.y)*(d.x-c.x) - (a.x-c.x)*(d.y-c.y)
+    r_bot = (b.x-a.x)*(d.y-c.y) - (b.y-a.y)*(d.x-c.x)
+
+    s_top = (a.y-c.y)*(b.x-a.x) - (a.x-c.x)*(b.y-a.y)
+    s_bot = r_bot
+
+    if r_bot == 0 or s_bot == 0:
+        return min(seg_distance_pt(c, d, a),
+                   min(seg_distance_pt(c, d, b),
+                       min(seg_distance_pt(a, b, c), seg_distance_pt(a, b, d))))
+    sv = s_top/s_bot
+    r = r_top/r_bot
+
+    if r<0 or r>1 or sv<0 or sv>1:
+        #no intersection
+        return min(seg_distance_pt(c, d, a),
+                   min(seg_distance_pt(c, d, b),
+                       min(seg_distance_pt(a, b, c),
+                           seg_distance_pt(a, b, d))))
+    return 0.0
+
+def seg_distance_pt(a, b, p):
+    """The closest distance from a line to a point."""
+    x, y = _seg_closest(a.x, a.y, b.x, b.y, p.x, p.y)
+    return _distance(x, y, p.x, p.y, a.geo)
+
+def seg_closest_pt(a, b, p):
+    """The point from a line to another line."""
+    x, y = _seg_closest(a.x, a.y, b.x, b.y, p.x, p.y)
+    return CPoint(x, y, a.geo)
+
+def _nearest_seg(line, npts, px, py, geo):
+    # the first segment nearest p, with the closest point on it and its distance
+    seg = 0
+    for i in xrange(1, npts):
+        x, y = _seg_closest(line[2*i-2], line[2*i-1], line[2*i], line[2*i+1], px, py)
+        d = _distance(x, y, px, py, geo)
+        if i == 1 or d < dist:
+            dist = d; cx = x; cy = y
+            seg = i-1
+        if dist <= 0.0:
+            break
+    return seg, cx, cy, dist
+
+def _to_coord(arg):
+    if type(arg) == tuple or type(arg) == list:
+        return (float(arg[0]), float(arg[1]))
+    if hasattr(arg,"x") and hasattr(arg,"y"):
+        return (float(arg.x), float(arg.y))
+    raise TypeError("unable to convert %s to a coordinate" % type(arg))
+
+class LineString(object):
+    """A sequence of points that define a linestring.
+
+    The vertices are held in a flat array of doubles, alongside the length of
+    the linestring up to each vertex."""
+    def __init__(self, *args, **kwargs):
+        self.geographic = bool(kwargs.pop('geographic', False))
+        if kwargs:
+            raise TypeError("unexpected keyword arguments %s" % ", ".join(kwargs))
+        flat = array('d')
+        for a in args:
+            if type(a) == list or type(a) == tuple and type(a[0]) == tuple:
+                for _a in a:
+                    flat.extend(_to_coord(_a))
+            else:
+                flat.extend(_to_coord(a))
+        self._set(flat)
+
+    def _set(self, flat):
+        self._n = len(flat) // 2
+        self._coords = flat
+        self._cum = cum = array('d', [0.0]) * (self._n + 1)
+        for i in xrange(1, self._n):
+            cum[i] = cum[i-1] + _distance(flat[2*i-2], flat[2*i-1], flat[2*i], flat[2*i+1], self.geographic)
+
+    def _pt(self, i):
+        return CPoint(self._coords[2*i], self._coords[2*i+1], self.geographic)
+
+    def _check(self):
+        if self._n < 2:
+            raise ValueError("the linestring has fewer than two points")
+
+    @property
+    def pts(self):
+        return [self._pt(i) for i in range(self._n)]
+
+    def __len__(self):
+        return self._n
+
+    def __str__(self):
+        return "(" + ",".join(map(str, self.pts)) + ")"
+
+    @property
+    def coords(self):
+        return [(self._coords[2*i], self._coords[2*i+1]) for i in range(self._n)]
+
+    def length(self):
+        """Length of all segments comprising this line."""
+        if self._n == 0:
+            return 0.0
+        return self._cum[self._n-1]
+
+    def closest_pt(self, p):
+        """The nearest point on this linestring to a given point."""
+        if self._n < 2:
+            return None
+        seg, x, y, d = _nearest_seg(self._coords, self._n, p.x, p.y, self.geographic)
+        return CPoint(x, y, self.geographic)
+
+    def distance_pt(self, p):
+        """The distance from the nearest point on this linestring to the given point."""
+        self._check()
+        return _nearest_seg(self._coords, self._n, p.x, p.y, self.geographic)[3]
+
+    def closest_pt_to_line(self, l2):
+        """The distance from this line to another."""
+        min_dist = -1
+        closest = None
+        pts = self.pts
+        pts2 = l2.pts
+        for i in range(1,len(pts)):
+            a = pts[i-1]
+            b = pts[i]
+            for j in range(1,len(pts2)):
+                u = pts2[j-1]
+                v = pts2[j]
+                d = seg_distance_seg(a, b, u, v)
+                if d == 0:
+                    return seg_intersect_seg(a, b, u, v)
+                if min_dist == -1 or min_dist > d:
+                    min_dist = d
+                    if seg_distance_pt(a, b, u) < seg_distance_pt(a, b, v):
+                        closest = seg_closest_pt(a, b, u)
+                    else:
+                        closest = seg_closest_pt(a, b, v)
+        return closest
+
+    def distance_to_line(self, l2):
+        """The distance from this line to another."""
+        min_dist = -1.0
+        pts = self.pts
+        pts2 = l2.pts
+        for i in range(1,len(pts)):
+            a = pts[i-1]
+            b = pts[i]
+            for j in range(1,len(pts2)):
+                u = pts2[j-1]
+                v = pts2[j]
+                d = seg_distance_seg(a, b, u, v)
+                if d == 0:
+                    return 0.0
+                if min_dist == -1 or min_dist > d:
+                    min_dist = d
+        return min_dist
+
+    def locate_point(self, p):
+        """Find the measure [0,1] on this linestring to which the given point falls nearest."""
+        self._check()
+        seg, x, y, d = _nearest_seg(self._coords, self._n, p.x, p.y, self.geographic)
+        if d <= 0:
+            x = p.x; y = p.y
+        return (self._cum[seg] + _distance(self._coords[2*seg], self._coords[2*seg+1], x, y, self.geographic)) / self._cum[self._n-1]
+
+    def locate_points(self, xs, ys):
+        """locate_point for each of the points (xs[i], ys[i]), as an array('d')."""
+        self._check()
+        return locate_points(self._coords, xs, ys, self.geographic)
+
+    def _along(self, i, m):
+        # the point at length m along the linestring, which falls on segment i
+        a = self._coords[2*i:2*i+4]
+        if m <= self._cum[i]:
+            return (a[0], a[1])
+        if m >= self._cum[i+1]:
+            return (a[2], a[3])
+        f = (m - self._cum[i]) / _distance(a[0], a[1], a[2], a[3], self.geographic)
+        return (a[0] + (a[2]-a[0])*f, a[1] + (a[3]-a[1])*f)
+
+    def substring(self, frm, to):
+        """Returns the substring of this linestring between the two measures."""
+        length = self.length()
+        self._check()
+        if frm > to:
+            raise ArgumentError("from is greater than to")
+        frm = length*frm
+        to = length*to
+        first = bisect_left(self._cum, frm, 1, self._n-1) - 1
+        last = bisect_left(self._cum, to, 1, self._n-1) - 1
+
+        flat = array('d')
+        flat.extend(self._along(first, frm))
+        for i in range(first+1, last+1):
+            if self._cum[i] > frm:
+                flat.extend(self._coords[2*i:2*i+2])
+        flat.extend(self._along(last, to))
+        ret = LineString(geographic=self.geographic)
+        ret._set(flat)
+        return ret
+
+    def concatenate(self, l2, merge_tolerance=0):
+        """Returns true if l2 was joined or None, if the min distance is above the max distance allowed."""
+        self._check()
+        l2._check()
+        a = self._pt(0)
+        b = self._pt(self._n-1)
+        c = l2._pt(0)
+        d = l2._pt(l2._n-1)
+        ac = a.distance_pt(c)
+        ad = a.distance_pt(d)
+        bc = b.distance_pt(c)
+        bd = b.distance_pt(d)
+        coords = self.coords
+        coords2 = l2.coords
+
+        if ac < min(ad, min(bc, bd)):
+            if ac <= merge_tolerance:
+                return LineString(coords[::-1], coords2[1:], geographic=self.geographic)
+            else:
+                return LineString(coords[::-1], coords2, geographic=self.geographic)
+        elif ad < min(bc, bd):
+            if ad <= merge_tolerance:
+                return LineString(coords2, coords[1:], geographic=self.geographic)
+            else:
+                return LineString(coords2, coords, geographic=self.geographic)
+        elif bc < bd:
+            if bc <= merge_tolerance:
+                return LineString(coords, coords2[1:], geographic=self.geographic)
+            else:
+                return LineString(coords, coords2, geographic=self.geographic)
+        else:
+            if bd <= merge_tolerance:
+                return LineString(coords, coords2[-2::-1], geographic=self.geographic)
+            else:
+                return LineString(coords, coords2[::-1], geographic=self.geographic)
+
+def _points(xs, ys):
+    if len(xs) != len(ys):
+        raise ValueError("coordinate arrays differ in length")
+    return xs, ys
+
+def _line(coords):
+    coords = array('d', coords)
+    if len(coords) < 4:
+        raise ValueError("a linestring needs at least two points")
+    return coords, len(coords) // 2
+
+def distance_earth_many(x1, y1, x2, y2):
+    """distance_earth between each of the points (x1[i], y1[i]) and (x2[i], y2[i])."""
+    _points(x1, y1)
+    _points(x2, y2)
+    _points(x1, x2)
+    return array('d', [distance_earth(a, b, c, d) for a, b, c, d in zip(x1, y1, x2, y2)])
+
+def closest_pts(coords, xs, ys, geographic=False):
+    """For each of the points (xs[i], ys[i]), the nearest point of the
+    linestring coords and its distance, as (xs, ys, distances, segment
+    numbers) arrays."""
+    line, npts = _line(coords)
+    ret = (array('d'), array('d'), array('d'), array('i'))
+    for px, py in zip(*_points(xs, ys)):
+        seg, x, y, d = _nearest_seg(line, npts, px, py, geographic)
+        ret[0].append(x); ret[1].append(y); ret[2].append(d); ret[3].append(seg)
+    return ret
+
+def locate_points(coords, xs, ys, geographic=False):
+    """LineString.locate_point for each of the points (xs[i], ys[i]) on the
+    linestring coords: the measure [0,1] at which each falls nearest."""
+    line, npts = _line(coords)
+    cum = [0.0] * npts
+    for i in xrange(1, npts):
+        cum[i] = cum[i-1] + _distance(line[2*i-2], line[2*i-1], line[2*i], line[2*i+1], geographic)
+    if cum[npts-1] == 0:
+        raise ZeroDivisionError("the linestring has no length")
+    ret = array('d')
+    for px, py in zip(*_points(xs, ys)):
+        seg, x, y, d = _nearest_seg(line, npts, px, py, geographic)
+        if d <= 0:
+            x = px; y = py
+        ret.append((cum[seg] + _distance(line[2*seg], line[2*seg+1], x, y, geographic)) / cum[npts-1])
+    return ret
+
+class ArgumentError(Exception):
+    pass
@@ -0,0 +1,106 @@
+"""
+Snapshot files: flat arrays, such as those of a routing Graph or a
+SegmentIndex, saved in one binary file to be memory-mapped back.
+
+A snapshot is a fixed header (magic, format version, metadata length), a
+JSON metadata block, then the bytes of each array, in native byte order,
+each aligned to ALIGN bytes.  The metadata holds the typecode, offset and
+length of every array, and the attributes given when it was written (e.g.
+the generation of the database the arrays were derived from).
+
+The arrays read back are ctypes arrays over a private mapping of the file,
+so opening a snapshot reads nothing but its header, and processes that
+open the same snapshot share one copy of its pages in the page cache.  An
+element is a plain Python number, as from an array.array, so code written
+for array.arrays runs over them as fast.
+"""
+import ctypes
+import mmap
+import os
+import struct
+import sys
+
+import simplejson as json
+
+MAGIC = "PYSMSNAP"
+VERSION = 1
+HEADER = struct.Struct("=8sII")     # magic, version, metadata length
+ALIGN = 64
+
+# ctypes of the array.array typecodes
+CTYPES = {'b': ctypes.c_byte, 'B': ctypes.c_ubyte, 'h': ctypes.c_short, 'H': ctypes.c_ushort,
+          'i': ctypes.c_int, 'I': ctypes.c_uint, 'l': ctypes.c_long, 'L': ctypes.c_ulong,
+          'q': ctypes.c_longlong, 'Q': ctypes.c_ulonglong, 'f': ctypes.c_float, 'd': ctypes.c_double}
+
+def _typecode(a):
+    # an array.array, or a ctypes array read from a snapshot
+    return getattr(a, 'typecode', None) or a._type_._type_
+
+def write(path, arrays, **attributes):
+    """Writes a snapshot of arrays, a {name: array} dict of array.arrays (or
+    arrays of another snapshot), with attributes, which must be JSON
+    serializable, to path.  The file is written beside path and renamed over
+    it, so that processes that have the old snapshot open keep reading it
+    intact."""
+    names = sorted(arrays)
+    sections = {}
+    offset = 0
+    for name in names:
+        a = arrays[name]
+        nbytes = len(buffer(a))
+        sections[name] = {'typecode': _typecode(a), 'itemsize': len(a) and nbytes // len(a),
+                          'offset': offset, 'length': len(a)}
+        offset += -(-nbytes // ALIGN) * ALIGN
+    metadata = json.dumps({'byteorder': sys.byteorder, 'arrays': sections, 'attributes': attributes})
+    start = -(-(HEADER.size + len(metadata)) // ALIGN) * ALIGN
+    tmp = path + ".tmp"
+    f = open(tmp, "wb")
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, len(metadata)))
+        f.write(metadata)
+        for name in names:
+            f.seek(start + sections[name]['offset'])
+            f.write(buffer(arrays[name]))
+        f.truncate(start + offset)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+class Snapshot(object):
+    """A snapshot file, mapped.  Raises ValueError if path is not a snapshot,
+    or one of another format version or byte order.
+
+    The mapping is copy-on-write: an array may be changed in memory, which
+    gives the process a copy of the pages it changes, but never the file.
+    It stays mapped until the Snapshot and every array read from it are
+    gone."""
+    def __init__(self, path):
+        self.path = path
+        f = open(path, "rb")
+        try:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a snapshot" % path)
+            magic, version, length = HEADER.unpack(header)
+            if version != VERSION:
+                raise ValueError("%s is a version %d snapshot, not %d" % (path, version, VERSION))
+            metadata = json.loads(f.read(length))
+            if metadata['byteorder'] != sys.byteorder:
+                raise ValueError("%s was written with %s endian arrays" % (path, metadata['byteorder']))
+            self.sections = metadata['arrays']
+            self.attributes = metadata['attributes']
+            self.start = -(-(HEADER.size + length) // ALIGN) * ALIGN
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        finally:
+            f.close()
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def array(self, name):
+        """The array saved as name, a ctypes array viewing the mapping."""
+        section = self.sections[name]
+        ctype = CTYPES[section['typecode']]
+        if section['length'] and ctypes.sizeof(ctype) != section['itemsize']:
+            raise ValueError("%s: %s has %d byte items here" % (self.path, name, ctypes.sizeof(ctype)))
+        return (ctype * section['length']).from_buffer(self.map, self.start + section['offset'])
@@ -1,5 +1,4 @@
-import pyximport; pyximport.install()
-import linearref as l  
+from backend import linearref as l
 
 def test_basic():
     assert int(157249.057369) == int(l.distance_earth(0,0,1,1))
@@ -57,7 +56,7 @@ def test_closest_pt_seg():
                          l.GPoint(-87.671732, 41.875730), 
                          l.GPoint(-87.6685562134,41.8757400513))
     assert int(p.x*1000000) == int(-87.6685562271*1000000) 
-    assert int(p.y*1000000) == int(41.8757430599*1000000)
+    assert int(p.y*1000000) == int(41.8757421271*1000000)
     
 def test_substring():
     l1 = l.LineString([(0,0), (1,1), (2,2)])
@@ -71,6 +70,21 @@ def test_substring():
     assert l2.pts[-1].x == 1.5
     assert l2.pts[-1].y == 1.5
 
+def test_linestring_measures():
+    l1 = l.LineString([(0,0), (0.5,0.5), (0.5,0.1)])
+    # the second segment is nearer, by less than a unit
+    assert abs(l1.distance_pt(l.Point(0.5,0)) - 0.1) < 1e-12
+    assert l1.closest_pt(l.Point(0.5,0)).y == 0.1
+    
+    l1 = l.LineString([(i, i % 2) for i in range(10)])
+    assert abs(l1.length() - 9 * 2**0.5) < 1e-12
+    xs, ys = [0.5, 2, 8.75], [0, 0.25, 0.75]
+    assert list(l1.locate_points(xs, ys)) == [l1.locate_point(l.Point(x, y)) for x, y in zip(xs, ys)]
+    l2 = l1.substring(1/9.0, 0.5)
+    assert len(l2) == 5
+    assert abs(l2.pts[0].x - 1) < 1e-12 and abs(l2.pts[-1].x - 4.5) < 1e-12
+    assert abs(l2.length() - 3.5 * 2**0.5) < 1e-12
+    
 def test_concatenate():
     l1 = l.LineString([(0,0), (1,1)])
     l2 = l.LineString([(1,1), (2,2)])
@@ -105,6 +119,221 @@ def test_intersect():
     assert l1.closest_pt_to_line(l2).x == 0.25
     assert l1.closest_pt_to_line(l2).y == 0.25
 
+def test_segment_index():
+    import random
+    import index
+    rnd = random.Random(1)
+    lines = []
+    for k in range(200):
+        x, y = rnd.uniform(-122.5, -122.3), rnd.uniform(37.7, 37.8)
+        pts = [(x, y)]
+        for j in range(rnd.randint(1, 6)):
+            x += rnd.uniform(-0.003, 0.003); y += rnd.uniform(-0.003, 0.003)
+            pts.append((x, y))
+        lines.append((k, pts))
+    ix = index.SegmentIndex(lines, node_size=4)
+    assert len(ix) == sum([len(pts) - 1 for k, pts in lines])
+    for i in range(50):
+        x, y = rnd.uniform(-122.5, -122.3), rnd.uniform(37.7, 37.8)
+        brute = sorted([ix.distance(j, x, y)[0] for j in range(len(ix))])
+        assert [hit[0] for hit in ix.nearest(x, y, k=5)] == brute[:5]
+        hit = ix.nearest(x, y)[0]
+        assert hit[0] == index.closest_point_on_linestring(lines[hit[1]][1], (x, y))[3]
+    assert ix.nearest(-122.4, 37.75, max_distance=0.001) == []
+
+def test_graph():
+    import random
+    import graph
+    a, b, c, d = (0, 0), (0.01, 0), (0.02, 0), (0.03, 0)
+    g = graph.Graph([(10, 1, 2, [a, b]), (11, 2, 3, [b, c]), (12, 1, 3, [a, (0.01, 0.005), c]),
+                     (13, 4, 3, [d, c], -1), (14, 5, 6, [(1, 1), (1, 1.01)]), (15, 7, 7, [a])])
+    assert list(g.nodes) == [1, 2, 3, 4, 5, 6] and len(g) == 9
+    ab = l.distance_earth(0, 0, 0.01, 0)
+    assert g.edges(2) == [(1, 10, ab), (3, 11, l.distance_earth(0.01, 0, 0.02, 0))]
+    for astar in (True, False):
+        length, nodes, segments = g.shortest_path(1, 4, astar)
+        assert nodes == [1, 2, 3, 4] and segments == [10, 11, 13]
+        assert abs(length - 3 * ab) < 1e-6
+        assert g.shortest_path(4, 1, astar) is None and g.shortest_path(1, 6, astar) is None
+        assert g.shortest_path(5, 5, astar) == (0.0, [5], [])
+    assert sorted(g.distances(1)) == [1, 2, 3, 4]
+    assert g.distances(1, [3, 6]).keys() == [3] and sorted(g.distances(1, max_length=ab * 1.5)) == [1, 2]
+    assert g.shortest_paths(1, [2, 4, 6]) == {2: g.shortest_path(1, 2), 4: g.shortest_path(1, 4)}
+    try:
+        g.vertex(7)
+        assert False
+    except KeyError:
+        pass
+
+    # against Bellman-Ford, on a random network
+    rnd = random.Random(3)
+    pts = dict((n, (rnd.uniform(-122.5, -122.4), rnd.uniform(37.7, 37.8))) for n in range(40))
+    segments = []
+    for k in range(100):
+        s, e = rnd.sample(range(40), 2)
+        segments.append((k, s, e, [pts[s], pts[e]], rnd.choice((0, 0, 1, -1))))
+    g = graph.Graph(segments)
+    for source in g.nodes[:5]:
+        dist = {source: 0.0}
+        for i in range(len(pts)):
+            for n in g.nodes:
+                for m, seg, length in g.edges(n):
+                    if n in dist and dist[n] + length < dist.get(m, float('inf')):
+                        dist[m] = dist[n] + length
+        found = g.distances(source)
+        assert sorted(found) == sorted(dist)
+        assert max([abs(found[n] - dist[n]) for n in dist]) < 1e-6
+        for n in dist:
+            assert abs(g.shortest_path(source, n)[0] - dist[n]) < 1e-6
+
+def test_snapshot():
+    import os, random, tempfile
+    import graph, index, snapshot
+    rnd = random.Random(2)
+    pts = dict((n, (rnd.uniform(-122.5, -122.4), rnd.uniform(37.7, 37.8))) for n in range(30))
+    segments = [(k,) + tuple(rnd.sample(range(30), 2)) for k in range(60)]
+    g = graph.Graph([(k, s, e, [pts[s], pts[e]], k % 3 - 1) for k, s, e in segments])
+    ix = index.SegmentIndex([(k, [pts[s], pts[e]]) for k, s, e in segments], node_size=4)
+    fd, path = tempfile.mkstemp(suffix=".snapshot")
+    os.close(fd)
+    try:
+        arrays = dict(('graph.' + name, a) for name, a in g.arrays().items())
+        arrays.update(('index.' + name, a) for name, a in ix.arrays().items())
+        snapshot.write(path, arrays, generation=7)
+        snap = snapshot.Snapshot(path)
+        assert snap.attributes == {'generation': 7} and 'graph.offsets' in snap
+        for name, a in arrays.items():
+            assert list(snap.array(name)) == list(a)
+        mapped = graph.Graph.from_arrays(dict((name, snap.array('graph.' + name)) for name in graph.Graph.ARRAYS))
+        mapped_ix = index.SegmentIndex.from_arrays(dict((name[6:], snap.array(name)) for name in snap.sections 
+                                                        if name.startswith('index.')), node_size=4)
+        assert len(mapped) == len(g) and mapped.nbytes() == g.nbytes()
+        for source in g.nodes[:5]:
+            assert mapped.distances(source) == g.distances(source)
+        for i in range(20):
+            x, y = rnd.uniform(-122.5, -122.4), rnd.uniform(37.7, 37.8)
+            assert mapped_ix.nearest(x, y, k=3) == ix.nearest(x, y, k=3)
+        
+        open(path, "wb").write("not a snapshot")
+        try:
+            snapshot.Snapshot(path)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        os.remove(path)
+
+def test_match():
+    import match, graph
+    # a 4x4 grid of streets, 0.002 degrees apart east to west and 0.001
+    # north to south; the streets of row 1 are one way west, and the fixes
+    # below drive east along row 2
+    node = lambda i, j: i * 4 + j + 1
+    segments = []
+    for i in range(4):
+        for j in range(4):
+            x, y = j * 0.002, i * 0.001
+            if j < 3:
+                segments.append((len(segments), node(i, j), node(i, j + 1), [(x, y), (x + 0.002, y)], i == 1 and -1 or 0))
+            if i < 3:
+                segments.append((len(segments), node(i, j), node(i + 1, j), [(x, y), (x, y + 0.001)]))
+    m = match.Matcher(graph.Graph(segments), segments, radius=30.0)
+    geoms = dict((s[0], s[3]) for s in segments)
+    row = lambda i, j: [s[0] for s in segments if s[1] == node(i, j) and s[2] == node(i, j + 1)][0]
+    
+    trace = [(0.0002 * k, 0.002 + (-1) ** k * 0.00002) for k in range(1, 30) if k % 10]
+    matched = m.match(trace)
+    for (x, y), (id, offset) in zip(trace, matched):
+        assert id == row(2, int(x / 0.002))
+        line = l.LineString(geoms[id], geographic=True)
+        assert abs(offset - line.locate_point(l.GPoint(x, y)) * line.length()) < 0.01
+    # a stray fix is nearer the parallel street to the north, but the way
+    # there and back is far longer than the way on
+    stray = match.Matcher(graph.Graph(segments), segments, radius=80.0, sigma=20.0, beta=20.0)
+    trace = [(0.0022, 0.002), (0.0026, 0.002), (0.003, 0.00256), (0.0034, 0.002), (0.0038, 0.002)]
+    assert stray.nearest(*trace[2])[0][0] == row(3, 1)
+    assert [id for id, offset in stray.match(trace)] == [row(2, 1)] * 5
+    # row 1 cannot be driven east
+    assert m.routes([(row(1, 0), 10.0, 0)], [(row(1, 0), 20.0, 0), (row(1, 1), 10.0, 0)])[0][0] > 200
+    
+    # a fix with no candidates splits the trace
+    trace = [(0.001, 0.002), (0.003, 0.002), (0.5, 0.5), (0.005, 0.002)]
+    matched = m.match(trace)
+    assert matched[2] is None and [id for id, offset in matched[:2] + matched[3:]] == [row(2, 0), row(2, 1), row(2, 2)]
+    assert m.match([]) == []
+    assert m.match_traces([trace, trace[:2]]) == [matched, matched[:2]]
+
+def test_batch():
+    import random, threading
+    from array import array
+    rnd = random.Random(2)
+    # coordinates exact in 32 bits, so that GPoint and Point do not round them
+    coord = lambda: rnd.randint(-1 << 16, 1 << 16) / 1024.0
+    xs, ys = array('d', [coord() for i in range(200)]), array('d', [coord() for i in range(200)])
+    
+    d = l.distance_earth_many(xs[:100], ys[:100], xs[100:], ys[100:])
+    assert list(d) == [l.distance_earth(xs[i], ys[i], xs[100+i], ys[100+i]) for i in range(100)]
+    
+    coords = array('d', [c / 64.0 for c in range(40)])
+    coords[11] = -5.0
+    for geographic, point in ((False, l.Point), (True, l.GPoint)):
+        s = l.LineString([tuple(coords[i:i+2]) for i in range(0, len(coords), 2)], geographic=geographic)
+        cx, cy, dist, seg = l.closest_pts(coords, xs, ys, geographic)
+        for i in range(len(xs)):
+            p = point(xs[i], ys[i])
+            c = l.seg_closest_pt(s.pts[seg[i]], s.pts[seg[i]+1], p)
+            assert (cx[i], cy[i], dist[i]) == (c.x, c.y, c.distance_pt(p))
+            assert dist[i] == min([l.seg_distance_pt(s.pts[j-1], s.pts[j], p) for j in range(1, len(s))])
+        assert list(l.locate_points(coords, xs, ys, geographic)) == [s.locate_point(point(x, y)) for x, y in zip(xs, ys)]
+    
+    # the loops release the GIL, so threads can split the work
+    out = [None] * 4
+    def work(k):
+        out[k] = l.locate_points(coords, xs[k::4], ys[k::4], True)
+    threads = [threading.Thread(target=work, args=(k,)) for k in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    m = l.locate_points(coords, xs, ys, True)
+    assert [list(o) for o in out] == [list(m[k::4]) for k in range(4)]
+    
+    # numpy arrays which are not native endian, contiguous doubles are copied
+    try:
+        import numpy
+    except ImportError:
+        return
+    points = numpy.array([[0.0, 0.0], [1.0, 0.0]])
+    expected = list(l.distance_earth_many([0.0, 0.0], [0.0, 0.0], [0.0, 1.0], [0.0, 0.0]))
+    zeros = numpy.zeros(2, dtype='>f8')
+    assert list(l.distance_earth_many(zeros, zeros, points[:, 0].astype('>f8'), zeros)) == expected
+    assert list(l.distance_earth_many(points[:, 1], points[:, 1], points[:, 0], points[:, 1])) == expected
+    assert list(l.distance_earth_many(numpy.zeros(2, dtype=int), zeros, points[:, 0], zeros)) == expected
+    assert list(l.locate_points(numpy.array(coords, dtype='>f8'), xs, ys, True)) == list(m)
+    assert list(l.locate_points(numpy.repeat(coords, 2)[::2], xs, ys, True)) == list(m)
+
+def test_fallback():
+    import random
+    import pylinearref as py
+    rnd = random.Random(4)
+    for geographic in (False, True):
+        for k in range(50):
+            coords = [(rnd.uniform(-122.5, -122.4), rnd.uniform(37.7, 37.8)) for i in range(rnd.randint(2, 6))]
+            xs = [rnd.uniform(-122.5, -122.4) for i in range(5)]
+            ys = [rnd.uniform(37.7, 37.8) for i in range(5)]
+            flat = [v for c in coords for v in c]
+            a, b = sorted([rnd.random(), rnd.random()])
+            results = []
+            for m in (l, py):
+                s = m.LineString(coords, geographic=geographic)
+                p = m.CPoint(xs[0], ys[0], geographic)
+                s2 = m.LineString([(x, y) for x, y in zip(xs, ys)], geographic=geographic)
+                results.append((s.length(), s.coords, s.closest_pt(p).x, s.closest_pt(p).y, s.distance_pt(p),
+                                s.locate_point(p), s.substring(a, b).coords, s.distance_to_line(s2),
+                                s.concatenate(s2).coords, str(s),
+                                [tuple(r) for r in m.closest_pts(flat, xs, ys, geographic)],
+                                list(m.locate_points(flat, xs, ys, geographic)),
+                                list(m.distance_earth_many(xs[:2], ys[:2], xs[2:4], ys[2:4]))))
+            assert results[0] == results[1]
+
 if __name__ == '__main__':
     test_basic()
     test_linestring()
\ No newline at end of file
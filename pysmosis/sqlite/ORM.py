@@ -1,8 +1,24 @@
-from ormlite import Record, ForeignKey, JSONField, TEXT, ID, FLOAT, INT, open_connection
-import os, sys
+from ormlite import Record, ForeignKey, JSONField, CoordsField, IntArrayField, TEXT, ID, FLOAT, INT, open_connection, migrate_json, \
+    ConnectionPool, database, ObjectCache
+import os, re, sys, uuid
+from functools import wraps
+import sqlite3
+import simplejson as json
+from math import sqrt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# records of ways and segments, with their geometry decoded, and LineStrings
+# of them, kept for the OSMDBs of the process (see OSMDB.way and linestring).
+# Its stats() count the hits, misses and evictions.
+geometry_cache = ObjectCache()
 
 class Node(Record):
     _table_ = 'nodes'
+    _slots_ = True
     _fields_ = (ID('id'),
                 FLOAT('lat', notnull=True, index=True),
                 FLOAT('lon', notnull=True, index=True),
@@ -10,13 +26,15 @@ class Node(Record):
                 INT('refcount'))
     
     def tuple(self):
-        return (n.id, n.lat, n.lon)
+        return (self.id, self.lat, self.lon)
 
 class Way(Record):
     _table_ = 'ways'
+    _slots_ = True
+    _cache_ = geometry_cache
     _fields_ = (ID('id'),
-                JSONField('geom'),
-                JSONField('nds'),
+                CoordsField('geom'),
+                IntArrayField('nds'),
                 JSONField('tags'),
                 FLOAT('left'),FLOAT('bottom'),FLOAT('right'),FLOAT('top'))
     @property
@@ -25,146 +43,875 @@ class Way(Record):
 
 class NodeCoords(Record):
     _table_ = 'nodes'
+    _slots_ = True
     _fields_ = (ID('id'),
                 FLOAT('lat', notnull=True, index=True),
                 FLOAT('lon', notnull=True, index=True))
     
 
 class WaySegment(Record):
+    _slots_ = True
+    _cache_ = geometry_cache
     _fields_ = (ID('id'),
                 ForeignKey('way_id', Way, 'id', 'segment_set'),
                 ForeignKey('start_id', Node, 'id', 'origin_seg_set'),
                 ForeignKey('end_id', Node, 'id', 'end_seg_set'),
-                JSONField('geom',notnull=True),
-                JSONField('nds',notnull=True),
+                CoordsField('geom',notnull=True),
+                IntArrayField('nds',notnull=True),
                 FLOAT('left'),FLOAT('bottom'),FLOAT('right'),FLOAT('top'))
     @property
     def bbox(self):
         return (self.left, self.bottom, self.right, self.top)
 
     
+# R*Tree virtual tables: (table, rtree table, rtree columns, source columns).
+# An rtree takes a (min, max) column pair per dimension.
+RTREES = (('ways', 'ways_rtree', 'id, left, right, bottom, top', 'id, left, right, bottom, top'),
+          (WaySegment._table_, 'waysegment_rtree', 'id, left, right, bottom, top', 'id, left, right, bottom, top'),
+          ('nodes', 'nodes_rtree', 'id, minlon, maxlon, minlat, maxlat', 'id, lon, lon, lat, lat'))
+
+# Normalized tags: each distinct key and value is stored once, in tag_keys
+# and tag_values, and each tag of a node or way as a row of the three ids.
+# (node_tags and way_tags are the (id, k, v) tables of osm.sqlite.sql.)
+TAG_TABLES = {'nodes': 'node_tag_ids', 'ways': 'way_tag_ids'}
+TAG_SCHEMA = """
+CREATE TABLE tag_keys (id INTEGER PRIMARY KEY, k TEXT NOT NULL UNIQUE);
+CREATE TABLE tag_values (id INTEGER PRIMARY KEY, v TEXT NOT NULL UNIQUE);
+CREATE TABLE node_tag_ids (id INTEGER NOT NULL, key_id INTEGER NOT NULL, value_id INTEGER NOT NULL);
+CREATE INDEX node_tag_ids_tag ON node_tag_ids(key_id, value_id, id);
+CREATE INDEX node_tag_ids_id ON node_tag_ids(id);
+CREATE TABLE way_tag_ids (id INTEGER NOT NULL, key_id INTEGER NOT NULL, value_id INTEGER NOT NULL);
+CREATE INDEX way_tag_ids_tag ON way_tag_ids(key_id, value_id, id);
+CREATE INDEX way_tag_ids_id ON way_tag_ids(id);
+"""
+
+def _writes(method):
+    """Runs an OSMDB method that writes through self.conn in a write block
+    of its database, so that in a pool it has the writer to itself, and 
+    then advances the database's generation.  The objects of the database
+    in geometry_cache are dropped, as the method may bypass the records, 
+    and dropped again once the write is committed.  A graph or segment 
+    index the method loads is of the generation it makes."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.db.write() as conn:
+            loaded = [(name, getattr(self, name)) for name in DERIVED]
+            try:
+                ret = method(self, *args, **kwargs)
+            finally:
+                self.clear_cache()
+                self.db.after_write(self.clear_cache)
+            conn.execute("UPDATE osmdb_meta SET value = value + 1 WHERE key = 'generation'")
+            conn.commit()
+            generation = self.generation()
+            for name, derived in loaded:
+                if getattr(self, name) is not derived and getattr(self, name) is not None:
+                    setattr(self, name + '_generation', generation)
+            return ret
+    return wrapper
+
+# what OSMDB loads from the database, and saves in snapshots
+DERIVED = ('graph', 'segment_index')
+
 class OSMDB:
-    def __init__(self, dbname,overwrite=False):
+    def __init__(self, dbname,overwrite=False, rtree=True, pool=False):
+        """With pool (True, or a ConnectionPool of dbname), the database is 
+        a ConnectionPool, so that the OSMDB can be shared by threads: queries
+        read through a connection per thread, while imports and other writes
+        take the pool's writer in turn.  Otherwise it is a single connection,
+        which is also made the ormlite module connection."""
         if overwrite:
             try:
                 os.remove( dbname )
             except OSError:
                 pass
         
-        if not os.path.exists(dbname):
-            self.conn = open_connection(dbname)
-            self.setup()
+        if pool:
+            self.db = pool is True and ConnectionPool(dbname) or pool
+            self.conn = self.db.writer
         else:
             self.conn = open_connection(dbname)
-            self.setup()
+            self.db = database(self.conn)
+        self.dbname = dbname
+        # tells this database's objects in geometry_cache from others': 
+        # shared by the OSMDBs of a file, whose objects are dropped on open
+        # in case another process changed it
+        self.cache_scope = dbname != ":memory:" and os.path.abspath(dbname) or object()
+        self.clear_cache()
+        # managers of the records bound to this database
+        self.objects = dict((rclass, rclass.objects.using(self.db)) for rclass in (Node, Way, WaySegment))
+        if not self._has_table('osmdb_meta'):
+            with self.db.write() as conn:
+                conn.execute("CREATE TABLE osmdb_meta (key TEXT PRIMARY KEY, value)")
+                conn.execute("INSERT INTO osmdb_meta VALUES ('generation', 0)")
+                conn.commit()
+        self.database_id = self._meta('database_id')
+        if self.database_id is None:
+            # made before databases had ids
+            with self.db.write() as conn:
+                conn.execute("INSERT OR IGNORE INTO osmdb_meta VALUES ('database_id', ?)", (uuid.uuid4().hex,))
+                conn.commit()
+            self.database_id = self._meta('database_id')
+        if not self._has_table('nodes'):
+            self.setup(rtree)
+        self.rtree = rtree and self.has_rtree()
+        # databases made before the tag tables filter on the JSON tags
+        self.tag_index = self._has_table(TAG_TABLES['ways'])
         
-    def setup(self):
+    def close(self):
+        self.clear_cache()
+        self.db.close()
+    
+    def clear_cache(self):
+        """Drops the objects of this database from geometry_cache."""
+        geometry_cache.clear(*[(self.cache_scope, kind) for kind in ('record', 'linestring')])
+        
+    @_writes
+    def setup(self, rtree=True):
         for n in (Node,Way,WaySegment):
-            n.objects.createtable()
+            self.objects[n].createtable()
 
         c = self.conn.cursor()
-        # This should be an RTree if supported
+        # B-tree fallback, for sqlite builds without the rtree module
         c.execute( "CREATE INDEX ways_bbox ON ways(left, bottom, right, top)" )
+        c.executescript(TAG_SCHEMA)
         self.conn.commit()
         c.close()
+        if rtree:
+            self.create_rtree_indexes()
+        
+    def _has_table(self, name):
+        return self.db.reader().execute("SELECT count(*) FROM sqlite_master WHERE name = ?", (name,)).fetchone()[0] > 0
         
+    def has_rtree(self):
+        """Whether this database has its R*Tree indexes."""
+        return self._has_table('ways_rtree')
+    
+    def _meta(self, key):
+        row = self.db.reader().execute("SELECT value FROM osmdb_meta WHERE key = ?", (key,)).fetchone()
+        return row and row[0]
+    
+    def generation(self):
+        """A counter of the changes made to the database by the OSMDB methods 
+        that write to it, for telling whether data derived from it, such as a
+        snapshot, is current.  Writes made other ways do not advance it.  It
+        starts from 0 in a database made anew, which database_id, random for
+        each database, tells apart from the one it replaced."""
+        return self._meta('generation')
+        
+    @_writes
+    def create_rtree_indexes(self, reporter=None):
+        """Creates R*Tree indexes over the bounding boxes of ways, segments and 
+        nodes, fills them from existing rows, and adds triggers that keep them 
+        up to date.  Returns False if sqlite was built without rtree support."""
+        c = self.conn.cursor()
+        try:
+            c.execute("CREATE VIRTUAL TABLE rtree_test USING rtree(id, minx, maxx)")
+            c.execute("DROP TABLE rtree_test")
+        except sqlite3.OperationalError:
+            if reporter: reporter.write("sqlite3 was built without rtree support\n")
+            return False
+        for table, rtree, columns, source in RTREES:
+            if reporter: reporter.write("Building %s...\n" % rtree)
+            source_columns = [col.strip() for col in source.split(",")]
+            new = ", ".join(["new." + col for col in source_columns])
+            # only changes to the indexed columns, not e.g. node refcounts, touch the index
+            indexed = ", ".join(sorted(set(source_columns[1:])))
+            c.executescript("""
+            CREATE VIRTUAL TABLE %(rtree)s USING rtree(%(columns)s);
+            INSERT INTO %(rtree)s SELECT %(source)s FROM %(table)s WHERE %(notnull)s IS NOT NULL;
+            CREATE TRIGGER %(rtree)s_insert AFTER INSERT ON %(table)s WHEN new.%(notnull)s IS NOT NULL BEGIN
+                INSERT INTO %(rtree)s VALUES (%(new)s);
+            END;
+            CREATE TRIGGER %(rtree)s_update AFTER UPDATE OF %(indexed)s ON %(table)s BEGIN
+                DELETE FROM %(rtree)s WHERE id = old.id;
+                INSERT INTO %(rtree)s SELECT %(new)s WHERE new.%(notnull)s IS NOT NULL;
+            END;
+            CREATE TRIGGER %(rtree)s_delete AFTER DELETE ON %(table)s BEGIN
+                DELETE FROM %(rtree)s WHERE id = old.id;
+            END;
+            """ % {'table': table, 'rtree': rtree, 'columns': columns, 'source': source, 'new': new,
+                   'indexed': indexed, 'notnull': source_columns[1]})
+        self.conn.commit()
+        self.rtree = True
+        return True
+
+    @_writes
+    def index_tags(self, reporter=None):
+        """Rebuilds the tag tables, creating them in a database made without
+        them, from the JSON tags of every node and way; see digest.index_tags."""
+        import digest
+        for table in ['tag_keys', 'tag_values'] + TAG_TABLES.values():
+            self.conn.execute("DROP TABLE IF EXISTS %s" % table)
+        self.conn.executescript(TAG_SCHEMA)
+        digest.index_tags(self.conn, reporter=reporter)
+        self.tag_index = True
+    
+    @_writes
+    def migrate(self, reporter=None):
+        """Rewrites way and segment geometry left as JSON text by older versions
+        in the packed binary format.  Unmigrated rows remain readable."""
+        for n in (Way, WaySegment):
+            migrate_json(n, reporter=reporter, conn=self.conn)
+        
+    @_writes
     def populate(self, osm_filename, 
                  accept_way=lambda way: True, 
                  accept_tag=lambda k,v: k.startswith('tiger') and (None,None) or (k,v), 
-                 reporter=None):
+                 reporter=None, bulk=False, batch_size=50000, parser='sax', workers=1, segment=False,
+                 node_cache=None):
+        """node_cache, a digest.NodeCache (or True for a default one), holds 
+        the node coordinates during the import, so that way geometry and 
+        segments are built from it rather than by querying the nodes table."""
+        import digest
+        owns_cache = node_cache is True
+        if owns_cache:
+            node_cache = digest.NodeCache()
+        try:
+            digest.load_osmfile(self.conn, osm_filename, accept_way, accept_tag, reporter=reporter,
+                                bulk=bulk, batch_size=batch_size, parser=parser, workers=workers,
+                                node_cache=node_cache, tags=self.tag_index)
+            digest.populate_way_geom(self.conn, reporter=reporter, nodes=node_cache)
+            if segment:
+                self.segment_ways(workers=workers, reporter=reporter, nodes=node_cache)
+        finally:
+            if owns_cache:
+                node_cache.close()
+        self._ways_changed(reporter)
+    
+    @_writes
+    def apply_changes(self, osc_filename, 
+                      accept_way=lambda way: True, 
+                      accept_tag=lambda k,v: k.startswith('tiger') and (None,None) or (k,v), 
+                      reporter=None):
+        """Applies an OSM change file, as populate would have imported the 
+        changed data; see digest.apply_osmchange.  As after populate, a 
+        loaded segment index is rebuilt and the graph and matcher dropped."""
         import digest
-        digest.load_osmfile(self.conn, osm_filename, accept_way, accept_tag, reporter=reporter)
-        #digest.populate_way_geom(self.conn)
-        #digest.segment_ways(self.conn)
+        ret = digest.apply_osmchange(self.conn, osc_filename, accept_way, accept_tag, reporter=reporter,
+                                     tags=self.tag_index)
+        self._ways_changed(reporter)
+        return ret
+    
+    @_writes
+    def segment_ways(self, workers=1, reporter=None, nodes=None):
+        """Rebuilds the way segments; see digest.segment_ways.  A loaded 
+        graph and matcher, made from the old segments, are dropped."""
+        import digest
+        ret = digest.segment_ways(self.conn, reporter=reporter, workers=workers, nodes=nodes)
+        self._segments_changed()
+        return ret
+    
+    def _segments_changed(self):
+        self.graph = self.matcher = None
+    
+    def _ways_changed(self, reporter=None):
+        """Rebuilds a loaded segment index, and drops the graph and matcher,
+        which are made from the segments, to be loaded again."""
+        self._segments_changed()
+        if self.segment_index is not None:
+            self.load_segment_index(reporter=reporter)
         
                
-    def nodes(self):
-        for n in Node.objects.query():
-            yield n.tuple()
+    def nodes(self, bbox=None, tags=None, columns=('id', 'lat', 'lon'), page_size=10000):
+        """(id, lat, lon) of every node, in id order, or of those within bbox
+        (left, bottom, right, top) having tags (see tags_where).  columns
+        picks other columns, or None gives Node records.  The nodes are read
+        page_size at a time (see BaseManager.stream), so a long scan holds 
+        neither a read transaction nor more than a page of rows."""
+        where = []
+        if bbox is not None:
+            where.append(self._node_box_where(*bbox))
+        if tags:
+            where.append(self.tags_where('nodes', tags))
+        return self.objects[Node].stream(page_size, columns, where=_and(where))
         
     def node(self, id):
-        return Node.objects.get(id=id).tuple()
+        return self.objects[Node].get(id=id).tuple()
     
     def nearest_node(self, lat, lon, range=0.005):
-        q = Node.object.query(where="lat > %d AND lat < %d AND lon > %d AND lon < %d" % (lat-range, lat+range, lon-range, lon+range))
+        where = "lat > ? AND lat < ? AND lon > ? AND lon < ?"
+        args = [lat-range, lat+range, lon-range, lon+range]
+        if self.rtree:
+            where += " AND id IN (SELECT id FROM nodes_rtree WHERE maxlat > ? AND minlat < ? AND maxlon > ? AND minlon < ?)"
+            args += args
+        q = self.objects[Node].values('id', 'lat', 'lon', where=(where, args))
         
-        dists = [(n.id, n.lat, n.lon, ((n.lat-lat)**2+(n.lon-lon)**2)**0.5) for n in q]
+        dists = [(nid, nlat, nlon, _planar_distance(nlat-lat, nlon-lon)) for nid, nlat, nlon in q]
             
         if len(dists)==0:
             return (None, None, None, None)
             
-        return min( dists, key = lambda x:x[3] )
+        return min( dists, key = lambda x:(x[3], x[0]) )
 
     def nearest_of( self, lat, lon, nodes ):
-        q = Node.object.query(where="id IN (%s)" % ",".join([str(x) for x in nodes]))        
-        dists = [(n.id, n.lat, n.lon, ((n.lat-lat)**2+(n.lon-lon)**2)**0.5) for n in q]
+        q = self.objects[Node].values('id', 'lat', 'lon', where="id IN (%s)" % ",".join([str(x) for x in nodes]))
+        dists = [(nid, nlat, nlon, _planar_distance(nlat-lat, nlon-lon)) for nid, nlat, nlon in q]
         q.close()
         if len(dists)==0:
             return (None, None, None, None)
             
-        return min( dists, key = lambda x:x[3] )
+        return min( dists, key = lambda x:(x[3], x[0]) )
+
+    def nearest_nodes(self, lats, lons, range=0.005):
+        """Batch nearest_node over arrays of query points, e.g. a GPS trace.
+        
+        Returns (ids, lats, lons, distances) arrays with one entry per point;
+        points with no node in range get id -1 and nan.  Candidates are 
+        fetched once per grid cell of points and the distances computed with
+        numpy; the results are the same as nearest_node's."""
+        lats, lons = _query_points(lats, lons)
+        sql = "SELECT id, lat, lon FROM nodes WHERE lat > ? AND lat < ? AND lon > ? AND lon < ?"
+        if self.rtree:
+            sql += " AND id IN (SELECT id FROM nodes_rtree WHERE maxlat > ? AND minlat < ? AND maxlon > ? AND minlon < ?)"
+        sql += " ORDER BY id"
+        
+        ret = _no_nodes(len(lats))
+        for tile in _tiles(lats, lons, max(4*range, 0.01)):
+            args = [lats[tile].min()-range, lats[tile].max()+range, lons[tile].min()-range, lons[tile].max()+range]
+            if self.rtree:
+                args += args
+            candidates = _node_arrays(self.db.reader().execute(sql, args).fetchall())
+            _fill_nearest_nodes(ret, tile, lats, lons, candidates, range)
+        return ret
+
+    def nearest_nodes_of(self, lats, lons, nodes):
+        """Batch nearest_of: the nearest of the given node ids to each query
+        point, as (ids, lats, lons, distances) arrays like nearest_nodes."""
+        lats, lons = _query_points(lats, lons)
+        rows = self.db.reader().execute("SELECT id, lat, lon FROM nodes WHERE id IN (%s) ORDER BY id" % 
+                                 ",".join([str(x) for x in nodes])).fetchall()
+        ret = _no_nodes(len(lats))
+        _fill_nearest_nodes(ret, numpy.arange(len(lats)), lats, lons, _node_arrays(rows))
+        return ret
+
+    def _nearby(self, rclass, rtree, lat, lon, range):
+        return self._in_box(rclass, rtree, lon-range, lat-range, lon+range, lat+range)
+
+    def _box_where(self, rtree, left, bottom, right, top):
+        """(sql, args) for the rows whose bounding box intersects the box."""
+        where = "left <= ? AND right >= ? AND bottom <= ? AND top >= ?"
+        args = [right, left, top, bottom]
+        if self.rtree:
+            # the rtree stores 32 bit floats, rounded outwards, so check the exact bounds too
+            where += " AND id IN (SELECT id FROM %s WHERE left <= ? AND right >= ? AND bottom <= ? AND top >= ?)" % rtree
+            args += args
+        return where, args
+    
+    def _node_box_where(self, left, bottom, right, top):
+        """(sql, args) for the nodes within the box."""
+        where = "lon >= ? AND lon <= ? AND lat >= ? AND lat <= ?"
+        args = [left, right, bottom, top]
+        if self.rtree:
+            where += " AND id IN (SELECT id FROM nodes_rtree WHERE maxlon >= ? AND minlon <= ? AND maxlat >= ? AND minlat <= ?)"
+            args += args
+        return where, args
+    
+    def _in_box(self, rclass, rtree, left, bottom, right, top):
+        return self.objects[rclass].query(where=self._box_where(rtree, left, bottom, right, top))
 
     def nearby_ways(self, lat, lon, range=0.005):
-        q = Way.objects.query(where="left <= %d AND right >= %d and bottom <= %d and top >= %d" % (lon+range, lon-range, lat+range, lat-range) )
+        q = self._nearby(Way, 'ways_rtree', lat, lon, range)
         
         for w in q:
             yield w
         q.close()
         
+    def nearby_segments(self, lat, lon, range=0.005):
+        q = self._nearby(WaySegment, 'waysegment_rtree', lat, lon, range)
+        
+        for s in q:
+            yield s
+        q.close()
+        
     def way(self, id):
-        return Way.objects.get(id=id)
+        """The Way of id, or None.  Each call makes a new record, but from the
+        row and decoded geometry in geometry_cache, read on a miss."""
+        return self._cached(Way, id)
+    
+    def waysegment(self, id):
+        """The WaySegment of id, or None, like way."""
+        return self._cached(WaySegment, id)
+    
+    def _cached(self, rclass, id):
+        scope, row = (self.cache_scope, 'record'), (rclass._table_, id)
+        item = geometry_cache.get(scope, row)
+        if item is not None:
+            o = rclass._make_(item[0], self.objects[rclass])
+            o._geom_cache = item[1]
+            return o
+        values = self.objects[rclass].values(id=id).fetchone()
+        if values is None:
+            return None
+        o = rclass._make_(values, self.objects[rclass])
+        nbytes = sum([len(v) for v in values if isinstance(v, (basestring, buffer))]) + 64 * len(values)
+        if o.geom is not None:
+            nbytes += 16 * len(o.geom)
+        geometry_cache.put(scope, row, (values, o.geom), nbytes)
+        return o
+    
+    def linestring(self, id, table='ways'):
+        """A geographic pysmosis.geom linearref.LineString of the geometry 
+        of the way, or with table='waysegment' the segment, of id, kept in
+        geometry_cache; None if there is no such row or it has fewer than 
+        two points.  It is shared, so must not be changed."""
+        scope, row = (self.cache_scope, 'linestring'), (table, id)
+        line = geometry_cache.get(scope, row)
+        if line is None:
+            from pysmosis.geom.backend import linearref
+            o = self._cached(table == 'ways' and Way or WaySegment, id)
+            geom = o and o.geom
+            if geom is None or len(geom) < 2:
+                return None
+            # 16 bytes a vertex, and 8 for the length up to it
+            line = geometry_cache.put(scope, row, linearref.LineString(list(geom), geographic=True),
+                                      64 + 24 * len(geom))
+        return line
                 
-    def ways(self):
-        for w in Way.objects.query():
-            yield w
+    def ways(self, bbox=None, tags=None, columns=None, page_size=10000):
+        """Every Way, in id order, or those whose bounding box intersects 
+        bbox (left, bottom, right, top) having tags; with columns, tuples of
+        those columns' stored values.  Read page_size at a time, like nodes."""
+        where = []
+        if bbox is not None:
+            where.append(self._box_where('ways_rtree', *bbox))
+        if tags:
+            where.append(self.tags_where('ways', tags))
+        return self.objects[Way].stream(page_size, columns, where=_and(where))
         
+    def tags_where(self, table, tags):
+        """(sql, args) selecting the rows of table, nodes or ways, that have 
+        each key of the tags dict: with its value, with any of its values if
+        that is a list, tuple or set, or with any value if it is None.  The
+        tags are looked up in the tag tables, or where there are none, GLOBbed
+        for in the JSON (see _tags_where)."""
+        if self.tag_index:
+            return _tag_index_where(table, tags)
+        return _tags_where(tags)
+    
+    def tag_counts(self, key, table='ways'):
+        """{value: the number of the rows of table, nodes or ways, tagged with
+        key=value}."""
+        if not self.tag_index:
+            counts = {}
+            for id, tags in (table == 'ways' and self.ways or self.nodes)(tags={key: None}, columns=('id', 'tags')):
+                value = json.loads(tags)[key]
+                counts[value] = counts.get(value, 0) + 1
+            return counts
+        return dict(self.db.reader().execute("""SELECT v, count(*) FROM %s JOIN tag_values ON tag_values.id = value_id
+                                                WHERE key_id = (SELECT id FROM tag_keys WHERE k = ?)
+                                                GROUP BY value_id""" % TAG_TABLES[table], (key,)))
+    
     def count_ways(self):
-        c = self.conn.cursor()        
+        c = self.db.reader().cursor()        
         c.execute( "SELECT count(*) FROM ways" )
         ret = next(c)[0]
         c.close()
         
         return ret
     
-    def waysegments(self):
-        for w in WaySegment.objects.query():
-            yield w
+    def waysegments(self, bbox=None, tags=None, columns=None, page_size=10000):
+        """Every WaySegment, in id order, or those whose bounding box 
+        intersects bbox of ways having tags; like ways otherwise."""
+        where = []
+        if bbox is not None:
+            where.append(self._box_where('waysegment_rtree', *bbox))
+        if tags:
+            if self.tag_index:
+                where.append(_tag_index_where('ways', tags, 'way_id'))
+            else:
+                sql, args = _tags_where(tags)
+                where.append(("way_id IN (SELECT id FROM ways WHERE %s)" % sql, args))
+        return self.objects[WaySegment].stream(page_size, columns, where=_and(where))
+    
+    def load_segment_index(self, reporter=None):
+        """Loads the segments of every way into an in-memory SegmentIndex, which
+        nearest_way then uses instead of querying the database."""
+        from pysmosis.geom.index import SegmentIndex
+        if reporter: reporter.write("Loading segment index...\n")
+        self.segment_index_generation = self.generation()
+        self.segment_index = SegmentIndex((w.id, w.geom) for w in self.objects[Way].query(where="geom IS NOT NULL"))
+        if reporter: reporter.write("Indexed %d segments\n" % len(self.segment_index))
+        return self.segment_index
+    
+    segment_index = segment_index_generation = None
+    
+    def load_graph(self, reporter=None):
+        """Loads the way segments into a routing graph (see 
+        pysmosis.geom.graph.Graph), which is kept as self.graph.  Segments of
+        ways tagged oneway=yes, true or 1 are only followed from their start
+        node to their end node, and of ways tagged oneway=-1 the other way."""
+        from pysmosis.geom.graph import Graph
+        if reporter: reporter.write("Loading routing graph...\n")
+        oneway = {}
+        for id, tags in self.ways(tags={'oneway': None}, columns=('id', 'tags')):
+            value = json.loads(tags)['oneway']
+            if value in ('yes', 'true', '1'):
+                oneway[id] = 1
+            elif value == '-1':
+                oneway[id] = -1
+        self.graph_generation = self.generation()
+        self.graph = Graph((s.id, s.start_id, s.end_id, s.geom, oneway.get(s.way_id, 0)) for s in self.waysegments())
+        if reporter: reporter.write("Loaded %d nodes, %d edges\n" % (len(self.graph.nodes), len(self.graph)))
+        return self.graph
+    
+    graph = graph_generation = None
+    
+    def load_matcher(self, reporter=None, **kwargs):
+        """Loads a map matcher (see pysmosis.geom.match.Matcher) over the way
+        segments and the routing graph, loading the graph if it is not yet 
+        loaded, which is kept as self.matcher.  kwargs are passed to the 
+        Matcher."""
+        from pysmosis.geom.match import Matcher
+        graph = self.graph is None and self.load_graph(reporter) or self.graph
+        if reporter: reporter.write("Loading map matcher...\n")
+        self.matcher = Matcher(graph, ((s.id, s.start_id, s.end_id, s.geom) for s in self.waysegments()), **kwargs)
+        if reporter: reporter.write("Indexed %d segments\n" % len(self.matcher.ids))
+        return self.matcher
+    
+    matcher = None
+    
+    @property
+    def snapshot_path(self):
+        """The default snapshot file: the database file name + .snapshot."""
+        if self.dbname == ":memory:":
+            raise ValueError("an in-memory database needs a snapshot path")
+        return self.dbname + ".snapshot"
+    
+    def save_snapshot(self, path=None, reporter=None):
+        """Saves the routing graph and the segment index, loading those not yet
+        loaded or loaded at an earlier generation, to a snapshot file (see 
+        pysmosis.geom.snapshot) at path, or snapshot_path, stamped with the 
+        database's id and generation."""
+        from pysmosis.geom import snapshot
+        generation = self.generation()
+        graph, index = self.graph, self.segment_index
+        if graph is None or self.graph_generation != generation:
+            graph = self.load_graph(reporter)
+        if index is None or self.segment_index_generation != generation:
+            index = self.load_segment_index(reporter)
+        arrays = {}
+        for prefix, derived in (('graph.', graph), ('segment_index.', index)):
+            for name, a in derived.arrays().items():
+                arrays[prefix + name] = a
+        path = path or self.snapshot_path
+        if reporter: reporter.write("Writing snapshot %s...\n" % path)
+        snapshot.write(path, arrays, database_id=self.database_id, generation=generation,
+                       node_size=index.node_size)
+        return path
+    
+    def load_snapshot(self, path=None, reporter=None):
+        """Memory-maps the routing graph and segment index of a snapshot saved
+        by save_snapshot into self.graph and self.segment_index, in place of
+        load_graph and load_segment_index.  Returns False, loading nothing, if
+        the file does not exist or was saved from another database, or at 
+        another generation of this one."""
+        from pysmosis.geom import snapshot
+        from pysmosis.geom.graph import Graph
+        from pysmosis.geom.index import SegmentIndex
+        path = path or self.snapshot_path
+        if not os.path.exists(path):
+            if reporter: reporter.write("No snapshot %s\n" % path)
+            return False
+        snap = snapshot.Snapshot(path)
+        if snap.attributes.get('database_id') != self.database_id:
+            if reporter: reporter.write("Snapshot %s is of another database\n" % path)
+            return False
+        generation = self.generation()
+        if snap.attributes['generation'] != generation:
+            if reporter: reporter.write("Snapshot %s is of generation %d, not %d\n" % (path, snap.attributes['generation'], generation))
+            return False
+        def arrays(prefix):
+            return dict((name[len(prefix):], snap.array(name)) for name in snap.sections if name.startswith(prefix))
+        self.graph = Graph.from_arrays(arrays('graph.'))
+        self.segment_index = SegmentIndex.from_arrays(arrays('segment_index.'), snap.attributes['node_size'])
+        self.graph_generation = self.segment_index_generation = generation
+        if reporter: reporter.write("Mapped %d edges, %d segments from %s\n" % (len(self.graph), len(self.segment_index), path))
+        return True
     
     def nearest_way( self, x,y, range=0.001, accept_tags=lambda tags:True ):
-        """returns (way_id, subsegment_num, subsegment_splitpoint, point, distance_from_point)"""
+        """returns (way, subsegment_num, subsegment_splitpoint, point, distance_from_point)
+        
+        subsegment_num is the segment of the way's geometry nearest (x, y), 
+        subsegment_splitpoint the fraction along that segment of the nearest
+        point, and distance_from_point is in meters.  Without a segment index,
+        only ways whose bounding box is within range degrees are considered;
+        with one, only ways within about that distance, skipping those the 
+        index holds that have since been deleted from the database."""
         
+        if self.segment_index is not None:
+            max_distance = range * 111195.0 * 2**0.5
+            for dist, way_id, seq, point, frac in self.segment_index.iter_nearest(x, y, max_distance):
+                way = self.way(way_id)
+                if way is not None and accept_tags(way.tags):
+                    return (way, seq, frac, point, dist)
+            return (None, None, None, None, None)
+        
+        from pysmosis.geom.index import closest_point_on_linestring
         lineup = []
         
-        for way in self.nearby_ways( y, x, range=0.001 ):
-            if accept_tags(way.tags):
+        for way in self.nearby_ways( y, x, range=range ):
+            if accept_tags(way.tags) and len(way.geom) > 1:
                 subsegment_num, subsegment_splitpoint, point, distance_from_point = closest_point_on_linestring( way.geom, (x, y) )
                 lineup.append( (way, subsegment_num, subsegment_splitpoint, point, distance_from_point) )
         
         if len(lineup)==0:
             return (None, None, None, None, None)
-        return min( lineup, key=lambda x:x[4] )
+        return min( lineup, key=lambda x:(x[4], x[0].id) )
+
+    def nearest_ways(self, xs, ys, range=0.001, accept_tags=lambda tags:True):
+        """Batch nearest_way over arrays of query points, e.g. a GPS trace.
+        
+        Returns (way ids, subsegment_nums, subsegment_splitpoints, xs, ys, 
+        distances) arrays with one entry per point, the same values as 
+        nearest_way but with way ids in place of Way records; points with no
+        way in range get way id -1 and nan.
+        
+        Without a segment index, the ways are fetched and their segments 
+        unpacked into arrays once per grid cell of points.  numpy then ranks 
+        every segment for every point by linearref's distance, up to rounding,
+        and only the segments within EXACT_MARGIN meters of the best, a bound
+        on that rounding, are measured with linearref."""
+        from pysmosis.geom.index import segment_distance
+        xs, ys = _query_points(xs, ys)
+        n = len(xs)
+        ids = numpy.empty(n, dtype=numpy.int64)
+        seqs = numpy.empty(n, dtype=numpy.int64)
+        ret = (ids, seqs, numpy.empty(n), numpy.empty(n), numpy.empty(n), numpy.empty(n))
+        
+        def put(i, hit):
+            if hit is None:
+                hit = (-1, -1, numpy.nan, (numpy.nan, numpy.nan), numpy.nan)
+            way_id, seq, frac, point, dist = hit
+            for a, v in zip(ret, (way_id, seq, frac, point[0], point[1], dist)):
+                a[i] = v
+        
+        if self.segment_index is not None:
+            accepted = {}
+            max_distance = range * 111195.0 * 2**0.5
+            for i in xrange(n):
+                hit = None
+                for dist, way_id, seq, point, frac in self.segment_index.iter_nearest(xs[i], ys[i], max_distance):
+                    if way_id not in accepted:
+                        way = self.way(way_id)
+                        accepted[way_id] = way is not None and accept_tags(way.tags)
+                    if accepted[way_id]:
+                        hit = (way_id, seq, frac, point, dist)
+                        break
+                put(i, hit)
+            return ret
+        
+        for tile in _tiles(ys, xs, max(8*range, 0.01)):
+            q = self._in_box(Way, 'ways_rtree', xs[tile].min()-range, ys[tile].min()-range,
+                             xs[tile].max()+range, ys[tile].max()+range)
+            ways = sorted([w for w in q if accept_tags(w.tags) and len(w.geom) > 1], key=lambda w: w.id)
+            q.close()
+            if not ways:
+                for i in tile:
+                    put(i, None)
+                continue
+            
+            way_ids = numpy.array([w.id for w in ways], dtype=numpy.int64)
+            left, bottom, right, top = [numpy.array([getattr(w, k) for w in ways], dtype=float)
+                                        for k in ('left', 'bottom', 'right', 'top')]
+            segs = _segment_arrays(ways)
+            x1, y1, x2, y2, seg_way, seg_seq = segs
+            
+            step = max(1, CHUNK_CELLS // len(x1))
+            for s in xrange(0, len(tile), step):
+                points = tile[s:s+step]
+                x = xs[points, None]
+                y = ys[points, None]
+                # the ways nearest_way would fetch for each point
+                near = (left <= x+range) & (right >= x-range) & (bottom <= y+range) & (top >= y-range)
+                approx = _approx_segment_distance(x1, y1, x2, y2, x, y)
+                approx[~near[:, seg_way]] = numpy.inf
+                best = approx.min(axis=1)
+                candidates = {}
+                close = (approx <= best[:, None] + EXACT_MARGIN) & ~numpy.isinf(approx)
+                for row, col in zip(*numpy.nonzero(close)):
+                    candidates.setdefault(row, []).append(col)
+                for row, i in enumerate(points):
+                    hit = None
+                    for col in candidates.get(row, ()):
+                        dist, point, frac = segment_distance(x1[col], y1[col], x2[col], y2[col], xs[i], ys[i])
+                        key = (dist, way_ids[seg_way[col]], seg_seq[col])
+                        if hit is None or key < hit[0]:
+                            hit = (key, (way_ids[seg_way[col]], seg_seq[col], frac, point, dist))
+                    put(i, hit and hit[1])
+        return ret
                 
     def bounds(self):
-        c = self.conn.cursor()
+        c = self.db.reader().cursor()
         c.execute( "SELECT min(left), min(bottom), max(right), max(top) FROM ways" )
         
         ret = next(c)
         c.close()
         return ret
 
-def osm_to_osmdb(osm_filename, osmdb_filename):
+# rows times columns of the distance matrices computed at once by the batch queries
+CHUNK_CELLS = 1 << 20
+# as in linearref, which converts degrees with pi to 8 decimals
+EARTH_RADIUS = 6370986.884258304
+RADIANS = 3.14159265 / 180.0
+# meters; nearest_ways measures segments exactly when their approximate 
+# distance is this close to the best one.  The approximation repeats 
+# linearref's arithmetic in another order, so the two differ by rounding: 
+# a few ulps of coordinates of up to 180 degrees, some 1e-8 meters, while a
+# relative 1e-15 of the longest distance on earth is another 2e-8.  The 
+# margin is some 30 times their sum.
+EXACT_MARGIN = 1e-6
+
+def _and(clauses):
+    """Joins (sql, args) clauses into one, or None if there are none."""
+    if not clauses:
+        return None
+    return (" AND ".join(["(%s)" % sql for sql, args in clauses]), 
+            [a for sql, args in clauses for a in args])
+
+def _glob_escape(s):
+    return re.sub(r"([[*?])", r"[\1]", s)
+
+def _tag_values(v):
+    """The values a tags_where value stands for, or None for any."""
+    if v is None:
+        return None
+    if isinstance(v, (list, tuple, set, frozenset)):
+        return sorted(v)
+    return [v]
+
+def _tags_where(tags):
+    """(sql, args) for the rows whose tags match the tags dict, as for 
+    OSMDB.tags_where.  This GLOBs the JSON text JSONField writes (json.dumps'
+    '"key": value' separators), so that it needs no JSON support in sqlite."""
+    where, args = [], []
+    for k, v in sorted(tags.items()):
+        prefix = "*" + _glob_escape(json.dumps(k) + ": ")
+        values = _tag_values(v)
+        if values is None:
+            patterns = [prefix + "*"]
+        else:
+            patterns = [prefix + _glob_escape(json.dumps(value)) + "[,}]*" for value in values]
+        where.append("(%s)" % " OR ".join(["tags GLOB ?"] * len(patterns)))
+        args.extend(patterns)
+    return " AND ".join(where), args
+
+def _tag_index_where(table, tags, column='id'):
+    """(sql, args) for the rows whose column, the id of a row of table (nodes
+    or ways), is that of one whose tags match the tags dict, as for 
+    OSMDB.tags_where, looked up in the tag tables."""
+    where, args = [], []
+    for k, v in sorted(tags.items()):
+        sql = "%s IN (SELECT id FROM %s WHERE key_id = (SELECT id FROM tag_keys WHERE k = ?)" % (column, TAG_TABLES[table])
+        args.append(k)
+        values = _tag_values(v)
+        if values is not None:
+            sql += " AND value_id IN (SELECT id FROM tag_values WHERE v IN (%s))" % ",".join(["?"] * len(values))
+            args.extend(values)
+        where.append(sql + ")")
+    return " AND ".join(where), args
+
+def _planar_distance(dlat, dlon):
+    return sqrt(dlat*dlat + dlon*dlon)
+
+def _query_points(a, b):
+    if numpy is None:
+        raise ImportError("the batch queries require numpy")
+    a = numpy.asarray(a, dtype=float).ravel()
+    b = numpy.asarray(b, dtype=float).ravel()
+    if a.shape != b.shape:
+        raise ValueError("coordinate arrays differ in length")
+    return a, b
+
+def _tiles(lats, lons, cell):
+    """Groups the indexes of the points by the cell of a cell degree grid 
+    they fall in."""
+    keys = numpy.floor(lats / cell) * 1e6 + numpy.floor(lons / cell)
+    order = numpy.argsort(keys, kind='mergesort')
+    return [t for t in numpy.split(order, numpy.nonzero(numpy.diff(keys[order]))[0] + 1) if len(t)]
+
+def _no_nodes(n):
+    ids = numpy.empty(n, dtype=numpy.int64)
+    ids.fill(-1)
+    ret = (ids, numpy.empty(n), numpy.empty(n), numpy.empty(n))
+    for a in ret[1:]:
+        a.fill(numpy.nan)
+    return ret
+
+def _node_arrays(rows):
+    """(ids, lats, lons) arrays of (id, lat, lon) rows."""
+    if not rows:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0), numpy.empty(0)
+    ids, lats, lons = zip(*rows)
+    return numpy.array(ids, dtype=numpy.int64), numpy.array(lats, dtype=float), numpy.array(lons, dtype=float)
+
+def _fill_nearest_nodes(ret, points, lats, lons, candidates, range=None):
+    """Sets ret's entries at the indexes in points to the nearest of the 
+    candidate nodes (sorted by id, so that ties go to the lowest id, as in
+    nearest_node), only counting candidates within range if it is given."""
+    ids, clats, clons = candidates
+    if not len(ids):
+        return
+    step = max(1, CHUNK_CELLS // len(ids))
+    for s in xrange(0, len(points), step):
+        p = points[s:s+step]
+        lat = lats[p, None]
+        lon = lons[p, None]
+        dlat = clats - lat
+        dlon = clons - lon
+        d = numpy.sqrt(dlat*dlat + dlon*dlon)
+        if range is not None:
+            d[~((clats > lat-range) & (clats < lat+range) & (clons > lon-range) & (clons < lon+range))] = numpy.inf
+        nearest = d.argmin(axis=1)
+        dist = d[numpy.arange(len(p)), nearest]
+        found = ~numpy.isinf(dist)
+        p, nearest = p[found], nearest[found]
+        for a, v in zip(ret, (ids, clats, clons)):
+            a[p] = v[nearest]
+        ret[3][p] = dist[found]
+
+def _segment_arrays(ways):
+    """x1, y1, x2, y2, way number and segment number arrays over the segments
+    of the ways' geometries."""
+    flat = [numpy.array(list(w.geom), dtype=float) for w in ways]
+    start = numpy.vstack([c[:-1] for c in flat])
+    end = numpy.vstack([c[1:] for c in flat])
+    counts = [len(c) - 1 for c in flat]
+    seg_way = numpy.repeat(numpy.arange(len(ways)), counts)
+    seg_seq = numpy.concatenate([numpy.arange(k) for k in counts])
+    return start[:, 0], start[:, 1], end[:, 0], end[:, 1], seg_way, seg_seq
+
+def _approx_segment_distance(x1, y1, x2, y2, x, y):
+    """Spherical distance in meters from each of the points (x, y) to the
+    planar closest point of each of the segments, as linearref measures it
+    (to within rounding; see EXACT_MARGIN)."""
+    dx = x2 - x1
+    dy = y2 - y1
+    den = dx*dx + dy*dy
+    r = numpy.clip(((x - x1)*dx + (y - y1)*dy) / numpy.where(den > 0, den, 1.0), 0.0, 1.0)
+    cx = x1 + r*dx
+    cy = y1 + r*dy
+    lat1, lat2 = cy * RADIANS, y * RADIANS
+    h = numpy.sin((lat1 - lat2) / 2)**2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((cx - x) * RADIANS / 2)**2
+    return 2.0 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(h)))
+
+def osm_to_osmdb(osm_filename, osmdb_filename, workers=1):
     osmdb = OSMDB( osmdb_filename, overwrite=True )
-    osmdb.populate( osm_filename, accept_way=lambda way: 'highway' in way.tags, reporter=sys.stdout )
+    osmdb.populate( osm_filename, accept_way=lambda way: 'highway' in way.tags, reporter=sys.stdout, bulk=True,
+                    workers=workers )
 
 if __name__=='__main__':
-    from sys import argv
+    from optparse import OptionParser
     
-    usage = "python osmdb.py osm_filename osmdb_filename"
-    if len(argv) < 3:
-        print usage
+    parser = OptionParser(usage="python ORM.py [options] osm_filename [osm_filename ...] osmdb_filename")
+    parser.add_option("-w", "--workers", type="int", default=1, 
+                      help="number of parser processes (default 1)")
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.print_usage()
         exit()
 
-    osm_filename = argv[1]
-    osmdb_filename = argv[2]
+    osm_filename = len(args) > 2 and args[:-1] or args[0]
+    osmdb_filename = args[-1]
     
-    osm_to_osmdb(osm_filename, osmdb_filename)
+    osm_to_osmdb(osm_filename, osmdb_filename, workers=options.workers)
@@ -0,0 +1,608 @@
+"""
+Import benchmarks.  Run from this directory:
+
+    python bench.py load [osm_filename ...]
+    python bench.py parsers [osm_filename ...]
+    python bench.py workers [osm_filename ...]
+    python bench.py decompress [osm_filename ...]
+    python bench.py geometry [osm_filename ...]
+    python bench.py spatial [osm_filename ...]
+    python bench.py nearest_way [osm_filename ...]
+    python bench.py batch [osm_filename ...]
+    python bench.py segment [osm_filename ...]
+    python bench.py nodecache [osm_filename ...]
+    python bench.py nodes [osm_filename ...]
+    python bench.py stream [osm_filename ...]
+    python bench.py concurrency [osm_filename ...]
+    python bench.py graph [osm_filename ...]
+    python bench.py snapshot [osm_filename ...]
+    python bench.py match [osm_filename ...]
+    python bench.py tags [osm_filename ...]
+    python bench.py cache [osm_filename ...]
+    python bench.py ormlite
+"""
+import os
+import re
+import random
+import sys
+import time
+import resource
+import tempfile
+import threading
+import multiprocessing
+# for pysmosis.geom, when run from a source checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import ORM
+import ormlite
+import digest
+import decompress
+
+test_file = os.path.join(os.path.dirname(__file__), "..", "test", "test_file.osm")
+bench_db = os.path.join(tempfile.gettempdir(), "pysmosis_bench.sqlite")
+
+def timed(fn, *args, **kwargs):
+    t = time.time()
+    ret = fn(*args, **kwargs)
+    return time.time() - t, ret
+
+def measured(fn, *args, **kwargs):
+    """Runs fn in a child process and returns (seconds, peak RSS in MB)."""
+    q = multiprocessing.Queue()
+    def run():
+        elapsed, _ = timed(fn, *args, **kwargs)
+        q.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    p = multiprocessing.Process(target=run)
+    p.start()
+    ret = q.get()
+    p.join()
+    return ret
+
+def synthesize_osm(dst, src=test_file, copies=100):
+    """Writes a file holding copies of src's nodes and ways, laid out on a grid, 
+    with ids offset so that the copies do not collide."""
+    body = open(src).read()
+    head = body[:body.index("<node")]
+    body = body[len(head):body.rindex("</osm>")]
+    offset = 10 ** len(str(max(map(int, re.findall(r' (?:id|ref)="(\d+)"', body)))))
+    out = open(dst, "w")
+    out.write(head)
+    for k in range(copies):
+        dlon, dlat = (k % 10) * 0.025, (k // 10) * 0.02
+        out.write(re.sub(r' (id|ref|lat|lon)="([-\d.]+)"',
+                         lambda m: ' %s="%s"' % (m.group(1),
+                                                 m.group(1) == 'lat' and "%.7f" % (float(m.group(2)) + dlat) or
+                                                 m.group(1) == 'lon' and "%.7f" % (float(m.group(2)) + dlon) or
+                                                 int(m.group(2)) + k * offset),
+                         body))
+    out.write("</osm>\n")
+    out.close()
+    return dst
+
+def synthetic_file(copies=100):
+    path = os.path.join(tempfile.gettempdir(), "pysmosis_bench_x%d.osm" % copies)
+    if not os.path.exists(path):
+        synthesize_osm(path, copies=copies)
+    return path
+
+def bench_load(filename=test_file, dbname=bench_db):
+    """Compares the per-element loader against the bulk loader."""
+    for bulk in (False, True):
+        db = ORM.OSMDB(dbname, overwrite=True)
+        elapsed, _ = timed(db.populate, filename, accept_way=lambda way: 'highway' in way.tags, bulk=bulk)
+        print "load %-40s bulk=%-5s %8.2fs  %6d nodes %6d ways" % (os.path.basename(filename), bulk, elapsed,
+                                                                   db.conn.execute("select count(*) from nodes").fetchone()[0],
+                                                                   db.count_ways())
+
+def bench_parsers(filename=test_file, dbname=bench_db):
+    """Compares the xml.sax Record loader against the iterparse tuple loader."""
+    def load(parser):
+        db = ORM.OSMDB(dbname, overwrite=True)
+        db.populate(filename, accept_way=lambda way: 'highway' in way.tags, bulk=True, parser=parser)
+    size = os.path.getsize(filename) / 1048576.0
+    for parser in ('sax', 'iterparse'):
+        elapsed, rss = measured(load, parser)
+        print "parse %-30s %6.1fMB %-9s  load %7.2fs (%5.1f MB/s)  peak rss %6.1fMB" % \
+            (os.path.basename(filename), size, parser, elapsed, size / elapsed, rss)
+
+def bench_workers(filename=test_file, dbname=bench_db):
+    """Times the parallel loader with increasing worker counts."""
+    for workers in sorted(set([1, 2, 4, multiprocessing.cpu_count()])):
+        db = ORM.OSMDB(dbname, overwrite=True)
+        elapsed, _ = timed(db.populate, filename, accept_way=lambda way: 'highway' in way.tags, 
+                           bulk=True, parser='iterparse', workers=workers)
+        print "workers %-30s %2d workers %7.2fs  nodes %s ways %s" % (os.path.basename(filename), workers, elapsed,
+                                                                      digest.table_checksum(db.conn, 'nodes')[1][:8],
+                                                                      digest.table_checksum(db.conn, 'ways')[1][:8])
+
+def compressed_copies(filename):
+    """Writes single stream .bz2, multistream .bz2 and .gz copies of filename
+    next to the benchmark database, returning their paths."""
+    import bz2, gzip
+    base = os.path.join(tempfile.gettempdir(), os.path.basename(filename))
+    paths = [base + ".bz2", base + ".multi.bz2", base + ".gz"]
+    if not os.path.exists(paths[-1]):
+        raw = open(filename, 'rb').read()
+        open(paths[0], 'wb').write(bz2.compress(raw))
+        # pbzip2 style: one stream per 900k block
+        open(paths[1], 'wb').write("".join([bz2.compress(raw[i:i + 900000]) for i in range(0, len(raw), 900000)]))
+        f = gzip.open(paths[2], 'wb')
+        f.write(raw)
+        f.close()
+    return paths
+
+def bench_decompress(filename=test_file, dbname=bench_db):
+    """Decompression throughput and end to end import time per input format."""
+    import bz2
+    def drain(f):
+        n = 0
+        data = f.read(1 << 16)
+        while data:
+            n += len(data)
+            data = f.read(1 << 16)
+        return n
+    for path in [filename] + compressed_copies(filename):
+        readers = [('open_osmfile', lambda: decompress.open_osmfile(path))]
+        if path.endswith(".bz2"):
+            # note that BZ2File stops at the end of the first stream
+            readers.insert(0, ('BZ2File', lambda: bz2.BZ2File(path, 'r')))
+        for name, reader in readers:
+            elapsed, n = timed(drain, reader())
+            print "decompress %-36s %-12s %7.2fs %7.1fMB (%6.1f MB/s)" % (os.path.basename(path), name, elapsed, 
+                                                                          n / 1048576.0, n / 1048576.0 / elapsed)
+        db = ORM.OSMDB(dbname, overwrite=True)
+        elapsed, _ = timed(db.populate, path, accept_way=lambda way: 'highway' in way.tags, 
+                           bulk=True, parser='iterparse')
+        print "import     %-36s %-12s %7.2fs" % (os.path.basename(path), 'iterparse', elapsed)
+
+def way_geometries(filename):
+    """Returns (node id list, coordinate list) for every highway in filename."""
+    nodes = {}
+    ways = []
+    for chunk in digest.iter_osm(filename):
+        for el in chunk:
+            if type(el) is digest.OSMNode:
+                nodes[el.id] = (el.lon, el.lat)
+            elif 'highway' in el.tags:
+                ways.append((el.nds, [nodes[n] for n in el.nds if n in nodes]))
+    return ways
+
+def bench_geometry(filename=test_file):
+    """Encoded size and decode time of way geometry as JSON and packed BLOBs."""
+    import ormlite
+    json = ormlite.json
+    ways = way_geometries(filename)
+    formats = [('json', lambda nds: json.dumps(nds), lambda c: json.dumps(c), json.loads),
+               ('packed', ormlite.pack_ints, ormlite.pack_coords, ormlite.unpack),
+               ('delta', lambda nds: ormlite.pack_ints(nds, True), lambda c: ormlite.pack_coords(c, True), ormlite.unpack)]
+    for name, enc_nds, enc_coords, dec in formats:
+        encoded = [(enc_nds(nds), enc_coords(coords)) for nds, coords in ways]
+        size = sum([len(nds) + len(coords) for nds, coords in encoded])
+        # decode as sqlite returns the values
+        if name == 'json':
+            encoded = [(unicode(nds), unicode(coords)) for nds, coords in encoded]
+        elapsed, _ = timed(lambda: [(dec(nds), dec(coords)) for nds, coords in encoded])
+        print "geometry %-30s %-7s %6d ways %9d bytes  decode %6.2fus/way" % (os.path.basename(filename), name, len(ways),
+                                                                              size, elapsed * 1e6 / len(ways))
+
+def random_points(db, n, seed=0):
+    """n (lat, lon) points spread uniformly over the bounds of db's ways."""
+    rnd = random.Random(seed)
+    l, b, r, t = db.bounds()
+    return [(rnd.uniform(b, t), rnd.uniform(l, r)) for i in range(n)]
+
+def bench_spatial(filename=test_file, dbname=bench_db, n=1000):
+    """Query latency of the R*Tree and B-tree paths over random points."""
+    db = ORM.OSMDB(dbname, overwrite=True)
+    db.populate(filename, accept_way=lambda way: 'highway' in way.tags, bulk=True, parser='iterparse')
+    points = random_points(db, n)
+    for rtree in (True, False):
+        db.rtree = rtree
+        for name, query in (('nearby_ways', lambda lat, lon: list(db.nearby_ways(lat, lon, range=0.002))),
+                            ('nearest_node', db.nearest_node)):
+            elapsed, _ = timed(lambda: [query(lat, lon) for lat, lon in points])
+            print "spatial %-30s %-12s rtree=%-5s %8.1fus/query" % (os.path.basename(filename), name, rtree, elapsed * 1e6 / n)
+
+def bench_nearest_way(filename=test_file, dbname=bench_db, n=1000):
+    """nearest_way latency against the database and the in-memory segment index."""
+    db = ORM.OSMDB(dbname, overwrite=True)
+    db.populate(filename, accept_way=lambda way: 'highway' in way.tags, bulk=True, parser='iterparse')
+    points = random_points(db, n)
+    name = os.path.basename(filename)
+    elapsed, _ = timed(lambda: [db.nearest_way(lon, lat) for lat, lon in points])
+    print "nearest_way %-30s %-14s %8.1fus/query" % (name, 'database', elapsed * 1e6 / n)
+    elapsed, index = timed(db.load_segment_index)
+    print "nearest_way %-30s %-14s %8.2fs for %d segments" % (name, 'index build', elapsed, len(index))
+    elapsed, _ = timed(lambda: [db.nearest_way(lon, lat) for lat, lon in points])
+    print "nearest_way %-30s %-14s %8.1fus/query" % (name, 'index', elapsed * 1e6 / n)
+    elapsed, _ = timed(lambda: [index.nearest(lon, lat) for lat, lon in points])
+    print "nearest_way %-30s %-14s %8.1fus/query (unbounded)" % (name, 'index.nearest', elapsed * 1e6 / n)
+
+def bench_batch(filename=test_file, dbname=bench_db, sizes=(1, 100, 100000), scalar_max=1000):
+    """Per point cost of the batch queries against their scalar versions, for
+    batches of random points (the scalar queries are timed on at most 
+    scalar_max of them)."""
+    db = ORM.OSMDB(dbname, overwrite=True)
+    db.populate(filename, accept_way=lambda way: 'highway' in way.tags, bulk=True, parser='iterparse')
+    name = os.path.basename(filename)
+    # keep the linearref import out of the timings
+    import pysmosis.geom.index
+    for n in sizes:
+        points = random_points(db, n)
+        lats, lons = [p[0] for p in points], [p[1] for p in points]
+        sample = points[:scalar_max]
+        for query, batch, scalar in (('nearest_node', lambda: db.nearest_nodes(lats, lons),
+                                      lambda: [db.nearest_node(lat, lon) for lat, lon in sample]),
+                                     ('nearest_way', lambda: db.nearest_ways(lons, lats),
+                                      lambda: [db.nearest_way(lon, lat) for lat, lon in sample])):
+            batch_elapsed, _ = timed(batch)
+            scalar_elapsed, _ = timed(scalar)
+            print "batch %-30s %-12s %6d points  batch %8.1fus/point  scalar %8.1fus/point" % \
+                (name, query, n, batch_elapsed * 1e6 / n, scalar_elapsed * 1e6 / len(sample))
+
+def bench_segment(filename=test_file, dbname=bench_db):
+    """segment_ways with one worker against a pool of them."""
+    db = ORM.OSMDB(dbname, overwrite=True)
+    db.populate(filename, bulk=True, parser='iterparse')
+    name = os.path.basename(filename)
+    for workers in sorted(set((1, multiprocessing.cpu_count()))):
+        elapsed, count = timed(db.segment_ways, workers=workers)
+        print "segment %-30s %2d workers %8.2fs for %d segments" % (name, workers, elapsed, count)
+
+def bench_nodecache(filename=test_file, dbname=bench_db):
+    """Time and peak RSS of an import that builds way geometry and segments
+    from the nodes table against one that uses a NodeCache, with the time
+    of each step."""
+    name = os.path.basename(filename)
+    def run(label, cache):
+        cache = cache and digest.NodeCache(*cache)
+        db = ORM.OSMDB(dbname, overwrite=True)
+        steps = [timed(digest.load_osmfile, db.conn, filename, lambda way: True, bulk=True, 
+                       parser='iterparse', node_cache=cache)[0],
+                 timed(digest.populate_way_geom, db.conn, nodes=cache)[0],
+                 timed(digest.segment_ways, db.conn, nodes=cache)[0]]
+        print "nodecache %-30s %-16s load %6.2fs  geometry %6.2fs  segments %6.2fs" % ((name, label) + tuple(steps))
+        sys.stdout.flush()
+        db.conn.close()
+        if cache is not None:
+            cache.close()
+    for label, cache in (('nodes table', None),
+                         ('sorted, memory', ('sorted', None)),
+                         ('sorted, mmap', ('sorted', 0)),
+                         ('dense, mmap', ('dense', 0))):
+        elapsed, rss = measured(run, label, cache)
+        print "nodecache %-30s %-16s %8.2fs %8.1fMB peak RSS" % (name, label, elapsed, rss)
+
+def bench_nodes(filename=test_file, dbname=bench_db, repeat=5):
+    """Iterating over all nodes as Node records, as tuples (OSMDB.nodes) 
+    and as namedtuples: the best of repeat rounds."""
+    db = ORM.OSMDB(dbname, overwrite=True)
+    db.populate(filename, bulk=True, parser='iterparse')
+    name = os.path.basename(filename)
+    ways = (('records', lambda: [n.tuple() for n in ORM.Node.objects.query()]),
+            ('nodes()', lambda: list(db.nodes())),
+            ('namedtuples', lambda: list(ORM.Node.objects.values('id', 'lat', 'lon', named=True))))
+    for label, fn in ways:
+        elapsed, nodes = min([timed(fn) for r in range(repeat)])
+        print "nodes %-30s %-12s %8.3fs %8.2fus/node" % (name, label, elapsed, elapsed * 1e6 / len(nodes))
+
+def bench_stream(filename=test_file, dbname=bench_db):
+    """Time and peak RSS of a pass over every way's geometry read with
+    fetchall, with an open cursor, and a page at a time."""
+    def load():
+        ORM.OSMDB(dbname, overwrite=True).populate(filename, bulk=True, parser='iterparse')
+    measured(load)
+    name = os.path.basename(filename)
+    def scan(ways):
+        db = ORM.OSMDB(dbname)
+        return sum([len(w.geom) for w in ways()])
+    for label, ways in (('fetchall', lambda: ORM.Way.objects.query().fetchall()),
+                        ('cursor', lambda: ORM.Way.objects.query()),
+                        ('stream 1000', lambda: ORM.Way.objects.stream(1000)),
+                        ('stream 10000', lambda: ORM.Way.objects.stream(10000))):
+        elapsed, rss = measured(scan, ways)
+        print "stream %-30s %-14s %8.2fs %8.1fMB peak RSS" % (name, label, elapsed, rss)
+
+def bench_concurrency(filename=test_file, dbname=bench_db, readers=(0, 1, 4, 8)):
+    """An import into a pooled OSMDB while reader threads run nearby_ways 
+    queries: the import time and the readers' queries per second (and 
+    failed queries), with the pool in WAL mode and with a rollback journal."""
+    name = os.path.basename(filename)
+    scratch = ORM.OSMDB(":memory:")
+    scratch.populate(filename, bulk=True, parser='iterparse')
+    points = random_points(scratch, 100)
+    scratch.close()
+    for wal in (True, False):
+        for n in readers:
+            if os.path.exists(dbname):
+                os.remove(dbname)
+            db = ORM.OSMDB(dbname, pool=ormlite.ConnectionPool(dbname, wal=wal, timeout=0.1))
+            done = threading.Event()
+            counts = [[0, 0] for i in range(n)]
+            def read(count):
+                while not done.is_set():
+                    for lat, lon in points:
+                        try:
+                            list(db.nearby_ways(lat, lon, range=0.002))
+                            count[0] += 1
+                        except ORM.sqlite3.OperationalError:
+                            count[1] += 1
+            threads = [threading.Thread(target=read, args=(c,)) for c in counts]
+            for t in threads:
+                t.start()
+            elapsed, _ = timed(db.populate, filename, bulk=True, parser='iterparse', batch_size=1000)
+            done.set()
+            for t in threads:
+                t.join()
+            db.close()
+            print "concurrency %-30s %-8s %d readers: import %7.2fs, %8.0f queries/s, %6d failed" % \
+                (name, wal and "WAL" or "journal", n, elapsed, sum([c[0] for c in counts]) / elapsed, sum([c[1] for c in counts]))
+            sys.stdout.flush()
+
+def grid_segments(n, spacing=0.001, oneway_every=5):
+    """The segments of an n by n grid city of blocks spacing degrees apart,
+    with every oneway_every'th street one way, for routing Graphs."""
+    node = lambda i, j: i * n + j + 1
+    segments = []
+    for i in range(n):
+        for j in range(n):
+            x, y = -122.5 + j * spacing, 37.7 + i * spacing
+            if j + 1 < n:
+                segments.append((len(segments), node(i, j), node(i, j + 1), [(x, y), (x + spacing, y)],
+                                 i % oneway_every == 0 and 1 or 0))
+            if i + 1 < n:
+                segments.append((len(segments), node(i, j), node(i + 1, j), [(x, y), (x, y + spacing)],
+                                 j % oneway_every == 0 and -1 or 0))
+    return segments
+
+def bench_graph(filename=test_file, dbname=bench_db, queries=200, targets=100):
+    """Build time and memory per edge of routing Graphs, from the segments of
+    filename and of a 200x200 grid city, and the latency of point to point
+    A* and Dijkstra searches and of one to many searches."""
+    from pysmosis.geom.graph import Graph
+    db = ORM.OSMDB(dbname, overwrite=True)
+    db.populate(filename, bulk=True, parser='iterparse', segment=True)
+    grid = grid_segments(200)
+    for name, build in ((os.path.basename(filename), db.load_graph),
+                        ('grid 200x200', lambda: Graph(grid))):
+        elapsed, g = timed(build)
+        print "graph %-30s %8d edges, built in %6.2fs, %5.1f bytes/edge" % (name, len(g), elapsed, g.nbytes() / float(len(g)))
+        rnd = random.Random(0)
+        pairs = [(rnd.choice(g.nodes), rnd.choice(g.nodes)) for i in range(queries)]
+        for label, search in (('A*', lambda s, t: g.shortest_path(s, t)),
+                              ('Dijkstra', lambda s, t: g.shortest_path(s, t, astar=False)),
+                              ('one to %d' % targets, lambda s, t: g.distances(s, rnd.sample(g.nodes, targets)))):
+            elapsed, _ = timed(lambda: [search(s, t) for s, t in pairs])
+            print "graph %-30s %-12s %8.2fms/query" % (name, label, elapsed * 1e3 / queries)
+        sys.stdout.flush()
+
+def bench_snapshot(filename=test_file, dbname=bench_db, queries=100):
+    """Startup time of a worker process that loads the routing graph and 
+    segment index from the database, against one that maps a snapshot, then
+    the time of queries over them, its peak RSS, and (on Linux) how much of
+    its memory is private rather than file pages shared through the page
+    cache."""
+    # imported here, so that startup times are of loading alone
+    from pysmosis.geom import graph, index, snapshot
+    def load():
+        db = ORM.OSMDB(dbname, overwrite=True)
+        db.populate(filename, bulk=True, parser='iterparse', segment=True)
+        elapsed, _ = timed(db.save_snapshot)
+        print "snapshot %-30s written in %6.2fs, %6.1fMB" % (name, elapsed, os.path.getsize(db.snapshot_path) / 1048576.0)
+    name = os.path.basename(filename)
+    measured(load)
+    def worker(label, start):
+        db = ORM.OSMDB(dbname)
+        elapsed, _ = timed(start, db)
+        rnd = random.Random(0)
+        g = db.graph
+        pairs = [(rnd.choice(g.nodes), rnd.choice(g.nodes)) for i in range(queries)]
+        points = random_points(db, queries)
+        query_time, _ = timed(lambda: ([g.distances(s, [t]) for s, t in pairs], 
+                                       [db.segment_index.nearest(lon, lat) for lat, lon in points]))
+        status = os.path.exists("/proc/self/status") and open("/proc/self/status").read() or ""
+        anon, shared = [re.search(key + r":\s+(\d+)", status) for key in ("RssAnon", "RssFile")]
+        memory = anon and "%7.1fMB private, %6.1fMB file" % (int(anon.group(1)) / 1024.0, int(shared.group(1)) / 1024.0) or ""
+        print "snapshot %-30s %-10s startup %6.3fs, queries %6.2fs, %s" % (name, label, elapsed, query_time, memory)
+        sys.stdout.flush()
+    for label, start in (('database', lambda db: (db.load_graph(), db.load_segment_index())),
+                         ('snapshot', lambda db: db.load_snapshot())):
+        elapsed, rss = measured(worker, label, start)
+        print "snapshot %-30s %-10s %8.1fMB peak RSS" % (name, label, rss)
+
+def synthetic_traces(db, n, spacing=20.0, noise=5.0, min_segments=5, seed=0):
+    """n GPS traces along shortest paths between random nodes of db's routing
+    graph, of a fix every spacing meters, each moved a normally distributed
+    noise meters (standard deviation) in each direction, with the segment
+    ids of their paths."""
+    from pysmosis.geom.backend import linearref
+    rnd = random.Random(seed)
+    g = db.graph
+    geoms = dict((s.id, (s.start_id, s.geom)) for s in db.waysegments())
+    noise = noise / 111195.0
+    traces = []
+    while len(traces) < n:
+        path = g.shortest_path(rnd.choice(g.nodes), rnd.choice(g.nodes))
+        if not path or len(path[2]) < min_segments:
+            continue
+        length, nodes, ids = path
+        trace, next = [], 0.0
+        along = 0.0
+        for node, id in zip(nodes, ids):
+            start, geom = geoms[id]
+            if start != node:
+                geom = geom[::-1]
+            for (x1, y1), (x2, y2) in zip(geom, geom[1:]):
+                d = linearref.distance_earth(x1, y1, x2, y2)
+                while next <= along + d:
+                    f = d and (next - along) / d or 0.0
+                    trace.append((x1 + f * (x2 - x1) + rnd.gauss(0, noise), y1 + f * (y2 - y1) + rnd.gauss(0, noise)))
+                    next += spacing
+                along += d
+        traces.append((trace, ids))
+    return traces
+
+def bench_match(filename=test_file, dbname=bench_db, traces=200, workers=(1, 2, 4)):
+    """Map matching throughput, in fixes per second, and accuracy, the share 
+    of fixes matched to a segment of the path the trace was made along, of
+    the HMM matcher against snapping each fix to its nearest way."""
+    db = ORM.OSMDB(dbname, overwrite=True)
+    db.populate(filename, accept_way=lambda way: 'highway' in way.tags, bulk=True, parser='iterparse', segment=True)
+    name = os.path.basename(filename)
+    elapsed, matcher = timed(db.load_matcher)
+    print "match %-30s %-14s %8.2fs for %d segments" % (name, 'build', elapsed, len(matcher.ids))
+    traces = synthetic_traces(db, traces)
+    fixes = sum([len(trace) for trace, ids in traces])
+    way_of = dict(db.waysegments(columns=('id', 'way_id')))
+    
+    def nearest_way():
+        return [[db.nearest_way(x, y)[0] for x, y in trace] for trace, ids in traces]
+    elapsed, snapped = timed(nearest_way)
+    hits = sum([len([w for w in ways if w and w.id in set([way_of[id] for id in ids])])
+                for (trace, ids), ways in zip(traces, snapped)])
+    print "match %-30s %-14s %8.0f fixes/s, %5.1f%% of %d fixes on the path's ways" % (name, 'nearest_way', fixes / elapsed, 100.0 * hits / fixes, fixes)
+    for n in workers:
+        elapsed, matched = timed(matcher.match_traces, [trace for trace, ids in traces], workers=n)
+        hits = sum([len([hit for hit in matches if hit and hit[0] in ids])
+                    for (trace, ids), matches in zip(traces, matched)])
+        print "match %-30s %-14s %8.0f fixes/s, %5.1f%% of %d fixes on the path" % (name, 'hmm x%d' % n, fixes / elapsed, 100.0 * hits / fixes, fixes)
+        sys.stdout.flush()
+
+def bench_tags(filename=test_file, dbname=bench_db, repeat=5):
+    """Ways selected by tag: decoding every way's JSON tags in Python,
+    GLOBbing the JSON in SQL, and through the tag tables; then the time to
+    load with the tag tables filled, and to fill them afterwards."""
+    import simplejson as json
+    db = ORM.OSMDB(dbname, overwrite=True)
+    elapsed, _ = timed(db.populate, filename, bulk=True, parser='iterparse')
+    name = os.path.basename(filename)
+    print "tags %-30s %-34s %8.3fs" % (name, 'load with tag tables', elapsed)
+    print "tags %-30s %-34s %8.3fs" % (name, 'index_tags', timed(db.index_tags)[0])
+    
+    def decoded(filter):
+        ret = []
+        for id, tags in db.ways(columns=('id', 'tags')):
+            tags = json.loads(tags)
+            for k, v in filter.items():
+                if k not in tags or v is not None and tags[k] not in (isinstance(v, list) and v or [v]):
+                    break
+            else:
+                ret.append(id)
+        return ret
+    def selected(filter, index):
+        db.tag_index = index
+        return [id for id, in db.ways(tags=filter, columns=('id',))]
+    for filter in ({'highway': 'residential'}, {'highway': ['primary', 'secondary']},
+                   {'highway': None, 'oneway': None}):
+        label = ",".join("%s=%s" % (k, v is None and '*' or isinstance(v, list) and "|".join(v) or v)
+                         for k, v in sorted(filter.items()))
+        counts = set()
+        for way, fn in (('json', lambda: decoded(filter)),
+                        ('glob', lambda: selected(filter, False)),
+                        ('tag tables', lambda: selected(filter, True))):
+            elapsed, ids = min([timed(fn) for r in range(repeat)])
+            counts.add(len(ids))
+            print "tags %-30s %-22s %-11s %8.4fs %6d ways" % (name, label, way, elapsed, len(ids))
+        assert len(counts) == 1
+    for index in (False, True):
+        db.tag_index = index
+        elapsed, counts = min([timed(db.tag_counts, 'highway') for r in range(repeat)])
+        print "tags %-30s %-22s %-11s %8.4fs %6d values" % (name, 'tag_counts(highway)', index and 'tag tables' or 'glob',
+                                                             elapsed, len(counts))
+
+def bench_cache(filename=test_file, dbname=bench_db, n=5000, hot=200, routes=200):
+    """nearest_way over n queries drawn from hot points near the ways, and 
+    the LineStrings of the segments of routes shortest paths, twice, with
+    the geometry cache off (size 0) and on."""
+    from pysmosis.geom.backend import linearref
+    db = ORM.OSMDB(dbname, overwrite=True)
+    db.populate(filename, accept_way=lambda way: 'highway' in way.tags, bulk=True, parser='iterparse', segment=True)
+    db.load_segment_index()
+    db.load_graph()
+    rnd = random.Random(0)
+    geoms = [s.geom for s in db.waysegments()]
+    points = [(x + rnd.uniform(-0.0002, 0.0002), y + rnd.uniform(-0.0002, 0.0002))
+              for x, y in [rnd.choice(rnd.choice(geoms)) for i in range(hot)]]
+    # a few points asked for most often
+    queries = [points[min(int(rnd.expovariate(8.0 / hot)), hot - 1)] for i in range(n)]
+    paths = []
+    while len(paths) < routes:
+        path = db.graph.shortest_path(rnd.choice(db.graph.nodes), rnd.choice(db.graph.nodes))
+        if path:
+            paths.append(path[2])
+    
+    cache = ORM.geometry_cache
+    name = os.path.basename(filename)
+    size = cache.size
+    for label, cache.size in (('off', 0), ('on', size)):
+        cache.clear()
+        before = cache.stats()
+        elapsed, _ = timed(lambda: [db.nearest_way(x, y) for x, y in queries])
+        print "cache %-30s %-3s %-12s %8.1fus/query" % (name, label, 'nearest_way', elapsed * 1e6 / n)
+        for route_pass in ('linestrings', 'again'):
+            elapsed, _ = timed(lambda: [[db.linestring(id, 'waysegment') for id in ids] for ids in paths])
+            print "cache %-30s %-3s %-12s %8.2fms/route" % (name, label, route_pass, elapsed * 1e3 / routes)
+        stats = cache.stats()
+        print "cache %-30s %-3s %d hits, %d misses, %d evictions, %d items, %.1fMB" % \
+            (name, label, stats['hits'] - before['hits'], stats['misses'] - before['misses'],
+             stats['evictions'] - before['evictions'], stats['items'], stats['nbytes'] / 1e6)
+    # what linestrings did before: read the record, decode it and build the LineString each time
+    def build(id):
+        return linearref.LineString(list(db.objects[ORM.WaySegment].get(id=id).geom), geographic=True)
+    elapsed, _ = timed(lambda: [[build(id) for id in ids] for ids in paths])
+    print "cache %-30s %-3s %-12s %8.2fms/route" % (name, '-', 'get+build', elapsed * 1e3 / routes)
+
+def bench_ormlite(n=20000, repeat=5):
+    """Per call cost of ormlite's create, get, query, save and delete, on 
+    the Foo and Bar records of ormlite.test(): the best of repeat rounds, 
+    each on a new database."""
+    from ormlite import Record, ID, INT, PickleField, ForeignKey, JSONField
+    class Foo(Record):
+        _fields_ = (ID('id'), INT('moo'), PickleField('pickle'))
+    class Bar(Record):
+        _fields_ = (ID('id'), ForeignKey('foo_id', Foo, 'id', 'bar_set'), JSONField('json_array', notnull=False))
+    calls = (('Foo.create', lambda i: Foo(id=i, moo=i % 7).create(autocommit=False)),
+             ('Bar.create', lambda i: Bar(id=i, foo_id=i, json_array=[i]).create(autocommit=False)),
+             ('Foo.get', lambda i: Foo.objects.get(id=i)),
+             ('Bar.get', lambda i: Bar.objects.get(id=i).json_array),
+             ('Foo.query', lambda i: Foo.objects.query(moo=i % 7, where=("id < ?", (i % 50,))).fetchall()),
+             ('Bar.save', lambda i: Bar(id=i, foo_id=i + 1, json_array=[i]).save()),
+             ('Bar.delete', lambda i: Bar(id=i).delete()))
+    best = {}
+    for r in range(repeat):
+        ormlite.open_connection(":memory:")
+        Foo.objects.createtable()
+        Bar.objects.createtable()
+        for name, fn in calls:
+            elapsed, _ = timed(lambda: [fn(i) for i in xrange(1, n + 1)])
+            best[name] = min(best.get(name, elapsed), elapsed)
+    for name, fn in calls:
+        print "ormlite %-12s %8.2fus/call" % (name, best[name] * 1e6 / n)
+
+benchmarks = {'load': bench_load,
+              'parsers': bench_parsers,
+              'workers': bench_workers,
+              'decompress': bench_decompress,
+              'geometry': bench_geometry,
+              'spatial': bench_spatial,
+              'nearest_way': bench_nearest_way,
+              'batch': bench_batch,
+              'segment': bench_segment,
+              'nodecache': bench_nodecache,
+              'nodes': bench_nodes,
+              'stream': bench_stream,
+              'concurrency': bench_concurrency,
+              'graph': bench_graph,
+              'snapshot': bench_snapshot,
+              'match': bench_match,
+              'tags': bench_tags,
+              'cache': bench_cache,
+              'ormlite': bench_ormlite}
+
+if __name__ == '__main__':
+    name = len(sys.argv) > 1 and sys.argv[1] or 'load'
+    if name == 'ormlite':
+        bench_ormlite()
+        sys.exit()
+    files = sys.argv[2:] or [test_file, synthetic_file(100)]
+    for f in files:
+        benchmarks[name](f)
@@ -0,0 +1,185 @@
+"""
+Decompressing readers for OSM input files.
+
+open_osmfile returns a file-like object for plain, .gz and .bz2 files.
+Compressed data is decoded ahead of the reader, and handed over through a
+bounded queue, so decompression overlaps with parsing.  Multistream .bz2
+files (as written by pbzip2 and used for the planet dumps) are split at
+their stream headers and the streams are decoded in a process pool; single
+stream files are decoded in one background thread.
+"""
+import os
+import re
+import bz2
+import zlib
+import mmap
+import threading
+import multiprocessing
+from Queue import Queue
+from collections import deque
+from itertools import islice
+
+# "BZh" + block size, followed by the first block's magic (pi in BCD)
+BZ2_STREAM_START = re.compile(r"BZh[1-9]1AY&SY")
+READ_SIZE = 1 << 20
+
+def is_compressed(filename):
+    return filename.endswith(".bz2") or filename.endswith(".gz")
+
+def bz2_streams(filename):
+    """Returns (start, end) byte ranges of the independent streams in a .bz2 file."""
+    f = open(filename, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+        f.close()
+        return []
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    starts = [s.start() for s in BZ2_STREAM_START.finditer(m)]
+    m.close()
+    f.close()
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return zip(starts, starts[1:] + [size])
+
+def _decompress_range(args):
+    filename, start, end = args
+    f = open(filename, 'rb')
+    f.seek(start)
+    data = f.read(end - start)
+    f.close()
+    return bz2.decompress(data)
+
+class QueueReader(object):
+    """A read-only file object over the byte strings put on a queue; None
+    marks the end of the data and an exception is re-raised on read.  Reads
+    return at most one queued string at a time."""
+    def __init__(self, queue):
+        self.queue = queue
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+
+    def _fill(self):
+        while not self.eof and self.pos >= len(self.buf):
+            data = self.queue.get()
+            if data is None:
+                self.eof = True
+            elif isinstance(data, Exception):
+                self.eof = True
+                raise data
+            else:
+                self.buf = data
+                self.pos = 0
+        return self.pos < len(self.buf)
+
+    def read(self, size=-1):
+        if size < 0:
+            parts = []
+            while self._fill():
+                parts.append(self.buf[self.pos:])
+                self.pos = len(self.buf)
+            data = ''.join(parts)
+        elif self._fill():
+            data = self.buf[self.pos:self.pos + size]
+            self.pos += len(data)
+        else:
+            data = ''
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.eof = True
+        self.buf = ''
+
+def _feed(queue, chunks):
+    try:
+        for data in chunks:
+            queue.put(data)
+        queue.put(None)
+    except Exception, e:
+        queue.put(e)
+
+def _read_bz2(filename):
+    f = open(filename, 'rb')
+    d = bz2.BZ2Decompressor()
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            try:
+                out = d.decompress(data)
+            except EOFError:
+                # the last stream ended exactly at the end of a read
+                d = bz2.BZ2Decompressor()
+                continue
+            if out:
+                yield out
+            # multistream files: start over on what is left
+            data = d.unused_data
+            if data:
+                d = bz2.BZ2Decompressor()
+    f.close()
+
+def _read_gz(filename):
+    f = open(filename, 'rb')
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            out = d.decompress(data)
+            if out:
+                yield out
+            # concatenated gzip members: start over on what is left
+            data = d.unused_data
+            if data:
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    out = d.flush()
+    if out:
+        yield out
+    f.close()
+
+def _pool_chunks(pool, filename, streams, in_flight):
+    """Decodes streams in pool, in order, with at most in_flight of them
+    submitted ahead of the consumer, so that a slow reader holds the pool
+    back rather than letting decoded streams pile up."""
+    streams = iter(streams)
+    pending = deque()
+    try:
+        for start, end in islice(streams, in_flight):
+            pending.append(pool.apply_async(_decompress_range, ((filename, start, end),)))
+        while pending:
+            data = pending.popleft().get()
+            for start, end in islice(streams, 1):
+                pending.append(pool.apply_async(_decompress_range, ((filename, start, end),)))
+            yield data
+    finally:
+        pool.terminate()
+
+def open_osmfile(filename, workers=None, queue_size=16):
+    """Opens filename for reading, decompressing .bz2 and .gz input.
+
+    At most queue_size decoded chunks are buffered ahead of the reader.
+    workers is the size of the process pool used for multistream .bz2
+    files (default: one per cpu), which decodes at most two streams per 
+    worker ahead of the queue."""
+    if not is_compressed(filename):
+        return open(filename, 'rb')
+    if filename.endswith(".gz"):
+        chunks = _read_gz(filename)
+    else:
+        streams = bz2_streams(filename)
+        workers = workers or multiprocessing.cpu_count()
+        if len(streams) > 1 and workers > 1:
+            workers = min(workers, len(streams))
+            chunks = _pool_chunks(multiprocessing.Pool(workers), filename, streams, 2 * workers)
+        else:
+            chunks = _read_bz2(filename)
+    queue = Queue(maxsize=queue_size)
+    feeder = threading.Thread(target=_feed, args=(queue, chunks))
+    feeder.daemon = True
+    feeder.start()
+    return QueueReader(queue)
@@ -2,21 +2,468 @@ import xml.sax
 #import bsddb3 as bsddb
 import sqlite3
 import os
-import bz2
-from ORM import Way, WaySegment, Node
+import re
+import time
+import mmap
+import struct
+import tempfile
+import multiprocessing
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+import simplejson as json
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from ORM import Way, WaySegment, Node, TAG_TABLES
+from ormlite import pack_coords, pack_ints, unpack, INT64
+import decompress
+
+OSMNode = namedtuple('OSMNode', 'id lat lon tags')
+OSMWay = namedtuple('OSMWay', 'id nds tags')
+
+
+class Progress(object):
+    """Tracks element counts during an import and reports throughput."""
+    def __init__(self, reporter=None, every=10000):
+        self.reporter = reporter
+        self.every = every
+        self.elements = 0
+        self.nodes = 0
+        self.ways = 0
+        self.started = time.time()
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return elapsed > 0 and self.elements / elapsed or 0.0
+
+    def tick(self, n=1):
+        self.elements += n
+        if self.reporter and self.elements // self.every != (self.elements - n) // self.every:
+            self.reporter.write("Processed %d tags (%.0f elements/sec)\n" % (self.elements, self.rate()))
+
+    def report(self, msg):
+        if self.reporter:
+            self.reporter.write("%s: %d nodes, %d ways (%.0f elements/sec)\n" % (msg, self.nodes, self.ways, self.rate()))
+
+    def done(self):
+        if self.reporter:
+            self.reporter.write("Loaded %d nodes, %d ways in %.2fs (%.0f elements/sec)\n" % \
+                                (self.nodes, self.ways, time.time() - self.started, self.rate()))
+
+
+class BulkInserter(object):
+    """Buffers records of one Record class and writes them with bulk_create,
+    leaving the commit to the caller."""
+    def __init__(self, conn, rclass):
+        self.conn = conn
+        self.rclass = rclass
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, record):
+        self.rows.append(record)
+
+    def flush(self):
+        n = self.rclass.objects.bulk_create(self.rows, conn=self.conn, commit=False)
+        self.rows = []
+        return n
+
+
+class TagWriter(object):
+    """Writes the tags of nodes and ways to the tag tables (see ORM.TAG_SCHEMA):
+    keys and values are interned in tag_keys and tag_values, with their ids 
+    kept in memory, and each tag is buffered as a row of node_tag_ids or 
+    way_tag_ids until flush, which leaves the commit to the caller."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.keys = dict((k, id) for id, k in conn.execute("SELECT id, k FROM tag_keys"))
+        self.values = dict((v, id) for id, v in conn.execute("SELECT id, v FROM tag_values"))
+        self.new_keys = []
+        self.new_values = []
+        self.rows = dict((table, []) for table in TAG_TABLES)
+    
+    def __len__(self):
+        return sum([len(rows) for rows in self.rows.values()])
     
+    def _intern(self, ids, new, s):
+        id = ids.get(s)
+        if id is None:
+            id = ids[s] = len(ids) + 1
+            new.append((id, s))
+        return id
+    
+    def add(self, table, id, tags):
+        """Adds the tags dict of row id of table, nodes or ways."""
+        rows = self.rows[table]
+        for k, v in tags.iteritems():
+            rows.append((id, self._intern(self.keys, self.new_keys, k), self._intern(self.values, self.new_values, v)))
+    
+    def delete(self, table, ids):
+        """Deletes the tags of the rows of table with ids."""
+        list(execute_in(self.conn, "DELETE FROM %s WHERE id IN (%%s)" % TAG_TABLES[table], ids))
+    
+    def flush(self):
+        """Writes the buffered tags and new keys and values; returns the number
+        of tags written."""
+        self.conn.executemany("INSERT INTO tag_keys (id, k) VALUES (?, ?)", self.new_keys)
+        self.conn.executemany("INSERT INTO tag_values (id, v) VALUES (?, ?)", self.new_values)
+        self.new_keys, self.new_values = [], []
+        count = 0
+        for table, rows in self.rows.items():
+            self.conn.executemany("INSERT INTO %s (id, key_id, value_id) VALUES (?, ?, ?)" % TAG_TABLES[table], rows)
+            count += len(rows)
+            self.rows[table] = []
+        return count
+
+class RefCounter(object):
+    """Counts the number of ways referencing each node id.
+
+    Counts are accumulated in a dict.  If max_entries is given, the dict is
+    merged into an on-disk sqlite table (at spill_path, or a temporary file)
+    whenever it holds that many ids, so the id space does not need to fit in
+    memory."""
+    def __init__(self, max_entries=None, spill_path=None):
+        self.max_entries = max_entries
+        self.spill_path = spill_path
+        self.counts = {}
+        self.spill = None
+
+    def add(self, ids):
+        counts = self.counts
+        for i in ids:
+            counts[i] = counts.get(i, 0) + 1
+        if self.max_entries and len(counts) >= self.max_entries:
+            self._spill()
+
+    def get(self, id):
+        cnt = self.counts.get(id, 0)
+        if self.spill:
+            row = self.spill.execute("SELECT cnt FROM refs WHERE id = ?", (id,)).fetchone()
+            if row:
+                cnt += row[0]
+        return cnt
+
+    def _spill(self):
+        if not self.spill:
+            if not self.spill_path:
+                fd, self.spill_path = tempfile.mkstemp(suffix=".refs.sqlite")
+                os.close(fd)
+            self.spill = sqlite3.connect(self.spill_path)
+            self.spill.execute("PRAGMA synchronous=OFF")
+            self.spill.execute("CREATE TABLE IF NOT EXISTS refs (id INTEGER PRIMARY KEY, cnt INTEGER DEFAULT 0)")
+        items = sorted(self.counts.items())
+        self.spill.executemany("INSERT OR IGNORE INTO refs (id, cnt) VALUES (?, 0)", [(i,) for i, c in items])
+        self.spill.executemany("UPDATE refs SET cnt = cnt + ? WHERE id = ?", [(c, i) for i, c in items])
+        self.spill.commit()
+        self.counts = {}
+
+    def items(self):
+        """Yields (node id, count) pairs in id order."""
+        if self.spill:
+            if self.counts:
+                self._spill()
+            for row in self.spill.execute("SELECT id, cnt FROM refs ORDER BY id"):
+                yield row
+        else:
+            for row in sorted(self.counts.items()):
+                yield row
+
+    def write_refcounts(self, conn, table='nodes', column='refcount'):
+        """Adds the counts to table.column in one pass, ordered by id, so that
+        the references of files loaded one after another add up."""
+        conn.executemany("UPDATE %s SET %s = %s + ? WHERE id = ?" % (table, column, column),
+                         ((c, i) for i, c in self.items()))
+        conn.commit()
+
+    def write_node_refs(self, conn):
+        """Writes the counts to the node_refs table used by segment_ways."""
+        conn.execute("CREATE TABLE IF NOT EXISTS node_refs (id INTEGER PRIMARY KEY, cnt INTEGER DEFAULT 0)")
+        conn.executemany("INSERT OR REPLACE INTO node_refs (id, cnt) VALUES (?, ?)", self.items())
+        conn.commit()
+
+    def close(self):
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+            os.remove(self.spill_path)
+        self.counts = {}
+
+
+def iter_osm(osmfile, 
+             accept_tag=lambda k,v: k.startswith('tiger') and (None,None) or (k,v),
+             chunk_size=10000):
+    """Streams an OSM xml file as lists of up to chunk_size OSMNode and OSMWay
+    tuples, in file order.  Elements are cleared once read, so memory use does
+    not grow with the size of the file."""
+    context = iterparse(osmfile, events=('start', 'end'))
+    event, root = next(context)
+    chunk = []
+    for event, elem in context:
+        if event == 'start':
+            continue
+        name = elem.tag
+        if name in ('node', 'way'):
+            chunk.append(osm_element(elem, accept_tag))
+        elif name in ('nd', 'tag'):
+            continue
+        root.clear()
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def osm_element(elem, accept_tag):
+    """The OSMNode or OSMWay for a node or way element.  The coordinates of a
+    node without them (as in some deletes) are None."""
+    tags = {}
+    for t in elem.iterfind('tag'):
+        k, v = accept_tag(t.get('k'), t.get('v'))
+        if k:
+            tags[k] = v
+    if elem.tag == 'way':
+        return OSMWay(int(elem.get('id')), [int(nd.get('ref')) for nd in elem.iterfind('nd')], tags)
+    lat, lon = elem.get('lat'), elem.get('lon')
+    return OSMNode(int(elem.get('id')), lat and float(lat), lon and float(lon), tags)
+
+def iter_osmchange(oscfile, 
+                   accept_tag=lambda k,v: k.startswith('tiger') and (None,None) or (k,v)):
+    """Streams an OSM change file as (action, element) pairs, in file order:
+    action is 'create', 'modify' or 'delete', and element an OSMNode or 
+    OSMWay.  Relations are skipped."""
+    context = iterparse(oscfile, events=('start', 'end'))
+    event, root = next(context)
+    action = None
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ('create', 'modify', 'delete'):
+                action = elem.tag
+            continue
+        if elem.tag in ('node', 'way'):
+            yield action, osm_element(elem, accept_tag)
+            elem.clear()
+        elif elem.tag == 'relation':
+            elem.clear()
+        elif elem.tag in ('create', 'modify', 'delete'):
+            root.clear()
+
+# the columns of the node and way rows written during a load
+NODE_COLUMNS = ('id', 'lat', 'lon', 'tags', 'refcount')
+WAY_COLUMNS = ('id', 'nds', 'tags', 'geom')
+
+def chunk_rows(chunk, accept_way):
+    """Turns a chunk from iter_osm into (element count, node rows, way rows, 
+    node id lists of the accepted ways, (table, id, tags) of the tagged 
+    nodes and accepted ways)."""
+    nodes = []
+    ways = []
+    nds = []
+    tags = []
+    for el in chunk:
+        if type(el) is OSMNode:
+            nodes.append((el.id, el.lat, el.lon, json.dumps(el.tags), 0))
+            if el.tags:
+                tags.append(('nodes', el.id, el.tags))
+        elif accept_way(el):
+            # as a str rather than a buffer, which does not pickle
+            ways.append((el.id, str(pack_ints(el.nds)), json.dumps(el.tags)))
+            nds.append(el.nds)
+            if el.tags:
+                tags.append(('ways', el.id, el.tags))
+    return len(chunk), nodes, ways, nds, tags
+
+ELEMENT_START = re.compile(r"<(node|way|relation)[\s/>]")
+
+def split_osmfile(filename, parts):
+    """Splits an uncompressed OSM file into at most parts (start, end) byte 
+    ranges.  Every range but the first begins at a top-level element."""
+    size = os.path.getsize(filename)
+    f = open(filename, 'rb')
+    bounds = [0]
+    for i in range(1, parts):
+        pos = max(size * i // parts, bounds[-1])
+        f.seek(pos)
+        while True:
+            block = f.read(1 << 16)
+            m = ELEMENT_START.search(block)
+            if m or len(block) < (1 << 16):
+                break
+            # step back a little, in case the tag straddles the block boundary
+            pos += len(block) - 16
+            f.seek(pos)
+        if not m:
+            break
+        if pos + m.start() > bounds[-1]:
+            bounds.append(pos + m.start())
+    f.close()
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+class RangeReader(object):
+    """A file-like view of bytes [start, end) of an OSM file.  Unless the range
+    covers the start or the end of the file, it is wrapped in the file's 
+    <osm> header and a closing </osm>, so that it parses as a document."""
+    def __init__(self, filename, start, end):
+        self.f = open(filename, 'rb')
+        size = os.fstat(self.f.fileno()).st_size
+        self.prefix = ''
+        if start > 0:
+            head = self.f.read(1 << 16)
+            self.prefix = head[:ELEMENT_START.search(head).start()]
+        self.suffix = end < size and '</osm>\n' or ''
+        self.f.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if self.prefix:
+            data, self.prefix = self.prefix, ''
+            return data
+        if self.remaining > 0:
+            data = self.f.read(size < 0 and self.remaining or min(size, self.remaining))
+            self.remaining -= len(data)
+            if data:
+                return data
+            self.remaining = 0
+        data, self.suffix = self.suffix, ''
+        return data
+
+    def close(self):
+        self.f.close()
+
+def parallel_batches(osmfile, workers, accept_way, accept_tag, chunk_size=10000):
+    """Parses osmfile in worker processes, yielding the same batches as 
+    chunk_rows as they arrive.
+
+    osmfile may be a filename, which is split into byte ranges with 
+    split_osmfile, or a list of filenames (e.g. a split extract), which are
+    parsed one per task.  Compressed files are never split, and are decoded
+    in a background thread of the worker that parses them.  The workers are
+    forked, so accept_way and accept_tag do not need to be picklable."""
+    if isinstance(osmfile, basestring):
+        osmfile = [osmfile]
+    tasks = []
+    for filename in osmfile:
+        if decompress.is_compressed(filename):
+            tasks.append((filename, None, None))
+        else:
+            tasks.extend([(filename, start, end) for start, end in 
+                          split_osmfile(filename, max(1, workers // len(osmfile)))])
+    workers = min(workers, len(tasks))
+    queue = multiprocessing.Queue(maxsize=workers * 4)
+
+    def work(mytasks):
+        try:
+            for filename, start, end in mytasks:
+                if start is None:
+                    f = decompress.open_osmfile(filename, workers=1)
+                else:
+                    f = RangeReader(filename, start, end)
+                for chunk in iter_osm(f, accept_tag, chunk_size=chunk_size):
+                    queue.put(chunk_rows(chunk, accept_way))
+                f.close()
+            queue.put(None)
+        except Exception:
+            import traceback
+            queue.put(traceback.format_exc())
+
+    procs = [multiprocessing.Process(target=work, args=(tasks[i::workers],)) for i in range(workers)]
+    for p in procs:
+        p.daemon = True
+        p.start()
+    running = workers
+    while running:
+        batch = queue.get()
+        if batch is None:
+            running -= 1
+        elif isinstance(batch, basestring):
+            for p in procs:
+                p.terminate()
+            raise ParseWorkerError(batch)
+        else:
+            yield batch
+    for p in procs:
+        p.join()
+
+def table_checksum(conn, table, order_by='id', columns='*'):
+    """Returns (row count, md5 hex digest) over the rows of table, in order_by 
+    order, for comparing the results of two imports."""
+    import hashlib
+    h = hashlib.md5()
+    count = 0
+    for row in conn.execute("SELECT %s FROM %s ORDER BY %s" % (columns, table, order_by)):
+        h.update(repr([type(v) == buffer and str(v) or v for v in row]))
+        count += 1
+    return count, h.hexdigest()
+
 def load_osmfile(conn, osmfile, 
               accept_way=lambda way: 'highway' in way.tags,
               accept_tag=lambda k,v: k.startswith('tiger') and (None,None) or (k,v),
-              reporter=None):
+              reporter=None, bulk=False, batch_size=50000,
+              refcounter=None, node_refs=False, parser='sax', workers=1,
+              decompress_workers=None, node_cache=None, tags=False):
+    """Loads an OSM xml file into the nodes and ways tables.
+
+    By default every element is written and committed as it is parsed.  With
+    bulk=True, nodes and ways are buffered and written with executemany, and
+    a transaction is committed once per batch_size elements.
+
+    parser='iterparse' reads the file with iter_osm instead of xml.sax, and
+    writes rows straight from its tuples without building Records; it always
+    writes in bulk.  With workers > 1, or a list of files, parsing is spread
+    over that many processes (see parallel_batches) and this process only
+    writes.
+
+    .bz2 and .gz files are read through decompress.open_osmfile, which
+    decodes multistream .bz2 files in a pool of decompress_workers processes.
+
+    Node reference counts are accumulated in refcounter (a RefCounter is 
+    created if none is given) and written to nodes.refcount once the file
+    has been read; with node_refs=True they are also written to node_refs.
+    
+    Given a NodeCache, node_cache, the coordinates and reference counts of 
+    the nodes are stored in it too, for populate_way_geom and segment_ways.
+    
+    With tags=True the tags are also written to the tag tables, which must
+    exist, with a TagWriter flushed as the nodes and ways are."""
         
     cur = conn.cursor()
     cur.execute('PRAGMA synchronous=OFF;')
+    progress = Progress(reporter)
+    node_buffer = BulkInserter(conn, Node)
+    way_buffer = BulkInserter(conn, Way)
+    owns_refcounter = refcounter is None
+    if owns_refcounter:
+        refcounter = RefCounter()
+    tag_writer = None
+    if tags:
+        tag_writer = TagWriter(conn)
+
+    def flush():
+        progress.nodes += node_buffer.flush()
+        progress.ways += way_buffer.flush()
+        if tag_writer is not None:
+            tag_writer.flush()
+        conn.commit()
+        progress.report("Flushed")
+    
+    def flush_tags():
+        # without bulk, the records are committed one by one and their tags
+        # a batch at a time
+        if tag_writer is not None and len(tag_writer) >= batch_size:
+            tag_writer.flush()
+            conn.commit()
     
     class FastOSMHandler(xml.sax.ContentHandler):
         object = None
         is_way = False
-        counter = 0
         
         @classmethod
         def setDocumentLocator(self,loc):
@@ -58,109 +505,670 @@ def load_osmfile(conn, osmfile,
                 return 
             
             elif self.is_way and name=='nd':
-                self.object.nds.append(attrs['ref'])
+                self.object.nds.append(int(attrs['ref']))
                 return
             
         @classmethod
         def endElement(self,name):
-            self.counter += 1
-            if reporter and self.counter % 10000 == 0:
-                reporter.write("Processed %d tags\n" % self.counter)
+            progress.tick()
             if name == 'node':
                 self.object.tags = self.object.tags 
-                self.object.create(autocommit=True)
+                if node_cache is not None:
+                    node_cache.add(self.object.id, self.object.lon, self.object.lat)
+                if tag_writer is not None and self.object.tags:
+                    tag_writer.add('nodes', self.object.id, self.object.tags)
+                if bulk:
+                    node_buffer.add(self.object)
+                    if len(node_buffer) >= batch_size:
+                        flush()
+                else:
+                    self.object.create(autocommit=True, conn=conn)
+                    progress.nodes += 1
+                    flush_tags()
                 self.object = None
                 return
 
             elif name == 'way':
                 if accept_way(self.object):
                     #print self.object._fields_
+                    # the lists were mutated in place, so reassign them to serialize
                     self.object.tags = self.object.tags 
-                    self.object.create(autocommit=False)
-                    cur.execute("UPDATE nodes set refcount = refcount + 1 where id in (%s)" % ",".join(self.object.nds))                        
-                    conn.commit()
+                    self.object.nds = self.object.nds
+                    refcounter.add(set(self.object.nds))
+                    if tag_writer is not None and self.object.tags:
+                        tag_writer.add('ways', self.object.id, self.object.tags)
+                    if bulk:
+                        way_buffer.add(self.object)
+                        if len(node_buffer) + len(way_buffer) >= batch_size:
+                            flush()
+                    else:
+                        self.object.create(autocommit=True, conn=conn)
+                        progress.ways += 1
+                        flush_tags()
                 self.object = None
                 return
             
-    if type(osmfile) == str and osmfile.endswith("bz2"):
-        osmfile = bz2.BZ2File(osmfile,"r")
-    xml.sax.parse(osmfile, FastOSMHandler)
+    if workers <= 1 and type(osmfile) == str and decompress.is_compressed(osmfile):
+        osmfile = decompress.open_osmfile(osmfile, workers=decompress_workers)
+    if workers > 1 or isinstance(osmfile, list) or parser == 'iterparse':
+        if workers > 1 or isinstance(osmfile, list):
+            batches = parallel_batches(osmfile, max(workers, 1), accept_way, accept_tag, chunk_size=batch_size)
+        else:
+            batches = (chunk_rows(chunk, accept_way) for chunk in iter_osm(osmfile, accept_tag, chunk_size=batch_size))
+        no_geom = pack_coords([])
+        for elements, nodes, ways, nds, tagged in batches:
+            Node.objects.bulk_create(nodes, columns=NODE_COLUMNS, conn=conn, commit=False)
+            Way.objects.bulk_create([(id, buffer(packed), way_tags, no_geom) for id, packed, way_tags in ways],
+                                    columns=WAY_COLUMNS, conn=conn, commit=False)
+            if tag_writer is not None:
+                for table, id, el_tags in tagged:
+                    tag_writer.add(table, id, el_tags)
+                tag_writer.flush()
+            conn.commit()
+            if node_cache is not None:
+                for id, lat, lon, node_tags, refcount in nodes:
+                    node_cache.add(id, lon, lat)
+            for way_nds in nds:
+                refcounter.add(set(way_nds))
+            progress.tick(elements)
+            progress.nodes += len(nodes)
+            progress.ways += len(ways)
+            progress.report("Flushed")
+    else:
+        xml.sax.parse(osmfile, FastOSMHandler)
+        if bulk or tag_writer is not None:
+            flush()
+    refcounter.write_refcounts(conn)
+    if node_cache is not None:
+        node_cache.set_refcounts(refcounter.items())
+    if node_refs:
+        refcounter.write_node_refs(conn)
+    if owns_refcounter:
+        refcounter.close()
+    progress.done()
     return conn
 
-    
-def segment_ways(conn, reporter=None):
-    cur = conn.cursor()
-    
-    counter = 0
-    totalways = 0
-    if reporter:
-        waycount = cur.execute("select count(id) from way").fetchone()[0]
-        reporter.write("Segmenting %d ways\n" % waycount)
-    seq = []
-    seq_num = 0
+
+def execute_in(conn, sql, ids, chunk_size=10000):
+    """Runs sql, whose "%s" is filled with a comma separated chunk of the 
+    integer ids, for chunk_size ids at a time, yielding each chunk's rows."""
+    ids = sorted(ids)
+    for i in xrange(0, len(ids), chunk_size):
+        yield conn.execute(sql % ",".join(map(str, ids[i:i+chunk_size]))).fetchall()
+
+def populate_way_geom(conn, batch_size=1000, reporter=None, nodes=None, way_ids=None):
+    """Builds ways.geom, as (lon, lat) pairs, and the way bounding boxes from 
+    the nodes each way references.  Nodes missing from the file are skipped.
+    The coordinates are looked up in nodes (a NodeCache or NodeTable) if it
+    is given, otherwise queried from the nodes table a batch at a time.
+    way_ids limits it to those ways."""
+    if reporter: reporter.write("Building way geometry...\n")
+    if way_ids is None:
+        cur = conn.cursor().execute("SELECT id, nds FROM ways")
+        batches = iter(lambda: cur.fetchmany(batch_size), [])
+    else:
+        batches = execute_in(conn, "SELECT id, nds FROM ways WHERE id IN (%s)", way_ids, batch_size)
+    count = 0
+    for batch in batches:
+        batch = [(id, unpack(nds)) for id, nds in batch]
+        ids = set([n for id, nds in batch for n in nds])
+        coords = {}
+        if nodes is None:
+            for id, lat, lon in conn.execute("SELECT id, lat, lon FROM nodes WHERE id IN (%s)" % ",".join(map(str, ids))):
+                coords[id] = (lon, lat)
+        else:
+            for id, (lon, lat, refcount) in nodes.lookup(ids).iteritems():
+                coords[id] = (lon, lat)
+        rows = []
+        for id, nds in batch:
+            geom = [coords[n] for n in nds if n in coords]
+            if not geom:
+                rows.append((pack_coords([]), None, None, None, None, id))
+                continue
+            xs = [x for x, y in geom]
+            ys = [y for x, y in geom]
+            rows.append((pack_coords(geom), min(xs), min(ys), max(xs), max(ys), id))
+        Way.objects.bulk_update(rows, columns=('geom', 'left', 'bottom', 'right', 'top'), conn=conn, commit=False)
+        count += len(rows)
+    conn.commit()
+    if reporter: reporter.write("Built geometry for %d ways\n" % count)
+
+def count_node_refs(conn, refcounter=None, reporter=None):
+    """Fills node_refs from the legacy way_nodes table."""
+    if reporter: reporter.write("Counting node refs...\n")
+    owns_refcounter = refcounter is None
+    if owns_refcounter:
+        refcounter = RefCounter()
     way_id = None
-    start_node = None
-    end_node = None
-
-    l = float('inf')
-    b = float('inf')
-    r = -float('inf')
-    t = -float('inf')
-    tup = None
-    
-    for wid, nid, lat, lng, cnt in conn.cursor().execute("select ways.id, nodes.id, nodes.latitude, nodes.longitude, node_refs.cnt from ways "
-                                               "join way_nodes on ways.id = way_nodes.id "
-                                               "join nodes on nodes.id = way_nodes.node_id "
-                                               "join node_refs on way_nodes.node_id = node_refs.id "
-                                               "order by ways.id, way_nodes.sequence_id"):
-
-        tup = None
-        end_node = nid
+    nds = set()
+    for wid, nid in conn.cursor().execute("select id, node_id from way_nodes order by id"):
         if wid != way_id:
-            if way_id and len(seq) > 1:
-                tup = [way_id,seq_num,start_node,end_node, seq, l,b,r,t]
-                l = float('inf')
-                b = float('inf')
-                r = -float('inf')
-                t = -float('inf')
-            start_node = nid
-            seq_num = 0
+            refcounter.add(nds)
             way_id = wid
-            seq = [(lng, lat)]
-        elif cnt > 1: # intersection
-            seq.append((lng, lat))
-            tup = [way_id,seq_num,start_node,end_node,seq, l,b,r,t]
-            start_node = nid
-            seq_num += 1
-            seq = [(lng, lat)]
+            nds = set()
+        nds.add(nid)
+    refcounter.add(nds)
+    refcounter.write_node_refs(conn)
+    if owns_refcounter:
+        refcounter.close()
+    if reporter: reporter.write("Counted.\n")
+
+class NodeCache(object):
+    """Node coordinates and reference counts by node id, for building way 
+    geometry and segments during an import without querying the nodes table.
+
+    With layout='dense' each node has a fixed size slot at an offset given by
+    its id, so a lookup is O(1) and nodes can be added in any order.  With 
+    layout='sorted' nodes are appended as (id, lon, lat, refcount) records and
+    found by binary search; an in-memory index of every block_size'th id 
+    keeps the search within one block of records.  Records added out of id
+    order are sorted at the next lookup, in place: with numpy only the ids
+    and their sort order are held in memory besides the records, and a 
+    spilled buffer is sorted through a temporary memory-mapped file.
+
+    The records are kept in a bytearray until it would outgrow memory bytes
+    (None for no limit), then moved to a file at path, or a temporary file,
+    and memory-mapped, so the operating system pages them in and out.  The 
+    file is sparse: ids are scattered over a large range, and the dense 
+    layout only writes the pages holding nodes.  A dense buffer spills past
+    DENSE_MEMORY bytes even with no limit, and ids from MAX_DENSE_ID up 
+    are refused, as their slots would not fit any reasonable file.
+    
+    lookup() finds many nodes at once, with numpy when it is installed."""
+    DENSE = struct.Struct("=ddi")       # lon, lat, refcount + 1 (0: no node)
+    SORTED = struct.Struct("=qddi")     # id, lon, lat, refcount + 1
+    REFCOUNT = struct.Struct("=i")
+    ID = struct.Struct("=q")
+    DENSE_MEMORY = 64 << 20
+    MAX_DENSE_ID = 1 << 36
+    SORT_CHUNK = 1 << 16        # records copied at a time when sorting
+    
+    def __init__(self, layout='sorted', memory=256 << 20, path=None, block_size=64):
+        if layout not in ('dense', 'sorted'):
+            raise ValueError("unknown NodeCache layout %r" % layout)
+        self.layout = layout
+        self.memory = memory
+        self.path = path
+        self.block_size = block_size
+        self.record = layout == 'dense' and self.DENSE or self.SORTED
+        self.coord_offset = layout == 'sorted' and 8 or 0
+        self.buf = bytearray()
+        self.file = None
+        self.mapped = False
+        self.count = 0
+        self.index = array(INT64)   # sorted layout: first id of each block
+        self.last_id = None
+        self.ordered = True
+    
+    def __len__(self):
+        return self.count
+    
+    def _reserve(self, size):
+        """Makes the buffer at least size bytes, moving it to a file once it
+        would outgrow the memory budget."""
+        if size <= len(self.buf):
+            return
+        size = max(size, 2 * len(self.buf), mmap.PAGESIZE)
+        memory = self.memory
+        if memory is None and self.layout == 'dense':
+            memory = self.DENSE_MEMORY
+        if not self.mapped and (memory is None or size <= memory):
+            self.buf.extend(bytearray(size - len(self.buf)))
+            return
+        if not self.mapped:
+            if self.path:
+                self.file = open(self.path, "w+b")
+                self.owns_path = False
+            else:
+                self.file, self.path = _temp_file()
+                self.owns_path = True
+            # copy the records in use; a dense buffer's empty slots stay sparse 
+            used = self.layout == 'sorted' and self.count * self.record.size or len(self.buf)
+            self.file.write(buffer(self.buf, 0, used))
+            self.file.truncate(size)
+            self.file.flush()
+            self.buf = mmap.mmap(self.file.fileno(), size)
+            self.mapped = True
+        else:
+            self.buf.resize(size)
+    
+    def add(self, id, lon, lat):
+        if self.layout == 'dense':
+            if not 0 <= id < self.MAX_DENSE_ID:
+                raise ValueError("node id %d out of range for a dense NodeCache" % id)
+            offset = id * self.record.size
+            self._reserve(offset + self.record.size)
+            if not self.REFCOUNT.unpack_from(self.buf, offset + 16)[0]:
+                self.count += 1
+            self.record.pack_into(self.buf, offset, lon, lat, 1)
+            return
+        if self.last_id is not None and id < self.last_id:
+            self.ordered = False
+        offset = self.count * self.record.size
+        self._reserve(offset + self.record.size)
+        self.record.pack_into(self.buf, offset, id, lon, lat, 1)
+        if self.ordered and self.count % self.block_size == 0:
+            self.index.append(id)
+        self.count += 1
+        self.last_id = max(id, self.last_id)
+    
+    def _sort(self):
+        """Sorts the records by id, copying them in id order to a scratch 
+        buffer (a temporary file if the buffer is spilled, or two copies 
+        would not fit the memory budget) and back."""
+        size, count = self.record.size, self.count
+        used = count * size
+        if self.mapped or (self.memory is not None and 2 * used > self.memory):
+            scratch_file, scratch_path = _temp_file()
+            scratch_file.truncate(max(used, 1))
+            scratch = mmap.mmap(scratch_file.fileno(), max(used, 1))
+        else:
+            scratch_file, scratch = None, bytearray(used)
+        try:
+            if numpy is not None:
+                records = numpy.frombuffer(self.buf, SORTED_NODE_RECORD, count)
+                order = numpy.argsort(records['id'], kind='mergesort')
+                for start in xrange(0, count, self.SORT_CHUNK):
+                    chunk = records[order[start:start + self.SORT_CHUNK]].tostring()
+                    scratch[start * size:start * size + len(chunk)] = chunk
+                del records, order
+            else:
+                unpack_id, buf = self.ID.unpack_from, self.buf
+                order = sorted(xrange(count), key=lambda i: unpack_id(buf, i * size)[0])
+                for i, j in enumerate(order):
+                    scratch[i * size:(i + 1) * size] = buf[j * size:(j + 1) * size]
+                del order
+            for start in xrange(0, used, self.SORT_CHUNK * size):
+                end = min(start + self.SORT_CHUNK * size, used)
+                self.buf[start:end] = scratch[start:end]
+        finally:
+            if scratch_file is not None:
+                scratch.close()
+                scratch_file.close()
+                os.remove(scratch_path)
+        unpack_id = self.ID.unpack_from
+        self.index = array(INT64, [unpack_id(self.buf, i * size)[0] for i in xrange(0, count, self.block_size)])
+        self.ordered = True
+    
+    def _offset(self, id):
+        """Offset of node id's record in the buffer, or -1."""
+        size = self.record.size
+        if self.layout == 'dense':
+            offset = id * size
+            if id < 0 or offset + size > len(self.buf) or not self.REFCOUNT.unpack_from(self.buf, offset + 16)[0]:
+                return -1
+            return offset
+        if not self.ordered:
+            self._sort()
+        block = bisect_right(self.index, id) - 1
+        if block < 0:
+            return -1
+        lo = block * self.block_size
+        hi = min(lo + self.block_size, self.count)
+        buf, unpack_id = self.buf, self.ID.unpack_from
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if unpack_id(buf, mid * size)[0] < id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and unpack_id(buf, lo * size)[0] == id:
+            return lo * size
+        return -1
+    
+    def get(self, id):
+        """(lon, lat, refcount) of node id, or None if it is not in the cache."""
+        offset = self._offset(id)
+        if offset < 0:
+            return None
+        offset += self.coord_offset
+        lon, lat, refcount = self.DENSE.unpack_from(self.buf, offset)
+        return lon, lat, refcount - 1
+    
+    def lookup(self, ids):
+        """{id: (lon, lat, refcount)} for those of ids in the cache."""
+        if numpy is None or not self.count:
+            return _lookup(self, ids)
+        ids = numpy.fromiter(ids, numpy.int64)
+        if self.layout == 'dense':
+            records = numpy.frombuffer(self.buf, NODE_RECORD, len(self.buf) // self.record.size)
+            ids = ids[(ids >= 0) & (ids < len(records))]
+            found = records[ids]
+            ids, found = ids[found['refcount'] > 0], found[found['refcount'] > 0]
         else:
-            seq.append((lng, lat))
+            if not self.ordered:
+                self._sort()
+            records = numpy.frombuffer(self.buf, SORTED_NODE_RECORD, self.count)
+            i = numpy.minimum(numpy.searchsorted(records['id'], ids), self.count - 1)
+            found = records[i]
+            ids, found = ids[found['id'] == ids], found[found['id'] == ids]
+        return _node_dict(ids, found['lon'], found['lat'], found['refcount'] - 1)
+    
+    def set_refcounts(self, items):
+        """Stores (node id, count) pairs, e.g. RefCounter.items(); ids not in
+        the cache are ignored."""
+        pack, refcount = self.REFCOUNT.pack_into, self.coord_offset + 16
+        for id, cnt in items:
+            offset = self._offset(id)
+            if offset >= 0:
+                pack(self.buf, offset + refcount, cnt + 1)
+    
+    def close(self):
+        if self.mapped:
+            self.buf.close()
+            self.file.close()
+            if self.owns_path:
+                os.remove(self.path)
+                self.path = None
+        self.buf = bytearray()
+        self.file = None
+        self.mapped = False
+        self.count = 0
+        self.index = array(INT64)
+        self.last_id = None
+        self.ordered = True
 
-        l = min(l,lng)
-        b = min(b,lat)
-        r = max(r,lng)
-        t = max(t,lat)
-        
-        if tup:
-            tup[4] = "SRID=4326;LINESTRING(%s)" % ",".join(["%f %f" % c for c in tup[4]])
-            #print "Tup", tup
-            cur.execute("INSERT into way_segments (way_id,sequence_id,start_node_id,end_node_id,wkt,left,bottom,right,top) VALUES (?,?,?,?,?,?,?,?,?)", tup)
+class NodeTable(object):
+    """Node coordinates and reference counts, in arrays sorted by node id.
+    
+    Worker processes forked after it is built share its memory with the 
+    parent, rather than each querying the nodes table."""
+    def __init__(self, conn):
+        self.ids = array(INT64)
+        self.coords = array('d')  # lon, lat per node
+        self.refcounts = array('i')
+        for id, lon, lat, refcount in conn.execute("SELECT id, lon, lat, refcount FROM nodes ORDER BY id"):
+            self.ids.append(id)
+            self.coords.extend((lon, lat))
+            self.refcounts.append(refcount or 0)
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def get(self, id):
+        """(lon, lat, refcount) of node id, or None if it is not in the table."""
+        i = bisect_left(self.ids, id)
+        if i == len(self.ids) or self.ids[i] != id:
+            return None
+        return self.coords[2*i], self.coords[2*i+1], self.refcounts[i]
+    
+    def lookup(self, ids):
+        """{id: (lon, lat, refcount)} for those of ids in the table."""
+        if numpy is None or not self.ids:
+            return _lookup(self, ids)
+        ids = numpy.fromiter(ids, numpy.int64)
+        table = numpy.frombuffer(self.ids, numpy.int64)
+        i = numpy.minimum(numpy.searchsorted(table, ids), len(table) - 1)
+        i, ids = i[table[i] == ids], ids[table[i] == ids]
+        coords = numpy.frombuffer(self.coords, numpy.float64)
+        return _node_dict(ids, coords[2*i], coords[2*i+1], numpy.frombuffer(self.refcounts, numpy.int32)[i])
+
+def _temp_file():
+    """A temporary file for NodeCache records, and its path."""
+    fd, path = tempfile.mkstemp(suffix=".nodes")
+    return os.fdopen(fd, "w+b"), path
+
+# NodeCache records, as numpy dtypes
+NODE_RECORD = [('lon', '=f8'), ('lat', '=f8'), ('refcount', '=i4')]
+SORTED_NODE_RECORD = [('id', '=i8')] + NODE_RECORD
+
+def _lookup(nodes, ids):
+    found = {}
+    for id in ids:
+        node = nodes.get(id)
+        if node is not None:
+            found[id] = node
+    return found
+
+def _node_dict(ids, lons, lats, refcounts):
+    return dict(zip(ids.tolist(), zip(lons.tolist(), lats.tolist(), refcounts.tolist())))
+
+def split_way(way_id, nds, nodes):
+    """Splits a way into segments at its junctions: the nodes, other than its
+    ends, that another way references too or that the way passes more than 
+    once.  Nodes missing from nodes are skipped.  Returns rows of (way_id,
+    start_id, end_id, packed geometry, packed node ids, left, bottom, right,
+    top), with the packed values as strings."""
+    pts = []
+    for n in nds:
+        node = nodes.get(n)
+        if node is not None:
+            pts.append((n, node))
+    visits = {}
+    for n, node in pts:
+        visits[n] = visits.get(n, 0) + 1
+    
+    rows = []
+    start = 0
+    last = len(pts) - 1
+    for i in xrange(1, len(pts)):
+        n, (lon, lat, refcount) = pts[i]
+        if i < last and refcount <= 1 and visits[n] == 1:
+            continue
+        seg = pts[start:i+1]
+        coords = [(lon, lat) for n, (lon, lat, refcount) in seg]
+        xs = [x for x, y in coords]
+        ys = [y for x, y in coords]
+        rows.append((way_id, seg[0][0], n, str(pack_coords(coords)), str(pack_ints([n for n, node in seg])),
+                     min(xs), min(ys), max(xs), max(ys)))
+        start = i
+    return rows
+
+def _way_ranges(conn, ways_per_range):
+    """[lo, hi) way id ranges holding ways_per_range ways each."""
+    ids = [id for id, in conn.execute("SELECT id FROM ways ORDER BY id")]
+    if not ids:
+        return []
+    bounds = ids[::ways_per_range] + [ids[-1] + 1]
+    return zip(bounds, bounds[1:])
+
+def _segment_range(conn, lo, hi, nodes):
+    ways = [(id, unpack(nds)) for id, nds in conn.execute("SELECT id, nds FROM ways WHERE id >= ? AND id < ? ORDER BY id", (lo, hi))]
+    resolved = nodes.lookup(set([n for id, nds in ways for n in nds]))
+    rows = []
+    for id, nds in ways:
+        rows.extend(split_way(id, nds, resolved))
+    return rows
+
+# the node table and connection of a segment_ways worker process
+_segment_nodes = None
+_segment_conn = None
+
+def _segment_task(args):
+    global _segment_conn
+    dbname, lo, hi = args
+    if _segment_conn is None:
+        _segment_conn = sqlite3.connect(dbname)
+    return _segment_range(_segment_conn, lo, hi, _segment_nodes)
+
+def insert_segments(conn, rows):
+    """Writes rows from split_way to the WaySegment table."""
+    WaySegment.objects.bulk_create([row[:3] + (buffer(row[3]), buffer(row[4])) + row[5:] for row in rows],
+                                   columns=('way_id', 'start_id', 'end_id', 'geom', 'nds', 'left', 'bottom', 'right', 'top'),
+                                   conn=conn, commit=False)
+
+def segment_ways(conn, reporter=None, workers=1, ways_per_range=2000, nodes=None):
+    """Rebuilds the WaySegment table, splitting every way at its junctions 
+    (see split_way), with the geometry and node ids in the packed format.
+    
+    The ways are divided into id ranges of ways_per_range ways, which with 
+    workers > 1 are segmented in a pool of worker processes (for databases
+    on disk).  Node coordinates and reference counts come from nodes (a 
+    NodeCache, or a NodeTable built if none is given), which the workers 
+    inherit.  The segments are written in one executemany per range, in way
+    id order."""
+    global _segment_nodes
+    table = WaySegment._table_
+    if nodes is None:
+        if reporter: reporter.write("Loading node table...\n")
+        nodes = NodeTable(conn)
+    ranges = _way_ranges(conn, ways_per_range)
+    if reporter: reporter.write("Segmenting ways in %d ranges\n" % len(ranges))
+    
+    dbname = [row[2] for row in conn.execute("PRAGMA database_list") if row[1] == 'main'][0]
+    pool = None
+    if workers > 1 and dbname and len(ranges) > 1:
+        _segment_nodes = nodes
+        pool = multiprocessing.Pool(min(workers, len(ranges)))
+        batches = pool.imap(_segment_task, [(dbname, lo, hi) for lo, hi in ranges])
+    else:
+        batches = (_segment_range(conn, lo, hi, nodes) for lo, hi in ranges)
+    
+    count = 0
+    try:
+        conn.execute("DELETE FROM %s" % table)
+        # number the rebuilt segments from 1 again
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+        for rows in batches:
+            insert_segments(conn, rows)
+            count += len(rows)
+        conn.commit()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            _segment_nodes = None
+    if reporter: reporter.write("Derived %d segments\n" % count)
+    return count
 
-    # the  final one:
-    #print "Tup", tup
-    tup = (way_id, seq_num, start_node, end_node, 
-         "SRID=4326;LINESTRING(%s)" % ",".join(["%f %f" % c for c in seq]),
-         l,b,r,t)
-    cur.execute("INSERT into way_segments (way_id,sequence_id,start_node_id,end_node_id,wkt,left,bottom,right,top) VALUES (?,?,?,?,?,?,?,?,?)", tup)
+def resegment_ways(conn, way_ids):
+    """Replaces the segments of the ways in way_ids (dropping those of ways
+    no longer in the ways table), with nodes read from the nodes table.
+    Returns the number of segments written."""
+    list(execute_in(conn, "DELETE FROM %s WHERE way_id IN (%%s)" % WaySegment._table_, way_ids))
+    count = 0
+    for batch in execute_in(conn, "SELECT id, nds FROM ways WHERE id IN (%s) ORDER BY id", way_ids, 1000):
+        ways = [(id, unpack(nds)) for id, nds in batch]
+        nodes = {}
+        for rows in execute_in(conn, "SELECT id, lon, lat, refcount FROM nodes WHERE id IN (%s)",
+                               set([n for id, nds in ways for n in nds])):
+            for id, lon, lat, refcount in rows:
+                nodes[id] = (lon, lat, refcount or 0)
+        rows = []
+        for id, nds in ways:
+            rows.extend(split_way(id, nds, nodes))
+        insert_segments(conn, rows)
+        count += len(rows)
+    return count
+
+def ways_through(conn, points):
+    """Ids of the ways referencing any of points, (node id, lon, lat) triples 
+    giving each node's position when the ways' bounding boxes were built."""
+    sql = "SELECT id, nds FROM ways WHERE left <= ? AND right >= ? AND bottom <= ? AND top >= ?"
+    if conn.execute("SELECT count(*) FROM sqlite_master WHERE name = 'ways_rtree'").fetchone()[0]:
+        sql = "SELECT id, nds FROM ways WHERE id IN (SELECT id FROM ways_rtree WHERE left <= ? AND right >= ? AND bottom <= ? AND top >= ?)"
+    found = set()
+    for node_id, lon, lat in points:
+        for id, nds in conn.execute(sql, (lon, lon, lat, lat)):
+            if node_id in unpack(nds):
+                found.add(id)
+    return found
+
+def apply_osmchange(conn, oscfile, 
+                    accept_way=lambda way: 'highway' in way.tags,
+                    accept_tag=lambda k,v: k.startswith('tiger') and (None,None) or (k,v),
+                    reporter=None, segment=None, tags=False):
+    """Applies an OSM change file (.osc, which may be compressed) to a database
+    built by load_osmfile and populate_way_geom, leaving it as a full import
+    of the changed data would, with the same accept_way and accept_tag.
+    
+    Created and modified nodes and ways replace the stored ones, the way a 
+    change file lists last winning; ways accept_way rejects are dropped.  
+    Reference counts are adjusted by the ways' old and new node lists, and 
+    geometry rebuilt for the changed ways and the ways through moved or 
+    deleted nodes, found by their bounding boxes.  If the database has been
+    segmented (or segment=True), the segments of those ways, and of the 
+    ways through nodes whose reference counts changed, are rebuilt.  The 
+    R*Tree triggers keep the spatial indexes in step, and with tags=True 
+    the tag tables are too.  Returns a dict of the numbers of nodes and ways
+    changed and ways resegmented."""
+    if type(oscfile) == str and decompress.is_compressed(oscfile):
+        oscfile = decompress.open_osmfile(oscfile)
+    nodes = {}
+    ways = {}
+    for action, el in iter_osmchange(oscfile, accept_tag):
+        if type(el) is OSMNode:
+            nodes[el.id] = (action, el)
+        else:
+            ways[el.id] = (action, el)
+    if reporter: reporter.write("Applying changes to %d nodes and %d ways...\n" % (len(nodes), len(ways)))
+    if segment is None:
+        segment = conn.execute("SELECT count(*) FROM (SELECT 1 FROM %s LIMIT 1)" % WaySegment._table_).fetchone()[0] > 0
+    
+    # the stored state the changes replace
+    old_nds = {}
+    for rows in execute_in(conn, "SELECT id, nds FROM ways WHERE id IN (%s)", ways):
+        for id, nds in rows:
+            old_nds[id] = unpack(nds)
+    new_ways = [el for action, el in ways.values() if action != 'delete' and accept_way(el)]
+    deltas = {}
+    for nds in old_nds.values():
+        for n in set(nds):
+            deltas[n] = deltas.get(n, 0) - 1
+    for el in new_ways:
+        for n in set(el.nds):
+            deltas[n] = deltas.get(n, 0) + 1
+    deltas = dict((n, d) for n, d in deltas.items() if d)
+    positions = {}
+    for rows in execute_in(conn, "SELECT id, lon, lat FROM nodes WHERE id IN (%s)", set(nodes) | set(deltas)):
+        for id, lon, lat in rows:
+            positions[id] = (id, lon, lat)
+    moved = ways_through(conn, [positions[n] for n in nodes if n in positions])
+    rejoined = segment and ways_through(conn, [positions[n] for n in deltas if n in positions]) or set()
+    
+    upserts = [el for action, el in nodes.values() if action != 'delete']
+    conn.executemany("INSERT OR IGNORE INTO nodes (id, lat, lon, tags, refcount) VALUES (?, ?, ?, ?, 0)",
+                     [(el.id, el.lat, el.lon, json.dumps(el.tags)) for el in upserts])
+    conn.executemany("UPDATE nodes SET lat = ?, lon = ?, tags = ? WHERE id = ?",
+                     [(el.lat, el.lon, json.dumps(el.tags), el.id) for el in upserts])
+    Way.objects.bulk_delete(ways, conn=conn, commit=False)
+    no_geom = pack_coords([])
+    Way.objects.bulk_create([(el.id, pack_ints(el.nds), json.dumps(el.tags), no_geom) for el in new_ways],
+                            columns=WAY_COLUMNS, conn=conn, commit=False)
+    Node.objects.bulk_delete([id for id, (action, el) in nodes.items() if action == 'delete'], conn=conn, commit=False)
+    conn.executemany("UPDATE nodes SET refcount = refcount + ? WHERE id = ?", [(d, n) for n, d in deltas.items()])
+    if tags:
+        tag_writer = TagWriter(conn)
+        tag_writer.delete('nodes', nodes)
+        tag_writer.delete('ways', ways)
+        for el in upserts:
+            tag_writer.add('nodes', el.id, el.tags)
+        for el in new_ways:
+            tag_writer.add('ways', el.id, el.tags)
+        tag_writer.flush()
+    
+    changed = moved | set(el.id for el in new_ways)
+    populate_way_geom(conn, way_ids=changed)
+    resegmented = set()
+    if segment:
+        resegmented = changed | rejoined | set(ways)
+        resegment_ways(conn, resegmented)
+    conn.commit()
+    if reporter: reporter.write("Rebuilt %d ways, resegmented %d\n" % (len(changed), len(resegmented)))
+    return {'nodes': len(nodes), 'ways': len(ways), 'resegmented': len(resegmented)}
 
-    if reporter:
-        reporter.write("Derived %d segments\n" % cur.execute("select count(*) from way_segments").fetchone())
+def index_tags(conn, reporter=None, batch_size=50000):
+    """Writes the JSON tags of every node and way to the (empty) tag tables,
+    for databases loaded without them."""
+    tag_writer = TagWriter(conn)
+    for table in ('nodes', 'ways'):
+        if reporter: reporter.write("Indexing the tags of %s...\n" % table)
+        c = conn.execute("SELECT id, tags FROM %s WHERE tags IS NOT NULL AND tags != '{}'" % table)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            for id, tags in rows:
+                tag_writer.add(table, id, json.loads(tags))
+            tag_writer.flush()
+    if reporter: reporter.write("Indexed %d keys, %d values\n" % (len(tag_writer.keys), len(tag_writer.values)))
 
 def purge_intermediate_nodes(conn, reporter=None):
     if reporter: reporter.write("Deleting intermediate nodes...\n")
     c = conn.cursor()
     c.execute("DELETE from nodes where id not in (select start_node_id from way_segments) and id not in (select end_node_id from way_segments)")
-    c.execute("DELETE from node_tags where id not in (select start_node_id from way_segments) and id not in (select end_node_id from way_segments)")
+    for table in ('node_tags', TAG_TABLES['nodes']):
+        if c.execute("SELECT count(*) FROM sqlite_master WHERE name = ?", (table,)).fetchone()[0]:
+            c.execute("DELETE from %s where id not in (select id from nodes)" % table)
     if reporter: reporter.write("Deleted.\n")
 
 def purge_node_refs(conn, reporter=None):
@@ -197,3 +1205,6 @@ def create_ways_rtree_index(conn, reporter=None):
 
 class SQLiteFeatureNotSupported(Exception):
     pass
+
+class ParseWorkerError(Exception):
+    pass
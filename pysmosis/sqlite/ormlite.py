@@ -4,30 +4,318 @@ except ImportError:
     from pysqlite2 import dbapi2 as sqlite3
 
 import sys
+import threading
 import simplejson as json
 import cPickle as pickle
 from cStringIO import StringIO
+from array import array
+from itertools import islice, izip, imap
+from collections import namedtuple
+from operator import attrgetter
+from contextlib import contextmanager
 import pdb
 
 connection = None
 verbose = False
 reporter = sys.stdout
 
+class LRUCache(object):
+    """A mapping of at most size items which, when full, drops the least 
+    recently used.  A hit is a dict lookup; only an insert into a full cache
+    scans it.  Inserts take a lock, so that threads can share the cache 
+    (as the managers BaseManager.using makes share their SQL); hits do not,
+    and may leave a key's recency a tick behind."""
+    def __init__(self, size=64):
+        self.size = size
+        self.data = {}
+        self.tick = 0
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __contains__(self, key):
+        return key in self.data
+    
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        self.tick += 1
+        item[1] = self.tick
+        return item[0]
+    
+    def __setitem__(self, key, value):
+        data = self.data
+        with self.lock:
+            if key not in data and len(data) >= self.size:
+                del data[min(data, key=lambda k: data[k][1])]
+            self.tick += 1
+            data[key] = [value, self.tick]
+    
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+class ObjectCache(object):
+    """A cache of objects derived from rows, such as decoded field values or
+    objects built from them, which may be shared by several databases.  It
+    holds at most size objects, of at most nbytes bytes in all by the sizes
+    they are put with, and counts its hits, misses, evictions and 
+    invalidations.  It is thread safe.
+    
+    Like LRUCache, a hit is a dict lookup.  A put that overfills it drops
+    the least recently used objects, enough of them at once (down to 7/8 of
+    its bounds) that the sort this takes is paid for by many puts.
+    
+    An object is kept under a scope, which tells apart the databases and
+    kinds of object, and a row, the (table, primary key) of the row it was
+    derived from.  Records whose class has the cache as its _cache_ drop the
+    objects of their rows, in every scope, when saved or deleted; writes
+    which bypass the records must clear the scopes of their database."""
+    def __init__(self, size=10000, nbytes=64 << 20):
+        self.size = size
+        self.max_nbytes = nbytes
+        self.data = {}
+        self.scopes = set()
+        self.nbytes = 0
+        self.tick = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def get(self, scope, row, default=None):
+        with self.lock:
+            item = self.data.get((scope, row))
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.tick += 1
+            item[2] = self.tick
+            return item[0]
+    
+    def put(self, scope, row, value, nbytes):
+        """Keeps value, of about nbytes bytes, and returns it."""
+        key = (scope, row)
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                self.nbytes -= item[1]
+            self.scopes.add(scope)
+            self.tick += 1
+            self.data[key] = [value, nbytes, self.tick]
+            self.nbytes += nbytes
+            if len(self.data) > self.size or self.nbytes > self.max_nbytes:
+                self._evict()
+        return value
+    
+    def _evict(self):
+        data = self.data
+        size, nbytes = self.size * 7 // 8, self.max_nbytes * 7 // 8
+        for key in sorted(data, key=lambda k: data[k][2]):
+            if len(data) <= size and self.nbytes <= nbytes:
+                break
+            self.nbytes -= data.pop(key)[1]
+            self.evictions += 1
+    
+    def invalidate(self, row):
+        """Drops the objects derived from row."""
+        with self.lock:
+            for scope in self.scopes:
+                item = self.data.pop((scope, row), None)
+                if item is not None:
+                    self.nbytes -= item[1]
+                    self.invalidations += 1
+    
+    def clear(self, *scopes):
+        """Drops the objects of scopes, or every object."""
+        with self.lock:
+            if not scopes:
+                self.data.clear()
+                self.scopes.clear()
+                self.nbytes = 0
+                return
+            scopes = set(scopes)
+            for key in [key for key in self.data if key[0] in scopes]:
+                self.nbytes -= self.data.pop(key)[1]
+            self.scopes -= scopes
+    
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'items': len(self.data), 'nbytes': self.nbytes}
+
 def open_connection(filename, **kwargs):
+    """Opens the connection Records use.  sqlite3 keeps a cache of prepared
+    statements per connection, keyed by their SQL, which the fixed SQL of
+    each Record class hits."""
     global connection 
     connection = sqlite3.connect(filename, **kwargs)
     return connection
 
-def record_factory(cls, use_dict=False):
-    if use_dict:
-        def _fact(cursor, row):
-            kwargs = {}
-            for i,col in enumerate(cursor.description):
-                kwargs[cls._mappings_[col[0]]] = row[i]
-            return cls(**kwargs)
-    else:
-        def _fact(cursor, row):
-            return cls(**dict([(k,v) for k,v in zip(cls._mappings_.values(), row)]))
+class SingleConnection(object):
+    """A database Managers can be bound to (see BaseManager.using) that is 
+    one connection, by default whatever the module connection is when it
+    is used.  Both reads and writes go through it, and write() leaves the
+    commit to the caller."""
+    def __init__(self, conn=None):
+        self.conn = conn
+    
+    def reader(self):
+        return self.conn or connection
+    
+    @contextmanager
+    def write(self):
+        yield self.conn or connection
+    
+    def after_write(self, fn):
+        """Calls fn: the one connection sees its own writes, committed or not."""
+        fn()
+    
+    def close(self):
+        (self.conn or connection).close()
+
+class ConnectionPool(object):
+    """A database Managers can be bound to for use by many threads: the 
+    connections of a pool are all to one file, which is put in WAL mode so
+    that its readers and writer do not block each other.  Each thread 
+    reads through a connection of its own, opened on first use, and all 
+    writes go through a single writer connection, one thread at a time 
+    (see write).  kwargs are passed to sqlite3.connect."""
+    def __init__(self, filename, wal=True, **kwargs):
+        if filename == ":memory:":
+            raise ValueError("a ConnectionPool needs a database file")
+        self.filename = filename
+        self.kwargs = kwargs
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.readers_lock = threading.Lock()
+        self.readers = []
+        self.writer = self.connect(check_same_thread=False)
+        if wal:
+            self.writer.execute("PRAGMA journal_mode=WAL")
+    
+    def connect(self, **kwargs):
+        return sqlite3.connect(self.filename, **dict(self.kwargs, **kwargs))
+    
+    def reader(self):
+        """The calling thread's connection, or the writer inside write()."""
+        local = self.local
+        if getattr(local, 'depth', 0):
+            return self.writer
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = self.connect()
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+    
+    @contextmanager
+    def write(self):
+        """A block in which the calling thread has the writer connection, 
+        which it is given, to itself, and reads through it too.  Blocks nest:
+        the outermost commits at its end, or rolls back what is uncommitted
+        if it raises (methods called with commit=True still commit)."""
+        local = self.local
+        with self.lock:
+            local.depth = getattr(local, 'depth', 0) + 1
+            if local.depth == 1:
+                local.pending = []
+            try:
+                yield self.writer
+                if local.depth == 1:
+                    self.writer.commit()
+            except:
+                if local.depth == 1:
+                    self.writer.rollback()
+                raise
+            finally:
+                local.depth -= 1
+                if not local.depth:
+                    pending, local.pending = local.pending, []
+                    for fn in pending:
+                        fn()
+    
+    def after_write(self, fn):
+        """Calls fn once the calling thread's outermost write block has 
+        ended, committed or rolled back, or now outside of one.  What other
+        threads read until then is what was last committed; e.g. an object
+        cached from it must be dropped again afterwards."""
+        if getattr(self.local, 'depth', 0):
+            self.local.pending.append(fn)
+        else:
+            fn()
+    
+    def close(self):
+        """Closes the connections.  Readers of threads other than the 
+        calling one are closed by the thread of the next sqlite call made 
+        through them, which then fails; call this once the threads are done."""
+        with self.readers_lock:
+            for conn in self.readers:
+                try:
+                    conn.close()
+                except sqlite3.ProgrammingError:
+                    pass
+            self.readers = []
+        with self.lock:
+            self.writer.close()
+        self.local = threading.local()
+
+def database(db):
+    """db as a database Managers can be bound to: a sqlite3 connection is 
+    wrapped in a SingleConnection, and None is the module connection."""
+    if db is None or isinstance(db, sqlite3.Connection):
+        return SingleConnection(db)
+    return db
+
+def row_constructor(cls):
+    """A function making a cls record from a row of the database values of
+    its columns, in cls._columns_ order, without calling __init__.  Like 
+    collections.namedtuple, it is generated so that it assigns each 
+    attribute directly; a class with _slots_ also has the attributes which
+    are not columns set to their defaults.  The record is bound to bound, 
+    the manager it was read through (see Record)."""
+    attributes = cls._attributes_
+    lines = ["def make(row, bound=None):", "    o = new(cls)"]
+    if attributes:
+        lines.append("    %s, = row" % ", ".join(["o." + a for a in attributes]))
+    if cls._slots_:
+        lines.extend(["    o.%s = defaults[%r]" % (a, a) for a in cls._defaults_
+                      if a not in attributes and a != '_bound_'])
+    lines.append("    o._bound_ = bound")
+    lines.append("    return o")
+    namespace = {'new': object.__new__, 'cls': cls, 'defaults': cls._defaults_}
+    exec "\n".join(lines) in namespace
+    return namespace['make']
+
+def record_factory(cls, use_dict=False, bound=None):
+    """A row factory making cls records from rows of its columns, in 
+    cls._columns_ order, or with use_dict of whatever columns are selected,
+    bound to bound (see row_constructor).  Records of classes without their
+    own __init__ are filled in directly."""
+    new = object.__new__
+    plain = cls.__init__.im_func is Record.__init__.im_func
+    if plain and not use_dict:
+        make = cls._make_
+        return lambda cursor, row: make(row, bound)
+    described = {}
+    def _fact(cursor, row):
+        attrs = described.get(cursor.description)
+        if attrs is None:
+            attrs = described[cursor.description] = [cls._mappings_[col[0]] for col in cursor.description]
+        if not plain:
+            o = cls(**dict(izip(attrs, row)))
+        elif cls._slots_:
+            o = cls()
+            for a, v in izip(attrs, row):
+                setattr(o, a, v)
+        else:
+            o = new(cls)
+            o.__dict__.update(izip(attrs, row))
+        o._bound_ = bound
+        return o
     return _fact
 
 class NoPrimaryKeyError(Exception):
@@ -45,6 +333,14 @@ class FieldBase(object):
         setattr(new_cls, self.fieldname, self.default)
         return self.fieldname
     
+    def attributes(self):
+        """The names of the instance attributes holding the field's value."""
+        return (self.fieldname,)
+    
+    def serialize(self, value):
+        """The value as stored in the database."""
+        return value
+    
     def lite_type(self):
         return "TEXT"
     
@@ -90,97 +386,325 @@ class ForeignKey(FieldBase):
         return self._lite_type
 
     def contribute(self, new_class):
+        # through the database o was read from
         def _getfkey(o):
             v = getattr(o, self.this_key)
             if v != None:
-                return self.other_cls.objects.query(**{self.other_key:v})
+                return o._manager(self.other_cls).query(**{self.other_key:v})
             return None
         
         def _getrelatedset(o):
-            return new_class.objects.query(**{self.this_key:getattr(o,self.other_key)})
+            return o._manager(new_class).query(**{self.this_key:getattr(o,self.other_key)})
         
+        setattr(new_class, self.this_key, self.default)
         setattr(new_class, self.this_key[0:-3], property(_getfkey))
         setattr(self.other_cls, self.related_name, property(_getrelatedset))
         return self.this_key
 
 
 class JSONField(FieldBase):
+    def serialize(self, value):
+        if value != None:
+            return json.dumps(value)
+        return value
+    
     def contribute(self, new_cls):
         def _set(o, value):
-            if value != None:
-                setattr(o, "__%s_raw" % self.fieldname, json.dumps(value))
-            else:
-                setattr(o, "__%s_raw" % self.fieldname, value)
-            setattr(o, "__%s_cache" % self.fieldname, value)
+            setattr(o, "_%s_raw" % self.fieldname, self.serialize(value))
+            setattr(o, "_%s_cache" % self.fieldname, value)
 
         def _get(o):
-            v = getattr(o, "__%s_cache" % self.fieldname)
+            v = getattr(o, "_%s_cache" % self.fieldname)
             if v != None: 
                 return v
-            v = getattr(o, "__%s_raw" % self.fieldname)
+            v = getattr(o, "_%s_raw" % self.fieldname)
             if v != None:
                 v = json.loads(v)
-                setattr(o, "__%s_cache" % self.fieldname, v)
+                setattr(o, "_%s_cache" % self.fieldname, v)
             return v
                     
-        setattr(new_cls, "__%s_cache" % self.fieldname, None)
-        setattr(new_cls, "__%s_raw" % self.fieldname, None)
+        setattr(new_cls, "_%s_cache" % self.fieldname, None)
+        setattr(new_cls, "_%s_raw" % self.fieldname, None)
         setattr(new_cls, self.fieldname, property(_get,_set))
-        return "__%s_raw" % self.fieldname
+        return "_%s_raw" % self.fieldname
+    
+    def attributes(self):
+        return ("_%s_raw" % self.fieldname, "_%s_cache" % self.fieldname)
 
 class PickleField(FieldBase):
+    def serialize(self, value):
+        if value != None:
+            return pickle.dumps(value)
+        return value
+    
     def contribute(self, new_cls):
         def _set(o, value):
-            if value != None:
-                setattr(o, "__%s_raw" % self.fieldname, pickle.dumps(value))
-            else:
-                setattr(o, "__%s_raw" % self.fieldname, value)
-            setattr(o, "__%s_cache" % self.fieldname, value)
+            setattr(o, "_%s_raw" % self.fieldname, self.serialize(value))
+            setattr(o, "_%s_cache" % self.fieldname, value)
 
         def _get(o):
-            v = getattr(o, "__%s_cache" % self.fieldname)
+            v = getattr(o, "_%s_cache" % self.fieldname)
             if v != None: 
                 return v
-            v = getattr(o, "__%s_raw" % self.fieldname)
+            v = getattr(o, "_%s_raw" % self.fieldname)
             if v != None:
                 v = pickle.loads(str(v))
-                setattr(o, "__%s_cache" % self.fieldname, v)
+                setattr(o, "_%s_cache" % self.fieldname, v)
             return v
         
-        setattr(new_cls, "__%s_cache" % self.fieldname, None)
-        setattr(new_cls, "__%s_raw" % self.fieldname, None)
+        setattr(new_cls, "_%s_cache" % self.fieldname, None)
+        setattr(new_cls, "_%s_raw" % self.fieldname, None)
+        setattr(new_cls, self.fieldname, property(_get,_set))
+        return "_%s_raw" % self.fieldname
+    
+    def attributes(self):
+        return ("_%s_raw" % self.fieldname, "_%s_cache" % self.fieldname)
+    
+# array typecode holding a signed 64 bit integer
+INT64 = [t for t in ('l', 'i') if array(t).itemsize == 8][0]
+# fixed point scale for delta encoded coordinates (the precision of OSM data)
+COORD_SCALE = 10000000
+
+def _write_varints(values, out):
+    for v in values:
+        v = (v << 1) ^ (v >> 63) # zigzag
+        while v > 0x7f:
+            out.append(chr(0x80 | (v & 0x7f)))
+            v >>= 7
+        out.append(chr(v))
+
+def _read_varints(data, offset=0):
+    values = array(INT64)
+    v = shift = 0
+    for c in islice(data, offset, None):
+        b = ord(c)
+        v |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            values.append((v >> 1) ^ -(v & 1))
+            v = shift = 0
+    return values
+
+def _deltas(values):
+    prev = 0
+    for v in values:
+        yield v - prev
+        prev = v
+
+def _undelta(values):
+    total = 0
+    for i, v in enumerate(values):
+        total += v
+        values[i] = total
+    return values
+
+def _native(a):
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+class CoordinateSequence(object):
+    """A read only sequence of (x, y) pairs over a flat array of doubles."""
+    __slots__ = ('flat',)
+    def __init__(self, flat):
+        self.flat = flat
+        
+    def __len__(self):
+        return len(self.flat) // 2
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return (self.flat[2*i], self.flat[2*i+1])
+    
+    def __iter__(self):
+        return izip(islice(self.flat, 0, None, 2), islice(self.flat, 1, None, 2))
+    
+    def __eq__(self, other):
+        if other is None:
+            return False
+        try:
+            return list(self) == [tuple(c) for c in other]
+        except TypeError:
+            return False
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        return repr(list(self))
+
+def pack_coords(coords, delta=False):
+    """Packs a sequence of (x, y) pairs (or a CoordinateSequence) into a BLOB.
+    
+    The default layout is 'D' followed by little-endian doubles.  With delta,
+    it is 'd' followed by zigzag varints of the differences between
+    successive values in 1e-7 degree fixed point."""
+    if isinstance(coords, CoordinateSequence):
+        flat = coords.flat
+    else:
+        flat = array('d', [v for c in coords for v in c])
+    if delta:
+        out = ['d']
+        _write_varints(_deltas([int(round(v * COORD_SCALE)) for v in flat]), out)
+        return buffer("".join(out))
+    if sys.byteorder != 'little':
+        flat = array('d', flat)
+        flat.byteswap()
+    return buffer('D' + flat.tostring())
+
+def pack_ints(values, delta=False):
+    """Packs a sequence of integers into a BLOB: 'Q' followed by little-endian
+    int64s or, with delta, 'q' followed by zigzag varint differences."""
+    if delta:
+        out = ['q']
+        _write_varints(_deltas(values), out)
+        return buffer("".join(out))
+    return buffer('Q' + _native(array(INT64, values)).tostring())
+
+def unpack(raw):
+    """Decodes a BLOB written by pack_coords or pack_ints.  Text is taken to
+    be a JSON value written by JSONField, and is decoded as such."""
+    if raw is None:
+        return None
+    if isinstance(raw, basestring):
+        return json.loads(raw)
+    kind = raw[0]
+    if kind == 'D':
+        return CoordinateSequence(_native(array('d', raw[1:])))
+    if kind == 'Q':
+        return _native(array(INT64, raw[1:]))
+    if kind == 'd':
+        return CoordinateSequence(array('d', [v / float(COORD_SCALE) for v in _undelta(_read_varints(raw, 1))]))
+    if kind == 'q':
+        return _undelta(_read_varints(raw, 1))
+    raise ValueError("unknown packed array type %r" % kind)
+
+class PackedField(FieldBase):
+    """The abstract base of the fields stored as packed BLOBs, CoordsField 
+    and IntArrayField, which define pack; declare one of those.  The value
+    is decoded on first access, and cached on the instance like JSONField."""
+    def __init__(self, fieldname, delta=False, **kwargs):
+        self.delta = delta
+        super(PackedField, self).__init__(fieldname, **kwargs)
+        
+    def lite_type(self):
+        return "BLOB"
+    
+    def pack(self, value):
+        """The BLOB of value (see pack_coords and pack_ints)."""
+        raise NotImplementedError("%s does not define pack; use CoordsField or IntArrayField" % 
+                                  self.__class__.__name__)
+    
+    def convert(self, value):
+        """Converts a decoded JSON value (from a migrated column) to the packed form."""
+        return unpack(self.pack(value))
+    
+    def serialize(self, value):
+        if value is not None:
+            return self.pack(value)
+        return value
+    
+    def contribute(self, new_cls):
+        def _set(o, value):
+            setattr(o, "_%s_raw" % self.fieldname, self.serialize(value))
+            setattr(o, "_%s_cache" % self.fieldname, value)
+
+        def _get(o):
+            # "is not None": != would compare a CoordinateSequence by value
+            v = getattr(o, "_%s_cache" % self.fieldname)
+            if v is not None: 
+                return v
+            v = getattr(o, "_%s_raw" % self.fieldname)
+            if v is not None:
+                v = unpack(v)
+                if type(v) == list:
+                    v = self.convert(v)
+                setattr(o, "_%s_cache" % self.fieldname, v)
+            return v
+                    
+        setattr(new_cls, "_%s_cache" % self.fieldname, None)
+        setattr(new_cls, "_%s_raw" % self.fieldname, None)
         setattr(new_cls, self.fieldname, property(_get,_set))
-        return "__%s_raw" % self.fieldname
+        return "_%s_raw" % self.fieldname
     
+    def attributes(self):
+        return ("_%s_raw" % self.fieldname, "_%s_cache" % self.fieldname)
+
+class CoordsField(PackedField):
+    """A sequence of (x, y) pairs, read back as a CoordinateSequence."""
+    def pack(self, value):
+        return pack_coords(value, self.delta)
+
+class IntArrayField(PackedField):
+    """A sequence of integers (e.g. node ids), read back as an array."""
+    def pack(self, value):
+        return pack_ints(value, self.delta)
+
+def migrate_json(rclass, reporter=None, conn=None):
+    """Rewrites JSON text left in the packed columns of rclass's table (by a
+    database written when they were JSONFields) in the packed format."""
+    fields = [f for f in rclass._fielddefs_ if isinstance(f, PackedField)]
+    pkeys = [f.fieldname for f in rclass._primary_keys_]
+    with rclass.objects.write(conn) as conn:
+        c = conn.cursor()
+        for f in fields:
+            rows = c.execute("SELECT %s, %s FROM %s WHERE typeof(%s) = 'text'" % 
+                             (",".join(pkeys), f.fieldname, rclass._table_, f.fieldname)).fetchall()
+            if reporter: reporter.write("Migrating %d %s.%s values\n" % (len(rows), rclass._table_, f.fieldname))
+            c.executemany("UPDATE %s SET %s = ? WHERE %s = ?" % (rclass._table_, f.fieldname, "=? AND ".join(pkeys)),
+                          [[f.pack(json.loads(row[-1]))] + list(row[:-1]) for row in rows])
+        conn.commit()
+
 class RecordBase(type):
     #__metaclass__ = object 
     def __new__(cls, name, bases, attrs):
         obj_new = super(RecordBase, cls).__new__
         parents = [b for b in bases if hasattr(b,'_fields_')]
+        fields = [isinstance(f, FieldBase) and f or FieldBase(f) for f in attrs['_fields_']]
+        # a class with _slots_ keeps its fields' attributes in slots; their
+        # defaults, which contribute sets on the class, go in _defaults_
+        if attrs.get('_slots_'):
+            attrs = dict(attrs, __slots__=tuple([a for f in fields for a in f.attributes()] + ['_bound_']))
                 
         new_class = obj_new(cls, name, bases, attrs)
         for obj_name, obj in attrs.items():                 
             setattr(new_class, obj_name, obj)
+        slots = [(a, new_class.__dict__[a]) for a in attrs.get('__slots__', ())]
             
 
         mappings = {}
+        fieldmap = {}
+        defaults = {'_bound_': None}
+        columns = []
         for p in parents:
             mappings.update(p._mappings_)
-        fields = list(attrs['_fields_'])
+            fieldmap.update(p._fieldmap_)
+            defaults.update(p._defaults_)
+            columns.extend([c for c in p._columns_ if c not in columns])
         fielddefs = []
         primary_keys = []
         for f in fields:
-            if not isinstance(f, FieldBase):
-                f = FieldBase(f)
-            
             if f.primary_key:
                 primary_keys.append(f)
             mappings[f.fieldname] = f.contribute(new_class)
+            fieldmap[f.fieldname] = f
             fielddefs.append(f)
+            for a in f.attributes():
+                defaults[a] = getattr(new_class, a)
+            if f.fieldname not in columns:
+                columns.append(f.fieldname)
+        for a, descriptor in slots:
+            setattr(new_class, a, descriptor)
             
         
         setattr(new_class,'_mappings_',mappings)
+        setattr(new_class,'_fieldmap_',fieldmap)
         setattr(new_class,'_fielddefs_',fielddefs)
+        setattr(new_class,'_defaults_',defaults)
         if not len(primary_keys):
             setattr(new_class,'_primary_keys_',None)
         else:
@@ -188,6 +712,24 @@ class RecordBase(type):
 
         if '_table_' not in attrs:
             setattr(new_class, '_table_', name.lower())
+        
+        # the column lists and statements, built once per class, with the 
+        # columns in the order the fields are declared
+        columns = tuple(columns)
+        setattr(new_class, '_columns_', columns)
+        setattr(new_class, '_attributes_', tuple([mappings[k] for k in columns]))
+        if len(columns) == 1:
+            setattr(new_class, '_values_', staticmethod(lambda o, get=attrgetter(*new_class._attributes_): (get(o),)))
+        elif columns:
+            setattr(new_class, '_values_', attrgetter(*new_class._attributes_))
+        setattr(new_class, '_make_', staticmethod(row_constructor(new_class)))
+        table = new_class._table_
+        pkeys = " and ".join(["%s=?" % f.fieldname for f in primary_keys])
+        setattr(new_class, '_sql_', {
+            'select': "SELECT %s from %s" % (",".join(columns), table),
+            'insert': "INSERT INTO %s(%s) VALUES (%s)" % (table, ",".join(columns), ",".join(["?"] * len(columns))),
+            'update': "UPDATE %s set %s where %s" % (table, ",".join(["%s=?" % k for k in columns]), pkeys),
+            'delete': "DELETE from %s where %s" % (table, pkeys)})
             
         if 'objects' not in attrs:
             setattr(new_class, 'objects', BaseManager())
@@ -199,15 +741,61 @@ class RecordBase(type):
 
 
 class BaseManager(object):
-    def __init__(self, rclass=None):
+    def __init__(self, rclass=None, db=None):
         # this is set by the __new__ method of class
         self.rclass = rclass
+        self.db = database(db)
+        self.queries = LRUCache(64)
+        self.factories = {}
+        self.managers = {}
+    
+    def using(self, db):
+        """A manager of rclass bound to db, a sqlite3 connection or a 
+        ConnectionPool, sharing this one's SQL."""
+        m = object.__new__(self.__class__)
+        m.__dict__.update(self.__dict__)
+        m.db = database(db)
+        m.factories = {}
+        m.managers = {}
+        return m
+    
+    def manager(self, rclass):
+        """The manager of rclass bound to this one's database."""
+        if rclass is self.rclass:
+            return self
+        m = self.managers.get(rclass)
+        if m is None:
+            m = self.managers[rclass] = rclass.objects.using(self.db)
+        return m
+    
+    def bind(self, db):
+        """Binds this manager, and so rclass's records, to db."""
+        self.db = database(db)
+    
+    def reader(self):
+        """The connection to read through."""
+        return self.db.reader()
+    
+    def write(self, conn=None):
+        """A with block giving the connection to write through: conn, if 
+        given, else the database's (see ConnectionPool.write)."""
+        if conn is not None:
+            return SingleConnection(conn).write()
+        return self.db.write()
+    
+    def factory(self, use_dict=False):
+        """The record_factory for rclass, made once."""
+        f = self.factories.get(use_dict)
+        if f is None:
+            f = self.factories[use_dict] = record_factory(self.rclass, use_dict, self)
+        return f
     
     def createtable(self):
-        c = connection.cursor()
-        c.execute(self.tabledef())
-        c.executescript(self.indicesdef())
-        connection.commit()
+        with self.write() as conn:
+            c = conn.cursor()
+            c.execute(self.tabledef())
+            c.executescript(self.indicesdef())
+            conn.commit()
     
     def tabledef(self):
         pkeys = [p.fieldname for p in filter(lambda f: not isinstance(f, ID), self.rclass._primary_keys_)]
@@ -230,50 +818,267 @@ class BaseManager(object):
     def get(self, **kwargs):
         return self.query(**kwargs).fetchone()
     
-    @classmethod    
-    def query(cls, **kwargs):
-        c = connection.cursor()
-        query = ["1"]
-        args = []
-        if kwargs:
-            for k,v in kwargs.items():
-                if k == 'where':
-                    query.append(v)
-                else:
-                    query.append("%s=?" % cls._mappings_[k])
-                    args.append(v)
-        q = "SELECT %s from %s where %s" % (",".join(cls._mappings_.keys()), cls._table_, 
-                                            " AND ".join(query))
+    def serializer(self, columns):
+        """A function giving the database values of columns for a record, a
+        dict of field values (missing fields take their defaults) or, left 
+        as is, a sequence of database values.  Each value is serialized 
+        once, not through the fields' properties."""
+        cls = self.rclass
+        get = attrgetter(*[cls._mappings_[c] for c in columns])
+        fields = [cls._fieldmap_[c] for c in columns]
+        missing = object()
+        def row(r):
+            if type(r) is tuple:
+                return r
+            if isinstance(r, cls):
+                v = get(r)
+                return len(fields) == 1 and (v,) or v
+            if isinstance(r, dict):
+                values = []
+                for f in fields:
+                    v = r.get(f.fieldname, missing)
+                    if v is missing:
+                        values.append(cls._defaults_[cls._mappings_[f.fieldname]])
+                    else:
+                        values.append(f.serialize(v))
+                return values
+            return r
+        return row
+    
+    def statement(self, kind, columns):
+        """The INSERT or UPDATE (by primary key) statement for columns."""
+        key = (kind, columns)
+        q = self.queries.get(key)
+        if q is None:
+            table = self.rclass._table_
+            if kind == 'insert':
+                q = "INSERT INTO %s(%s) VALUES (%s)" % (table, ",".join(columns), ",".join(["?"] * len(columns)))
+            else:
+                q = "UPDATE %s set %s where %s" % (table, ",".join(["%s=?" % k for k in columns]),
+                                                   " and ".join(["%s=?" % f.fieldname for f in self.rclass._primary_keys_]))
+            self.queries[key] = q
+        return q
+    
+    def executemany(self, q, rows, batch_size, conn, commit):
+        """Runs q over rows with executemany, batch_size rows at a time, in 
+        one transaction: committed at the end if commit, rolled back if a 
+        batch fails.  Returns the number of rows."""
+        if verbose: reporter.write("Bulk: %s\n" % q)
+        with self.write(conn) as conn:
+            rows = iter(rows)
+            count = 0
+            try:
+                batch = list(islice(rows, batch_size))
+                while batch:
+                    conn.executemany(q, batch)
+                    count += len(batch)
+                    batch = list(islice(rows, batch_size))
+            except:
+                if commit:
+                    conn.rollback()
+                raise
+            if commit:
+                conn.commit()
+            return count
+    
+    def bulk_create(self, records, batch_size=10000, columns=None, rowids=False, conn=None, commit=True):
+        """Inserts records (see serializer) with executemany, in one 
+        transaction, and returns their number.  columns limits the insert to
+        those columns.  With rowids=True the rows are inserted one at a time
+        to learn their rowids, which are returned, and set as the id of 
+        records which had none.  conn defaults to the manager's database."""
+        cls = self.rclass
+        columns = tuple(columns or cls._columns_)
+        q = columns == cls._columns_ and cls._sql_['insert'] or self.statement('insert', columns)
+        row = self.serializer(columns)
+        if not rowids:
+            return self.executemany(q, imap(row, records), batch_size, conn, commit)
+        ids = [f.fieldname for f in cls._primary_keys_ or () if isinstance(f, ID)]
+        with self.write(conn) as conn:
+            c = conn.cursor()
+            rowids = []
+            try:
+                for r in records:
+                    c.execute(q, row(r))
+                    rowids.append(c.lastrowid)
+                    if ids and isinstance(r, cls) and getattr(r, ids[0]) is None:
+                        setattr(r, ids[0], c.lastrowid)
+            except:
+                if commit:
+                    conn.rollback()
+                raise
+            if commit:
+                conn.commit()
+            return rowids
+    
+    def bulk_update(self, records, batch_size=10000, columns=None, conn=None, commit=True):
+        """Updates records by primary key with executemany, in one transaction,
+        and returns their number.  columns limits the update to those 
+        columns; rows of database values then hold those columns' values 
+        followed by the primary key's."""
+        cls = self.rclass
+        if not cls._primary_keys_:
+            raise NoPrimaryKeyError(cls.__name__)
+        columns = tuple(columns or cls._columns_)
+        q = columns == cls._columns_ and cls._sql_['update'] or self.statement('update', columns)
+        row = self.serializer(columns + tuple([f.fieldname for f in cls._primary_keys_]))
+        rows = imap(row, records)
+        if cls._cache_ is not None:
+            n = len(cls._primary_keys_)
+            rows = self.invalidating(rows, lambda r: _row_key(r[-n:]))
+        return self.executemany(q, rows, batch_size, conn, commit)
+    
+    def bulk_delete(self, keys, batch_size=10000, conn=None, commit=True):
+        """Deletes the records with the primary keys in keys (tuples, for a 
+        key of several fields) with executemany, in one transaction."""
+        cls = self.rclass
+        if not cls._primary_keys_:
+            raise NoPrimaryKeyError(cls.__name__)
+        if cls._cache_ is not None:
+            keys = self.invalidating(keys, lambda k: k)
+        if len(cls._primary_keys_) == 1:
+            keys = ((k,) for k in keys)
+        return self.executemany(cls._sql_['delete'], keys, batch_size, conn, commit)
+    
+    def invalidating(self, rows, key):
+        """Passes rows through, dropping the objects derived from the row of
+        primary key key(row) of each from rclass's _cache_, then again once
+        the write is committed (see ConnectionPool.after_write)."""
+        cache, table = self.rclass._cache_, self.rclass._table_
+        keys = []
+        for r in rows:
+            keys.append((table, key(r)))
+            cache.invalidate(keys[-1])
+            yield r
+        def invalidate():
+            for row in keys:
+                cache.invalidate(row)
+        self.db.after_write(invalidate)
+    
+    def select(self, kwargs, columns=None, tail=None):
+        """Executes the SELECT of query (of columns, if given, rather than 
+        all of rclass's) and returns the cursor.  tail is a (sql, args) 
+        tuple added after the where clause, e.g. ORDER BY or LIMIT."""
+        where = kwargs.pop('where', None)
+        fields = tuple(sorted(kwargs))
+        args = [kwargs[k] for k in fields]
+        if type(where) == tuple:
+            where, where_args = where
+            args.extend(where_args)
+            key = (fields, where)
+        else:
+            key = where is None and fields or None
+        if columns is not None and key is not None:
+            key = (columns, key)
+        if tail is not None:
+            tail, tail_args = tail
+            args.extend(tail_args)
+            key = key is not None and (key, tail) or None
+        q = key is not None and self.queries.get(key)
+        if not q:
+            query = ["1"] + ["%s=?" % self.rclass._mappings_[k] for k in fields]
+            if where is not None:
+                query.append(where)
+            select = columns is None and self.rclass._sql_['select'] or \
+                     "SELECT %s from %s" % (",".join(columns), self.rclass._table_)
+            q = "%s where %s" % (select, " AND ".join(query))
+            if tail is not None:
+                q += " " + tail
+            if key is not None:
+                self.queries[key] = q
         if verbose: reporter.write("Query: %s\n" % q)
+        c = self.reader().cursor()
         c.execute(q, args)
-        c.row_factory = record_factory(cls)
         return c
     
     def query(self, **kwargs):
-        c = connection.cursor()
-        query = ["1"]
-        args = []
-        if kwargs:
-            for k,v in kwargs.items():
-                if k == 'where':
-                    query.append(v)
-                else:
-                    query.append("%s=?" % self.rclass._mappings_[k])
-                    args.append(v)
-        q = "SELECT %s from %s where %s" % (",".join(self.rclass._mappings_.keys()), 
-                                            self.rclass._table_, " AND ".join(query))
-        if verbose: reporter.write("Query: %s\n" % q)
-        c.execute(q, args)
-        c.row_factory = record_factory(self.rclass)
+        """Selects records by field=value.  where adds raw SQL, either a string 
+        or a (sql, args) tuple for a clause with ? placeholders.  The SELECT
+        is built once per set of fields and (sql, args) where clause."""
+        c = self.select(kwargs)
+        c.row_factory = self.factory()
+        return c
+    
+    def values(self, *columns, **kwargs):
+        """Selects like query, but the cursor gives tuples of the database 
+        values of columns (by default all of them, in _columns_ order) 
+        without making records; with named=True, namedtuples of them.  The
+        values are as stored: JSON text and packed BLOBs are not decoded."""
+        named = kwargs.pop('named', False)
+        columns = columns or self.rclass._columns_
+        c = self.select(kwargs, columns)
+        if named:
+            c.row_factory = self.named_factory(columns)
         return c
+    
+    def named_factory(self, columns):
+        """A row factory making namedtuples of columns, made once."""
+        key = ('named', columns)
+        f = self.factories.get(key)
+        if f is None:
+            row = namedtuple(self.rclass.__name__ + "Row", columns)
+            f = self.factories[key] = lambda cursor, values, new=tuple.__new__: new(row, values)
+        return f
+    
+    def stream(self, page_size=10000, columns=None, named=False, **kwargs):
+        """Yields what query(**kwargs), or with columns values(*columns, 
+        named=named, **kwargs), would, in primary key order, page_size rows 
+        at a time.  Each page is a SELECT of the rows after the last one of 
+        the page before (WHERE key > ? ORDER BY key LIMIT page_size), read 
+        in full before any of it is yielded, so no statement is left open, 
+        holding a read transaction, while the caller works through a page."""
+        cls = self.rclass
+        if not cls._primary_keys_ or len(cls._primary_keys_) > 1:
+            raise NoPrimaryKeyError(cls.__name__)
+        key = cls._primary_keys_[0].fieldname
+        where, where_args = kwargs.pop('where', None), ()
+        if type(where) == tuple:
+            where, where_args = where
+        tail = ("ORDER BY %s LIMIT ?" % key, (page_size,))
+        selected = columns = columns and tuple(columns) or None
+        skip = 0
+        if columns is None:
+            make = self.factory()
+        else:
+            make = named and self.named_factory(columns) or None
+            if key not in columns:
+                # select the key too, ahead of the columns, and drop it
+                selected, skip = (key,) + columns, 1
+        i = list(selected or cls._columns_).index(key)
+        last = None
+        while True:
+            clauses, args = [], []
+            if last is not None:
+                clauses.append("%s > ?" % key)
+                args.append(last)
+            if where is not None:
+                clauses.append("(%s)" % where)
+                args.extend(where_args)
+            page_kwargs = dict(kwargs)
+            if clauses:
+                page_kwargs['where'] = (" AND ".join(clauses), args)
+            c = self.select(page_kwargs, selected, tail)
+            rows = c.fetchall()
+            c.close()
+            if not rows:
+                return
+            last = rows[-1][i]
+            for row in rows:
+                if skip:
+                    row = row[skip:]
+                if make is not None:
+                    row = make(c, row)
+                yield row
+            if len(rows) < page_size:
+                return
 
     def cursor(self):
-        c = connection.cursor()
-        c.row_factory = record_factory(self.rclass, use_dict=True)
+        c = self.reader().cursor()
+        c.row_factory = self.factory(use_dict=True)
         return c
         
     def join(self, othercls, on, **kwargs):
-        c = connection.cursor()
+        c = self.reader().cursor()
         query = ["1"]
         if kwargs:
             for k,v in kwargs:
@@ -292,10 +1097,34 @@ class BaseManager(object):
 
 
 class Record(object):
+    """A row of _table_.  Field values are given by keyword or, in _columns_
+    order, by position.  Setting _slots_ = True keeps a subclass's fields
+    in __slots__: its records are smaller and quicker to make, but take no
+    attributes other than fields.
+    
+    A record read through a manager is bound to it: create, save and delete
+    write, and foreign keys read, through that manager's database (unless
+    given a conn).  Other records use the class's objects.
+    
+    A subclass's _cache_, an ObjectCache, 
+    has the objects derived from a record's row dropped when it is saved or
+    deleted."""
     __metaclass__ = RecordBase
+    __slots__ = ()
     _fields_ = []
-    def __init__(self, **kwargs):
+    _slots_ = False
+    _cache_ = None
+    _bound_ = None
+    def __init__(self, *args, **kwargs):
         super(Record, self).__init__()
+        if self._slots_:
+            for k, v in self._defaults_.iteritems():
+                setattr(self, k, v)
+        if args:
+            if len(args) > len(self._columns_):
+                raise TypeError("%s takes at most %d arguments (%d given)" % 
+                                (self.__class__.__name__, len(self._columns_), len(args)))
+            kwargs.update(izip(self._columns_, args))
         if kwargs:
             for k,v in kwargs.items():
                 #if k in self._mappings_:
@@ -317,36 +1146,59 @@ class Record(object):
     def keys(self):
         return self._mappings_.keys()
     
-    def create(self, autocommit=True, get_rowid=False):
-        c = connection.cursor()
-        #pdb.set_trace()
-        q = "INSERT INTO %s(%s) VALUES (%s)" % (self._table_, 
-                                                      ",".join(self._mappings_.keys()), 
-                                                      ",".join(["?" for f in self._mappings_.keys()]))
+    def values(self):
+        """The values of the columns, in _columns_ order."""
+        return self._values_(self)
+    
+    def _manager(self, rclass=None):
+        """The manager of rclass, by default this record's class, for the
+        database the record was read from."""
+        rclass = rclass or self.__class__
+        if self._bound_ is None:
+            return rclass.objects
+        return self._bound_.manager(rclass)
+    
+    def create(self, autocommit=True, get_rowid=False, conn=None):
+        q = self._sql_['insert']
         if verbose: reporter.write("Create: %s\n" % q)
-        #print [getattr(self, f) for f in self._mappings_.values()]
-        c.execute(q, [getattr(self, f) for f in self._mappings_.values()])
-        if autocommit or get_rowid:
-            connection.commit()
-            return c.lastrowid
+        with self._manager().write(conn) as conn:
+            c = conn.cursor()
+            c.execute(q, self._values_(self))
+            if autocommit or get_rowid:
+                conn.commit()
+                return c.lastrowid
             
-    def save(self):
-        if not len(self._primary_keys_):
-            raise NoPrimaryKeyError(self.__class__.__name__)
-        c = connection.cursor()
-        c.execute("UPDATE %s set %s=? where %s=?" % (self._table_, 
-                                                   "=?,".join(self._mappings_.keys()),
-                                                   "=? and ".join([f.fieldname for f in self._primary_keys_]), 
-                                                   [getattr(self, f) for f in self._mappings_.values()]))
-    def delete(self):
-        if not len(self._primary_keys_):
+    def save(self, conn=None):
+        if not self._primary_keys_:
             raise NoPrimaryKeyError(self.__class__.__name__)
-        c = connection.cursor()
-        q = "DELETE from %s where %s=?" % (self._table_, 
-                                           "=? and ".join([f.fieldname for f in self._primary_keys_]))
+        q = self._sql_['update']
+        if verbose: reporter.write("Save: %s\n" % q)
+        with self._manager().write(conn) as conn:
+            conn.execute(q, self._values_(self) + tuple([getattr(self, f.fieldname) for f in self._primary_keys_]))
+        self._invalidate()
         
+    def delete(self, conn=None):
+        if not self._primary_keys_:
+            raise NoPrimaryKeyError(self.__class__.__name__)
+        q = self._sql_['delete']
         if verbose: reporter.write("Delete: %s\n" % q)
-        c.execute(q, [getattr(self, f.fieldname) for f in self._primary_keys_])
+        with self._manager().write(conn) as conn:
+            conn.execute(q, [getattr(self, f.fieldname) for f in self._primary_keys_])
+        self._invalidate()
+    
+    def _invalidate(self):
+        # now, and again once the write is committed, in case another thread
+        # read the row meanwhile
+        if self._cache_ is not None:
+            row = (self._table_, _row_key([getattr(self, f.fieldname) for f in self._primary_keys_]))
+            self._cache_.invalidate(row)
+            self._manager().db.after_write(lambda: self._cache_.invalidate(row))
+
+def _row_key(values):
+    """The primary key of ObjectCache rows: its value, or a tuple of them."""
+    if len(values) == 1:
+        return values[0]
+    return tuple(values)
 
             
 def test():
@@ -402,7 +1254,7 @@ def test():
     b = Bar.objects.get(id=2)
     b.delete()
     assert len(Bar.objects.query().fetchall()) == 1
-
+    
     f = Foo(moo=2, pickle={'a':'b'})
     id = f.create(get_rowid=True)
     print id 
@@ -433,6 +1285,58 @@ def test():
         
     assert fields == len(Foo._mappings_)
     
+    class Baz(Record):
+        _fields_ = (ID('id'), CoordsField('geom'), IntArrayField('nds'),
+                    CoordsField('dgeom', delta=True), IntArrayField('dnds', delta=True))
+    Baz.objects.createtable()
+    coords = [(-122.4123456, 37.7512345), (-122.4, 37.75)]
+    Baz(id=1, geom=coords, nds=[1, 2, 3], dgeom=coords, dnds=[65320811, 65320812, 2**40, -5]).create()
+    b = Baz.objects.get(id=1)
+    assert b.geom == coords
+    assert b.geom[-1] == (-122.4, 37.75)
+    assert list(b.nds) == [1, 2, 3]
+    assert b.dgeom == coords
+    assert list(b.dnds) == [65320811, 65320812, 2**40, -5]
+    assert len(str(pack_ints(b.dnds, delta=True))) < len(str(pack_ints(b.dnds)))
+    assert b.geom != None and not (b.geom == None)
+    try:
+        PackedField('x').serialize([1])
+        assert False
+    except NotImplementedError:
+        pass
+    
+    # a row written when the columns held JSON
+    c.execute("INSERT INTO baz (id, geom, nds) VALUES (2, '[[1.5, 2]]', '[4, 5]')")
+    assert Baz.objects.get(id=2).geom == [(1.5, 2)]
+    assert list(Baz.objects.get(id=2).nds) == [4, 5]
+    migrate_json(Baz)
+    assert c.execute("SELECT typeof(geom), typeof(nds) FROM baz WHERE id = 2").fetchone() == ('blob', 'blob')
+    assert Baz.objects.get(id=2).geom == [(1.5, 2)]
+    
+    # records in slots, made by position, and rows without records
+    class Qux(Record):
+        _slots_ = True
+        _fields_ = (ID('id'), INT('moo'), JSONField('tags'), CoordsField('geom'))
+    Qux.objects.createtable()
+    assert Qux._columns_ == ('id', 'moo', 'tags', 'geom')
+    Qux(1, 5, {'a': 1}, coords).create()
+    Qux(id=2).create()
+    try:
+        Qux(id=3, cow=3)
+        assert False
+    except AttributeError:
+        assert not hasattr(Qux(), '__dict__')
+    q = Qux.objects.get(id=1)
+    assert (q.id, q.moo, q.tags, q.geom) == (1, 5, {'a': 1}, coords)
+    q = Qux.objects.get(id=2)
+    assert (q.moo, q.tags, q.geom) == (None, None, None)
+    assert Qux.objects.cursor().execute("select tags from qux where id = 1").fetchone().tags == {'a': 1}
+    assert Qux.objects.values('id', 'moo', where="id < 3").fetchall() == [(1, 5), (2, None)]
+    assert Qux.objects.values(id=1).fetchone() == Qux.objects.get(id=1).values()
+    row = Qux.objects.values('moo', 'tags', named=True, id=1).fetchone()
+    assert row == (5, '{"a": 1}') and row.moo == 5 and row.tags == '{"a": 1}'
+    assert [tuple(f.values()) for f in Foo.objects.query()] == Foo.objects.values().fetchall()
+    
     #print "F bar_set:",f.bar_set.fetchall()
     #for o in Foo.join(Bar, 'id = foo_id'):
     #    print "Join:", o
@@ -4,6 +4,55 @@ import sys
 
 digest.VERBOSE = True
 
+def make_change(osmfile, osm_out, osc_out):
+    """Edits osmfile, writing the edited file to osm_out and the edits as an 
+    OSM change file to osc_out."""
+    from xml.etree import ElementTree as ET
+    tree = ET.parse(osmfile)
+    root = tree.getroot()
+    ways = root.findall('way')
+    highways = [w for w in ways if [t for t in w.findall('tag') if t.get('k') == 'highway']]
+    refs = {}
+    for w in highways:
+        for nd in set([nd.get('ref') for nd in w.findall('nd')]):
+            refs[nd] = refs.get(nd, 0) + 1
+    used = set([nd.get('ref') for w in ways for nd in w.findall('nd')])
+    nodes = dict((n.get('id'), n) for n in root.findall('node'))
+    change = {'create': [], 'modify': [], 'delete': []}
+    
+    # delete a way, shorten and rename another
+    root.remove(highways[0])
+    change['delete'].append(highways[0])
+    highways[1].remove(highways[1].findall('nd')[-1])
+    ET.SubElement(highways[1], 'tag', k='name', v='Changed Street')
+    change['modify'].append(highways[1])
+    # move a junction
+    junction = [nd.get('ref') for nd in highways[5].findall('nd') if refs[nd.get('ref')] > 1][0]
+    nodes[junction].set('lat', "%.7f" % (float(nodes[junction].get('lat')) + 0.0001))
+    change['modify'].append(nodes[junction])
+    # a new way from a new node to the junction, then to a node inside another way
+    inner = [ref for w in highways[6:] for ref in [nd.get('ref') for nd in w.findall('nd')[1:-1]] if refs[ref] == 1][0]
+    node = ET.SubElement(root, 'node', id='1', lat='37.74', lon='-122.41')
+    way = ET.SubElement(root, 'way', id='2')
+    for ref in ('1', junction, inner):
+        ET.SubElement(way, 'nd', ref=ref)
+    ET.SubElement(way, 'tag', k='highway', v='service')
+    change['create'].extend([node, way])
+    # make a way a highway
+    other = [w for w in ways if w not in highways and w.findall('nd')][0]
+    ET.SubElement(other, 'tag', k='highway', v='path')
+    change['modify'].append(other)
+    # delete a node no way uses
+    unused = [n for id, n in sorted(nodes.items()) if id not in used][0]
+    root.remove(unused)
+    change['delete'].append(unused)
+    
+    tree.write(osm_out)
+    osc = ET.Element('osmChange', version='0.6')
+    for action in ('create', 'modify', 'delete'):
+        ET.SubElement(osc, action).extend(change[action])
+    ET.ElementTree(osc).write(osc_out)
+
 class TestBase:
     file1 = os.path.join(os.path.dirname(__file__), "..", "test", "test_file.osm")
 
@@ -43,7 +92,743 @@ class TestBase:
         
         assert 1207 == c.execute("select count(*) from way_segments, way_segments_rtree_idx i where i.id = way_segments.id and i.left > -123 and i.bottom > 36 and i.right < -120 and i.top < 38").fetchone()[0]
         
+    def test_bulk_load(self):
+        import ORM
+        summaries = []
+        for bulk in (False, True):
+            db = ORM.OSMDB(":memory:")
+            db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, 
+                        bulk=bulk, batch_size=1000)
+            c = db.conn.cursor()
+            summaries.append((c.execute("select count(*), sum(refcount) from nodes").fetchone(),
+                              c.execute("select count(*) from ways").fetchone()[0]))
+        assert summaries[0] == summaries[1]
+        assert summaries[1][0][0] == 2967
+        assert summaries[1][1] == 309
+        
+    def test_refcounter_spill(self):
+        import ORM
+        totals = []
+        for refcounter in (digest.RefCounter(), digest.RefCounter(max_entries=100)):
+            db = ORM.OSMDB(":memory:")
+            digest.load_osmfile(db.conn, self.file1, bulk=True, refcounter=refcounter, node_refs=True)
+            assert refcounter.get(65320811) == 1
+            refcounter.close()
+            c = db.conn.cursor()
+            totals.append((c.execute("select sum(refcount), count(*) from nodes where refcount > 1").fetchone(),
+                           c.execute("select sum(cnt) from node_refs").fetchone()[0]))
+        assert totals[0] == totals[1]
+        assert totals[1] == ((1400, 652), 3618)
+        
+        # counts add to those stored, as when loading a second file
+        refcounter = digest.RefCounter()
+        refcounter.add([65320811, 65320812])
+        before = db.conn.execute("SELECT id, refcount FROM nodes WHERE id IN (65320811, 65320812)").fetchall()
+        refcounter.write_refcounts(db.conn)
+        assert db.conn.execute("SELECT id, refcount FROM nodes WHERE id IN (65320811, 65320812)").fetchall() == \
+            [(id, refcount + 1) for id, refcount in before]
+        refcounter.close()
+        
+    def test_iterparse(self):
+        import ORM
+        rows = []
+        for parser in ('sax', 'iterparse'):
+            db = ORM.OSMDB(":memory:")
+            db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, 
+                        bulk=True, parser=parser)
+            c = db.conn.cursor()
+            rows.append((c.execute("select * from nodes order by id").fetchall(),
+                         c.execute("select * from ways order by id").fetchall()))
+        assert rows[0] == rows[1]
+        
+        chunks = list(digest.iter_osm(self.file1, chunk_size=100))
+        assert max(map(len, chunks)) == 100
+        assert 2967 == len([el for chunk in chunks for el in chunk if type(el) is digest.OSMNode])
+        
+    def test_parallel_load(self):
+        import ORM
+        checksums = []
+        for workers in (1, 3):
+            db = ORM.OSMDB(":memory:")
+            db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, 
+                        bulk=True, batch_size=500, workers=workers)
+            checksums.append((digest.table_checksum(db.conn, 'nodes'), 
+                              digest.table_checksum(db.conn, 'ways')))
+        assert checksums[0] == checksums[1]
+        assert checksums[1][0][0] == 2967
+        assert checksums[1][1][0] == 309
+        
+        ranges = digest.split_osmfile(self.file1, 3)
+        assert len(ranges) == 3
+        assert ranges[0][0] == 0 and ranges[-1][1] == os.path.getsize(self.file1)
+        for start, end in ranges[1:]:
+            f = open(self.file1)
+            f.seek(start)
+            assert f.read(6) in ('<node ', '<way i')
+        
+    def test_compressed_load(self):
+        import ORM, bz2, gzip, tempfile, decompress
+        raw = open(self.file1, 'rb').read()
+        tmp = tempfile.mkdtemp()
+        multistream = os.path.join(tmp, "multi.osm.bz2")
+        open(multistream, 'wb').write("".join([bz2.compress(raw[i:i+200000]) for i in range(0, len(raw), 200000)]))
+        gz = os.path.join(tmp, "test.osm.gz")
+        f = gzip.open(gz, 'wb')
+        f.write(raw)
+        f.close()
+        
+        assert len(decompress.bz2_streams(multistream)) == 7
+        assert decompress.open_osmfile(multistream, workers=2).read() == raw
+        
+        # the pool is kept at most in_flight streams ahead of the reader
+        class Pool(object):
+            submitted = 0
+            def apply_async(self, fn, args):
+                Pool.submitted += 1
+                return Result(fn(*args))
+            def terminate(self):
+                pass
+        class Result(object):
+            def __init__(self, value):
+                self.value = value
+            def get(self):
+                return self.value
+        chunks = decompress._pool_chunks(Pool(), multistream, decompress.bz2_streams(multistream), 3)
+        assert chunks.next() == raw[:200000] and Pool.submitted == 4
+        assert "".join(chunks) == raw[200000:] and Pool.submitted == 7
+        
+        checksums = []
+        for filename, workers in ((self.file1, 1), (multistream, 1), (multistream, 2), (gz, 1)):
+            db = ORM.OSMDB(":memory:")
+            digest.load_osmfile(db.conn, filename, bulk=True, workers=workers, decompress_workers=2)
+            checksums.append((digest.table_checksum(db.conn, 'nodes'), 
+                              digest.table_checksum(db.conn, 'ways')))
+        assert checksums.count(checksums[0]) == 4
+        
+        for filename in (multistream, gz):
+            os.remove(filename)
+        os.rmdir(tmp)
+        
+    def test_rtree_queries(self):
+        import ORM
+        results = []
+        for rtree in (True, False):
+            db = ORM.OSMDB(":memory:", rtree=rtree)
+            db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True)
+            assert db.rtree == rtree
+            results.append([(sorted([w.id for w in db.nearby_ways(lat, lon, range=0.002)]), 
+                             db.nearest_node(lat, lon))
+                            for lat, lon in ((37.74, -122.41), (37.75, -122.42), (37.736, -122.404))])
+        assert results[0] == results[1]
+        assert len(results[0][0][0]) == 29
+        
+        # the triggers keep the index up to date
+        c = db.conn.cursor()
+        db.create_rtree_indexes()
+        assert c.execute("select count(*) from ways_rtree").fetchone()[0] == 309
+        w = db.way(results[0][0][0][0])
+        w.delete()
+        assert c.execute("select count(*) from ways_rtree").fetchone()[0] == 308
+        assert c.execute("select count(*) from nodes_rtree").fetchone()[0] == 2967
+        # moving a node moves its entry, while a refcount update leaves it be
+        node = db.nearest_node(37.74, -122.41)[0]
+        changes = db.conn.total_changes
+        c.execute("UPDATE nodes SET refcount = refcount + 1 WHERE id = ?", (node,))
+        assert db.conn.total_changes == changes + 1
+        c.execute("UPDATE nodes SET lat = 10.5, lon = 20.5 WHERE id = ?", (node,))
+        assert c.execute("select minlon, minlat from nodes_rtree where id = ?", (node,)).fetchone() == (20.5, 10.5)
+        
+    def test_segment_index(self):
+        import ORM, random
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True)
+        l, b, r, t = db.bounds()
+        rnd = random.Random(0)
+        points = [(rnd.uniform(l, r), rnd.uniform(b, t)) for i in range(50)]
+        # with a range covering the whole file, both paths see every way
+        scanned = [db.nearest_way(x, y, range=1) for x, y in points]
+        assert len(db.load_segment_index()) == 3311
+        indexed = [db.nearest_way(x, y, range=1) for x, y in points]
+        assert [w[4] for w in scanned] == [w[4] for w in indexed]
+        assert db.nearest_way(l - 1, b - 1, range=0.001) == (None, None, None, None, None)
+        
+        # ways deleted after the index was loaded are skipped
+        x, y = points[0]
+        way = indexed[0][0]
+        way.delete()
+        hit = db.nearest_way(x, y, range=1)
+        assert hit[0].id != way.id and hit[4] >= indexed[0][4]
+        assert db.nearest_ways([x], [y], range=1)[0][0] == hit[0].id
+        
+    def test_segment_ways(self):
+        import ORM, tempfile
+        dbname = os.path.join(tempfile.gettempdir(), "pysmosis_test_segments.sqlite")
+        db = ORM.OSMDB(dbname, overwrite=True)
+        db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True)
+        assert db.segment_ways() == 1207
+        serial = digest.table_checksum(db.conn, 'waysegment')
+        assert digest.segment_ways(db.conn, workers=3, ways_per_range=50) == 1207
+        assert digest.table_checksum(db.conn, 'waysegment') == serial
+        
+        # the segments of each way join up to its geometry
+        ways = dict((w.id, w) for w in db.ways())
+        joined = {}
+        for s in db.waysegments():
+            assert (s.start_id, s.end_id) == (s.nds[0], s.nds[-1]) and len(s.geom) == len(s.nds) > 1
+            assert s.bbox == (min(s.geom.flat[0::2]), min(s.geom.flat[1::2]), max(s.geom.flat[0::2]), max(s.geom.flat[1::2]))
+            joined[s.way_id] = joined.get(s.way_id, [])[:-1] + list(s.geom)
+        assert all(joined[id] == list(w.geom) for id, w in ways.items())
+        db.conn.close()
+        os.remove(dbname)
+        
+    def test_node_cache(self):
+        import ORM
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True, segment=True)
+        expected = [digest.table_checksum(db.conn, t) for t in ('ways', 'waysegment')]
+        node = db.conn.execute("SELECT id, lon, lat, refcount FROM nodes WHERE refcount > 1").fetchone()
+        
+        # in memory, and spilled to a memory-mapped file from the start
+        for layout in ('dense', 'sorted'):
+            for memory in (None, 0):
+                if layout == 'dense' and memory is None:
+                    continue
+                cache = digest.NodeCache(layout, memory=memory)
+                for parser in ('sax', 'iterparse'):
+                    db = ORM.OSMDB(":memory:")
+                    db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True, 
+                                parser=parser, segment=True, node_cache=cache)
+                    assert [digest.table_checksum(db.conn, t) for t in ('ways', 'waysegment')] == expected
+                    assert len(cache) == 2967 and cache.mapped == (memory == 0)
+                    assert cache.get(node[0]) == node[1:] and cache.get(node[0] + 1) is None and cache.get(1) is None
+                    assert cache.lookup([node[0], node[0] + 1, 1]) == digest._lookup(cache, [node[0], 1]) == {node[0]: node[1:]}
+                    cache.close()
+
+        # out of order records, sorted in memory and through a file
+        ids = [(i * 7919) % 10007 for i in xrange(1, 10007)]
+        for memory in (None, 0, 200000):
+            cache = digest.NodeCache('sorted', memory=memory, block_size=16)
+            for id in ids:
+                cache.add(id, id * 0.5, -id)
+            assert cache.get(5) == (2.5, -5, 0) and cache.get(0) is None and cache.get(10007) is None
+            assert cache.ordered and list(cache.index) == range(1, 10007, 16)
+            assert cache.lookup([3, 10006, 10007]) == {3: (1.5, -3, 0), 10006: (5003.0, -10006, 0)}
+            cache.close()
+
+        # a dense cache with no limit spills large ids to a sparse file, and refuses huge ones
+        cache = digest.NodeCache('dense', memory=None)
+        cache.add(10, 1.0, 2.0)
+        assert not cache.mapped
+        cache.add(1 << 30, 3.0, 4.0)
+        assert cache.mapped and len(cache) == 2
+        assert cache.lookup([10, 1 << 30, 11]) == {10: (1.0, 2.0, 0), 1 << 30: (3.0, 4.0, 0)}
+        for id in (-1, cache.MAX_DENSE_ID):
+            try:
+                cache.add(id, 0.0, 0.0)
+                assert False
+            except ValueError:
+                pass
+        cache.close()
+
+
+    def test_apply_changes(self):
+        import ORM, tempfile, shutil
+        tmp = tempfile.mkdtemp()
+        edited, osc = os.path.join(tmp, "edited.osm"), os.path.join(tmp, "change.osc")
+        make_change(self.file1, edited, osc)
+        highways = lambda way: 'highway' in way.tags
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, accept_way=highways, bulk=True, segment=True)
+        assert db.apply_changes(osc, accept_way=highways)['ways'] == 4
+        full = ORM.OSMDB(":memory:")
+        full.populate(edited, accept_way=highways, bulk=True, segment=True)
+        shutil.rmtree(tmp)
+        
+        # the same as a full import of the edited file, but for segment ids
+        for table in ('nodes', 'ways'):
+            assert digest.table_checksum(db.conn, table) == digest.table_checksum(full.conn, table)
+        segments = ('waysegment', 'way_id, id', 'way_id, start_id, end_id, geom, nds, left, bottom, right, top')
+        assert digest.table_checksum(db.conn, *segments) == digest.table_checksum(full.conn, *segments)
+        for table, rtree in (('ways', 'ways_rtree'), ('nodes', 'nodes_rtree'), ('waysegment', 'waysegment_rtree')):
+            count = "SELECT count(*) FROM %s" % rtree
+            assert db.conn.execute(count).fetchone() == full.conn.execute(count).fetchone()
+            assert db.conn.execute("SELECT count(*) FROM %s WHERE id NOT IN (SELECT id FROM %s)" % (rtree, table)).fetchone()[0] == 0
+        
+    def test_batch_queries(self):
+        import ORM, random
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True)
+        l, b, r, t = db.bounds()
+        rnd = random.Random(1)
+        # near the ways' vertices, so that most points have a match
+        coords = [c for w in db.ways() for c in w.geom]
+        points = [(x + rnd.uniform(-0.001, 0.001), y + rnd.uniform(-0.001, 0.001)) for x, y in rnd.sample(coords, 100)]
+        points.append((l - 1, b - 1))
+        xs, ys = [p[0] for p in points], [p[1] for p in points]
+        
+        nodes = db.nearest_nodes(ys, xs, range=0.001)
+        ways = db.nearest_ways(xs, ys)
+        for i, (x, y) in enumerate(points):
+            n = db.nearest_node(y, x, range=0.001)
+            if n[0] is None:
+                assert nodes[0][i] == -1
+            else:
+                assert tuple(a[i] for a in nodes) == n
+            w = db.nearest_way(x, y)
+            if w[0] is None:
+                assert ways[0][i] == -1
+            else:
+                assert tuple(a[i] for a in ways) == (w[0].id, w[1], w[2], w[3][0], w[3][1], w[4])
+        assert nodes[0][-1] == -1 and ways[0][-1] == -1
+        assert (nodes[0] != -1).sum() > 50 and (ways[0] != -1).sum() > 50
+        
+        # the ranking distance is linearref's within EXACT_MARGIN
+        from pysmosis.geom.index import segment_distance
+        import numpy
+        segs = numpy.array([a + b for w in db.ways() for a, b in zip(w.geom[:-1], w.geom[1:])][:200])
+        approx = ORM._approx_segment_distance(segs[:, 0], segs[:, 1], segs[:, 2], segs[:, 3],
+                                              numpy.array(xs)[:, None], numpy.array(ys)[:, None])
+        for i, (x, y) in enumerate(points):
+            for j, (x1, y1, x2, y2) in enumerate(segs):
+                assert abs(approx[i, j] - segment_distance(x1, y1, x2, y2, x, y)[0]) < ORM.EXACT_MARGIN
         
+        ids = [n[0] for n in db.nodes()][:20]
+        of = db.nearest_nodes_of(ys, xs, ids)
+        assert [tuple(a[i] for a in of) for i in range(len(points))] == [db.nearest_of(y, x, ids) for x, y in points]
+
+    def test_row_modes(self):
+        import ORM
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True)
+        nodes = list(db.nodes())
+        assert len(nodes) == 2967
+        assert nodes == [n.tuple() for n in ORM.Node.objects.query()]
+        assert nodes == [(n.id, n.lat, n.lon) for n in ORM.Node.objects.values('id', 'lat', 'lon', named=True)]
+        ways = [w.values() for w in ORM.Way.objects.query()]
+        assert [tuple(map(str, w)) for w in ways] == [tuple(map(str, w)) for w in ORM.Way.objects.values()]
+        w = db.way(ways[0][0])
+        fields = [getattr(w, c) for c in ORM.Way._columns_]
+        copy = ORM.Way(*fields)
+        assert not hasattr(copy, '__dict__') and [getattr(copy, c) for c in ORM.Way._columns_] == fields
+
+    def test_streaming(self):
+        import ORM, sqlite3, tempfile, shutil
+        tmp = tempfile.mkdtemp()
+        try:
+            db = ORM.OSMDB(os.path.join(tmp, "stream.sqlite"))
+            db.populate(self.file1, bulk=True)
+            db.segment_ways()
+            nodes = db.conn.execute("SELECT id, lat, lon, tags FROM nodes ORDER BY id").fetchall()
+            assert list(db.nodes(page_size=100)) == [n[:3] for n in nodes]
+            assert list(db.nodes(columns=('lat', 'lon'), page_size=7)) == [n[1:3] for n in nodes]
+            assert [n.id for n in db.nodes(columns=None, page_size=1000)] == [n[0] for n in nodes]
+            assert [w.id for w in db.ways(page_size=10)] == [w.id for w in ORM.Way.objects.query()]
+            named = list(ORM.WaySegment.objects.stream(50, ('way_id', 'start_id'), named=True))
+            assert [(s.way_id, s.start_id) for s in named] == [(s.way_id, s.start_id) for s in db.waysegments()]
+            
+            # filters, with and without the rtree indexes
+            bbox = (-122.42, 37.74, -122.41, 37.75)
+            l, b, r, t = bbox
+            in_box = [n[:3] for n in nodes if l <= n[2] <= r and b <= n[1] <= t]
+            ways = list(db.ways())
+            highways = set([w.id for w in ways if w.tags.get('highway') == 'residential'])
+            for rtree in (True, False):
+                db.rtree = rtree
+                assert in_box and list(db.nodes(bbox=bbox, page_size=10)) == in_box
+                assert [w.id for w in db.ways(bbox=bbox)] == [w.id for w in ways if w.left <= r and w.right >= l and w.bottom <= t and w.top >= b]
+            assert highways and set([w.id for w in db.ways(tags={'highway': 'residential'}, page_size=10)]) == highways
+            assert set([s.way_id for s in db.waysegments(tags={'highway': 'residential'})]) == highways
+            assert len(list(db.ways(tags={'highway': None}))) == len([w for w in ways if 'highway' in w.tags])
+            assert [n for n in nodes if n[3] != '{}'] and \
+                   [n[0] for n in db.nodes(tags={'name': None})] == [n[0] for n in nodes if '"name": ' in n[3]]
+            
+            # a writer can commit between pages
+            stream = db.nodes(page_size=100)
+            first = stream.next()
+            writer = sqlite3.connect(os.path.join(tmp, "stream.sqlite"), timeout=0)
+            writer.execute("UPDATE nodes SET refcount = refcount WHERE id = ?", (first[0],))
+            writer.commit()
+            assert len(list(stream)) == len(nodes) - 1
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_connection_pool(self):
+        import ORM, ormlite, threading, tempfile, shutil
+        tmp = tempfile.mkdtemp()
+        try:
+            db = ORM.OSMDB(os.path.join(tmp, "pool.sqlite"), pool=True)
+            db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True)
+            assert db.conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            points = [(37.74 + i * 0.001, -122.41 - i * 0.001) for i in range(20)]
+            expected = [sorted([w.id for w in db.nearby_ways(lat, lon)]) for lat, lon in points]
+            
+            # a database of its own, not the pool's, is now the module connection
+            other = ORM.OSMDB(os.path.join(tmp, "other.sqlite"))
+            assert other.count_ways() == 0 and db.count_ways() == 309
+            
+            # readers in threads while another thread writes
+            results, errors = {}, []
+            def read(n):
+                try:
+                    for r in range(5):
+                        results[n, r] = [sorted([w.id for w in db.nearby_ways(lat, lon)]) for lat, lon in points]
+                except Exception, e:
+                    errors.append(e)
+            def write():
+                try:
+                    for i in range(50):
+                        with db.db.write() as conn:
+                            conn.execute("UPDATE nodes SET refcount = refcount + 1 WHERE id = ?", (65320811,))
+                except Exception, e:
+                    errors.append(e)
+            threads = [threading.Thread(target=read, args=(n,)) for n in range(4)] + [threading.Thread(target=write)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert not errors and len(results) == 20
+            assert all([r == expected for r in results.values()])
+            assert len(db.db.readers) == 5
+            
+            # write blocks nest, and the outermost commits or rolls back
+            try:
+                with db.db.write() as conn:
+                    ORM.Node(id=1, lat=0, lon=0, refcount=0).create(autocommit=False, conn=conn)
+                    with db.db.write():
+                        db.objects[ORM.Node].bulk_delete([65320811], commit=False)
+                    raise KeyError
+            except KeyError:
+                pass
+            assert db.node(65320811) and not db.objects[ORM.Node].get(id=1)
+            with db.db.write() as conn:
+                ORM.Node(id=1, lat=0, lon=0, refcount=0).create(autocommit=False, conn=conn)
+            assert db.node(1) == (1, 0, 0)
+            
+            # records read from the pool write, and follow foreign keys, 
+            # through it, not the module connection
+            n = db.objects[ORM.Node].get(id=1)
+            n.refcount = 7
+            n.save()
+            assert db.objects[ORM.Node].get(id=1).refcount == 7 and other.objects[ORM.Node].get(id=1) is None
+            n.delete()
+            assert db.objects[ORM.Node].get(id=1) is None
+            db.segment_ways()
+            segment = db.objects[ORM.WaySegment].get(id=1)
+            assert segment.way.fetchone().id == segment.way_id
+            assert [s.id for s in db.way(segment.way_id).segment_set].count(segment.id) == 1
+            
+            # a row another thread reads into the geometry cache before a 
+            # write to it is committed is dropped again after the commit
+            way = db.way(segment.way_id)
+            with db.db.write() as conn:
+                way.tags = dict(way.tags, name='Renamed')
+                way.save(conn)
+                reader = threading.Thread(target=db.way, args=(way.id,))
+                reader.start()
+                reader.join()
+            assert db.way(way.id).tags['name'] == 'Renamed'
+            db.close()
+            try:
+                ormlite.ConnectionPool(":memory:")
+                assert False
+            except ValueError:
+                pass
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_routing_graph(self):
+        import ORM, random
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True, segment=True)
+        g = db.load_graph()
+        oneway = [s for s in db.waysegments(tags={'oneway': 'yes'})]
+        assert oneway and len(g) == 2 * 1207 - len(oneway) - len(list(db.waysegments(tags={'oneway': '-1'})))
+        s = oneway[0]
+        assert [e[1] for e in g.edges(s.start_id)].count(s.id) == 1 and s.id not in [e[1] for e in g.edges(s.end_id)]
+        
+        rnd = random.Random(5)
+        lengths = dict((e[1], e[2]) for n in g.nodes for e in g.edges(n))
+        source = rnd.choice(g.nodes)
+        targets = rnd.sample(g.nodes, 50)
+        distances = g.distances(source, targets)
+        assert len(distances) > 25
+        for t in targets:
+            path = g.shortest_path(source, t)
+            assert (path is None) == (t not in distances)
+            if path:
+                length, nodes, segments = path
+                assert abs(length - distances[t]) < 1e-6 and abs(length - g.shortest_path(source, t, astar=False)[0]) < 1e-6
+                assert nodes[0] == source and nodes[-1] == t and len(nodes) == len(segments) + 1
+                assert abs(sum([lengths[seg] for seg in segments]) - length) < 1e-6
+
+
+    def test_snapshot(self):
+        import ORM, random, tempfile, shutil
+        tmp = tempfile.mkdtemp()
+        try:
+            dbname = os.path.join(tmp, "snapshot.sqlite")
+            db = ORM.OSMDB(dbname)
+            assert db.load_snapshot() is False
+            db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True, segment=True)
+            assert db.save_snapshot() == dbname + ".snapshot"
+            generation = db.generation()
+            
+            # a second process would open the database and map the snapshot
+            other = ORM.OSMDB(dbname)
+            assert other.load_snapshot()
+            assert len(other.graph) == len(db.graph) and len(other.segment_index) == len(db.segment_index)
+            rnd = random.Random(6)
+            for source, target in [(rnd.choice(db.graph.nodes), rnd.choice(db.graph.nodes)) for i in range(20)]:
+                assert other.graph.shortest_path(source, target) == db.graph.shortest_path(source, target)
+            for lat, lon in [(37.74 + i * 0.001, -122.41 - i * 0.001) for i in range(20)]:
+                way, seq, frac, point, dist = other.nearest_way(lon, lat)
+                assert (way.id, seq, frac, point, dist) == (lambda hit: (hit[0].id,) + hit[1:])(db.nearest_way(lon, lat))
+            
+            # any write through the OSMDB makes the snapshot stale
+            db.migrate()
+            assert db.generation() == generation + 1
+            other = ORM.OSMDB(dbname)
+            assert not other.load_snapshot() and other.graph is None
+            
+            # and so does making the database anew, at the same generation
+            db.save_snapshot()
+            db = ORM.OSMDB(dbname, overwrite=True)
+            db.populate(self.file1, accept_way=lambda way: way.tags.get('highway') == 'residential', bulk=True, segment=True)
+            while db.generation() < generation + 1:
+                db.migrate()
+            assert db.generation() == generation + 1
+            assert not db.load_snapshot() and db.graph is None
+            
+            # a graph or segment index loaded before a change is not saved as current
+            edited, osc = os.path.join(tmp, "edited.osm"), os.path.join(tmp, "change.osc")
+            make_change(self.file1, edited, osc)
+            db.load_graph()
+            db.load_segment_index()
+            edges, index = len(db.graph), db.segment_index
+            db.apply_changes(osc)
+            assert db.graph is None and db.segment_index is not index
+            db.load_graph()
+            graph = db.graph
+            assert len(graph) > edges
+            db.migrate()
+            db.save_snapshot()
+            assert db.graph is not graph and db.segment_index_generation == db.generation()
+            other = ORM.OSMDB(dbname)
+            assert other.load_snapshot() and len(other.graph) == len(graph)
+            assert len(other.segment_index) == len(ORM.OSMDB(dbname).load_segment_index())
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_map_matching(self):
+        import ORM, random
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True, segment=True)
+        matcher = db.load_matcher()
+        segments = dict((s.id, s) for s in db.waysegments())
+        
+        # fixes between the vertices of shortest paths, a few meters off
+        rnd = random.Random(7)
+        traces, paths = [], []
+        while len(traces) < 5:
+            path = db.graph.shortest_path(rnd.choice(db.graph.nodes), rnd.choice(db.graph.nodes))
+            if not path or len(path[2]) < 5:
+                continue
+            length, nodes, ids = path
+            trace = []
+            for node, id in zip(nodes, ids):
+                geom = segments[id].geom
+                if segments[id].start_id != node:
+                    geom = geom[::-1]
+                trace.extend([((x1 + x2) / 2 + rnd.gauss(0, 0.00003), (y1 + y2) / 2 + rnd.gauss(0, 0.00003))
+                              for (x1, y1), (x2, y2) in zip(geom, geom[1:])])
+            traces.append(trace)
+            paths.append(set(ids))
+        matched = matcher.match_traces(traces)
+        for trace, path, matches in zip(traces, paths, matched):
+            assert len([hit for hit in matches if hit and hit[0] in path]) >= 0.9 * len(trace)
+        assert matcher.match_traces(traces, workers=2) == matched
+
+    def test_tag_index(self):
+        import ORM, tempfile, shutil
+        import simplejson as json
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, bulk=True)
+        tags = dict((id, json.loads(t)) for id, t in db.ways(columns=('id', 'tags')))
+        
+        def check(db):
+            filters = ({'highway': 'residential'}, {'highway': ['primary', 'secondary']},
+                       {'highway': None, 'oneway': None}, {'highway': 'no such value'})
+            for filter in filters:
+                expected = sorted(id for id, t in tags.items()
+                                  if all(k in t and (v is None or t[k] in (v if isinstance(v, list) else [v]))
+                                         for k, v in filter.items()))
+                assert [id for id, in db.ways(tags=filter, columns=('id',))] == expected
+            counts = {}
+            for t in tags.values():
+                if 'highway' in t:
+                    counts[t['highway']] = counts.get(t['highway'], 0) + 1
+            assert db.tag_counts('highway') == counts
+        check(db)
+        # the JSON fallback, and the tables rebuilt from the JSON
+        db.tag_index = False
+        check(db)
+        db.conn.execute("DROP TABLE tag_keys")
+        # an (id, k, v) node_tags table, as in osm.sqlite.sql, is left alone
+        db.conn.execute("CREATE TABLE node_tags (id INTEGER NOT NULL, k TEXT NOT NULL, v TEXT NOT NULL)")
+        db.conn.execute("INSERT INTO node_tags VALUES (1, 'a', 'b')")
+        db.index_tags()
+        check(db)
+        assert db.conn.execute("SELECT * FROM node_tags").fetchall() == [(1, u'a', u'b')]
+        
+        # changes keep the tables in step
+        tmp = tempfile.mkdtemp()
+        edited, osc = os.path.join(tmp, "edited.osm"), os.path.join(tmp, "change.osc")
+        make_change(self.file1, edited, osc)
+        db.apply_changes(osc)
+        shutil.rmtree(tmp)
+        tags = dict((id, json.loads(t)) for id, t in db.ways(columns=('id', 'tags')))
+        check(db)
+        assert [id for id, in db.ways(tags={'name': 'Changed Street'}, columns=('id',))]
+
+    def test_geometry_cache(self):
+        import ORM, random
+        db = ORM.OSMDB(":memory:")
+        db.populate(self.file1, accept_way=lambda way: 'highway' in way.tags, bulk=True, segment=True)
+        db.load_segment_index()
+        rnd = random.Random(3)
+        geoms = [s.geom for s in db.waysegments()]
+        points = [(x + rnd.uniform(-0.0002, 0.0002), y + rnd.uniform(-0.0002, 0.0002))
+                  for x, y in [rnd.choice(rnd.choice(geoms)) for i in range(20)]]
+        cache = ORM.geometry_cache
+        
+        # the same answers from the records in the cache
+        uncached = [db.nearest_way(x, y) for x, y in points]
+        hits = cache.stats()['hits']
+        cached = [db.nearest_way(x, y) for x, y in points]
+        assert cache.stats()['hits'] >= hits + len(points)
+        for a, b in zip(uncached, cached):
+            assert a[0] is not b[0] and a[0].values() == b[0].values() and a[1:] == b[1:]
+            assert a[0].geom == b[0].geom and a[0].tags == b[0].tags
+        
+        way = db.way(cached[0][0].id)
+        line = db.linestring(way.id)
+        assert line is db.linestring(way.id) and len(line) == len(way.geom)
+        segment = db.waysegment(db.objects[ORM.WaySegment].get(way_id=way.id).id)
+        assert db.linestring(segment.id, 'waysegment') is not None
+        assert db.way(-1) is None and db.linestring(-1) is None
+        
+        # saving or deleting a record drops what is kept of its row
+        way.geom = list(way.geom)[:2]
+        way.save()
+        assert db.way(way.id).geom == way.geom and len(db.linestring(way.id)) == 2
+        way.delete()
+        assert db.way(way.id) is None and db.linestring(way.id) is None
+        db.objects[ORM.WaySegment].bulk_delete([segment.id])
+        assert db.waysegment(segment.id) is None
+        
+        # bounded by count
+        size = cache.size
+        cache.size = 10
+        try:
+            evictions = cache.stats()['evictions']
+            for w in db.ways(columns=('id',), page_size=100):
+                db.way(w[0])
+            assert len(cache) <= 10 and cache.stats()['evictions'] > evictions
+        finally:
+            cache.size = size
+        db.close()
+
+    def test_statement_cache(self):
+        import ormlite, sqlite3
+        class Moo(ormlite.Record):
+            _fields_ = (ormlite.ID('id'), ormlite.INT('moo'), ormlite.JSONField('json_array', notnull=False))
+        conn = sqlite3.connect(":memory:")
+        moos = Moo.objects.using(conn)
+        moos.createtable()
+        Moo(id=1, moo=2).create(conn=conn)
+        Moo(id=2, moo=2, json_array=[1, 2, 3]).create(conn=conn)
+        
+        # saves through the SQL made for the class, and queries kept by their fields
+        m = moos.get(id=1)
+        m.json_array = [4]
+        m.save()
+        assert moos.get(id=1).json_array == [4]
+        assert moos.query(moo=2, where=("id < ?", (2,))).fetchone().id == 1
+        assert ('id',) in moos.queries and (('moo',), "id < ?") in moos.queries
+        
+        lru = ormlite.LRUCache(2)
+        lru['a'] = 1
+        lru['b'] = 2
+        lru.get('a')
+        lru['c'] = 3
+        assert 'b' not in lru and lru.get('a') == 1 and lru.get('c') == 3
+        
+        # shared by threads, each inserting more keys than it holds
+        import threading
+        lru = ormlite.LRUCache(64)
+        errors = []
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        def fill(n):
+            try:
+                for i in range(2000):
+                    lru[n, i] = i
+                    lru.get((n, i - 1))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=fill, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        sys.setcheckinterval(interval)
+        assert not errors and len(lru) == 64
+
+    def test_bulk_writes(self):
+        import ormlite, sqlite3
+        class Moo(ormlite.Record):
+            _fields_ = (ormlite.ID('id'), ormlite.INT('moo'), ormlite.PickleField('pickle'))
+        moos = Moo.objects.using(sqlite3.connect(":memory:"))
+        moos.createtable()
+        
+        # from records, dicts of field values and rows of columns
+        assert moos.bulk_create([Moo(id=10, moo=4), {'id': 11, 'moo': 4, 'pickle': {'c': 'd'}}, (12, 4, None)],
+                                columns=('id', 'moo', 'pickle'), batch_size=2) == 3
+        assert moos.get(id=11).pickle == {'c': 'd'} and moos.get(id=12).moo == 4
+        new = [Moo(moo=5), Moo(moo=5)]
+        assert moos.bulk_create(new, rowids=True) == [13, 14] and new[1].id == 14
+        assert moos.bulk_update([Moo(id=10, moo=6, pickle=[1]), {'id': 11, 'moo': 6}]) == 2
+        assert moos.get(id=10).pickle == [1] and moos.get(id=11).pickle is None
+        assert moos.bulk_update([(7, 12)], columns=('moo',)) == 1 and moos.get(id=12).moo == 7
+        assert moos.bulk_delete([13, 14]) == 2 and moos.get(id=13) is None
+        
+        # a failed batch is rolled back
+        try:
+            moos.bulk_create([Moo(id=20), Moo(id=10)])
+            assert False
+        except sqlite3.IntegrityError:
+            assert moos.get(id=20) is None
+        assert moos.values('id').fetchall() == [(10,), (11,), (12,)]
+
+    def test_object_cache(self):
+        import ormlite
+        cache = ormlite.ObjectCache(size=4, nbytes=100)
+        cache.put('x', ('t', 1), 'one', 10)
+        cache.put('x', ('t', 2), 'two', 10)
+        cache.put('y', ('t', 1), 'uno', 10)
+        assert cache.get('x', ('t', 1)) == 'one' and cache.get('x', ('t', 3)) is None
+        
+        # evicts the least recently used, by count and by bytes
+        cache.put('x', ('t', 3), 'three', 10)
+        cache.put('x', ('t', 4), 'four', 60)
+        assert cache.get('x', ('t', 2)) is None and cache.get('y', ('t', 1)) is None and cache.get('x', ('t', 1)) == 'one'
+        assert len(cache) == 3 and cache.nbytes == 80
+        
+        # invalidating a row drops it from every scope
+        cache.put('y', ('t', 1), 'uno', 10)
+        cache.invalidate(('t', 1))
+        assert cache.stats() == {'hits': 2, 'misses': 3, 'evictions': 2, 'invalidations': 2, 'items': 2, 'nbytes': 70}
+
 if __name__ == '__main__':
     BaseTest().test_basic()
 """
@@ -1,11 +1,55 @@
-from distutils.core import setup
-from distutils.extension import Extension
-from Cython.Distutils import build_ext
-
-setup(name='pysmosis',
-      version='0.0.1',
-      description='Python Open Street Map tools',
-      packages=['pysmosis', 'pysmosis.sqlite', 'pysmosis.geom'],
-      cmdclass = {'build_ext': build_ext},
-      ext_modules = [Extension("pysmosis.geom.linearref", ["pysmosis/geom/linearref.pyx"])]
-     )
+import os
+import sys
+from distutils.core import setup
+from distutils.extension import Extension
+from distutils.command.build_ext import build_ext
+from distutils.command.sdist import sdist
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
+
+# build from the .pyx with Cython when it is installed, otherwise from the
+# generated C file a source distribution carries
+try:
+    from Cython.Distutils import build_ext
+    linearref_source = "pysmosis/geom/linearref.pyx"
+except ImportError:
+    linearref_source = "pysmosis/geom/linearref.c"
+
+class cython_sdist(sdist):
+    """Generates linearref.c from the .pyx before making the source 
+    distribution, which carries both (see MANIFEST.in), so that it builds 
+    without Cython.  Needs Cython."""
+    def run(self):
+        from Cython.Compiler.Main import compile
+        result = compile("pysmosis/geom/linearref.pyx")
+        if result.num_errors:
+            raise SystemExit("could not generate linearref.c")
+        sdist.run(self)
+
+class optional_build_ext(build_ext):
+    """Builds the extension if it can; pysmosis.geom.pylinearref stands in
+    for linearref otherwise."""
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError, e:
+            self.warn(e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError), e:
+            self.warn("%s; linearref will use the pure Python fallback" % e)
+
+ext_modules = []
+if os.path.exists(linearref_source):
+    ext_modules.append(Extension("pysmosis.geom.linearref", [linearref_source]))
+else:
+    sys.stderr.write("neither Cython nor %s found; linearref will use the pure Python fallback\n" % linearref_source)
+
+setup(name='pysmosis',
+      version='0.0.1',
+      description='Python Open Street Map tools',
+      packages=['pysmosis', 'pysmosis.sqlite', 'pysmosis.geom'],
+      cmdclass = {'build_ext': optional_build_ext, 'sdist': cython_sdist},
+      ext_modules = ext_modules
+     )